@@ -0,0 +1,138 @@
+# backend/agent_config.py
+"""
+从 JSON 文件加载 Agent 和房间分配，运行中修改文件即可生效，不需要重启进程。
+
+文件格式 (rooms 可省略):
+    {
+      "agents": {
+        "agent_fatty_li": {"name": "李胖子 (AI)", "model": "deepseek/deepseek-chat-v3-0324",
+                           "description": "...", "talk_interval_range": [60, 600],
+                           "context_message_count": 30, "avatar_url": "..."}
+      },
+      "rooms": {"lobby": {"name": "健康生活与减肥", "agents": ["agent_fatty_li"]}}
+    }
+
+按修改时间轮询 (不依赖 inotify，在容器挂载的配置文件上也能用)。文件内容无效时记录错误并保留当前配置。
+生效时直接修改 config.AGENTS 和 config.ROOMS (其他模块持有的是同一个字典)，
+并把定义有变化的 Agent 交给回调，由调度器只重启受影响的发言循环。
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Callable, Dict
+import config
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ("name", "model", "description")
+
+
+class AgentConfigError(ValueError):
+    """配置文件内容无效"""
+
+
+def _validate_agent(agent_id: str, agent: Any) -> Dict[str, Any]:
+    if not isinstance(agent, dict):
+        raise AgentConfigError(f"Agent {agent_id} 的配置必须是对象")
+    missing = [field for field in REQUIRED_FIELDS if not agent.get(field)]
+    if missing:
+        raise AgentConfigError(f"Agent {agent_id} 缺少字段: {missing}")
+    agent = {**agent, "agent_id": agent_id}
+    interval = agent.get("talk_interval_range", (60, 600))
+    if (not isinstance(interval, (list, tuple)) or len(interval) != 2
+            or not all(isinstance(value, (int, float)) for value in interval) or not 0 < interval[0] <= interval[1]):
+        raise AgentConfigError(f"Agent {agent_id} 的 talk_interval_range 必须是 [最小, 最大] 秒")
+    agent["talk_interval_range"] = tuple(interval)
+    count = agent.setdefault("context_message_count", 30)
+    if not isinstance(count, int) or count <= 0:
+        raise AgentConfigError(f"Agent {agent_id} 的 context_message_count 必须是正整数")
+    return agent
+
+
+def parse_agent_config(data: Any) -> tuple[Dict[str, Dict[str, Any]], Dict[str, Dict[str, Any]] | None]:
+    """校验配置文件内容，返回 (agents, rooms)，没有 rooms 时 rooms 为 None"""
+    if not isinstance(data, dict) or not isinstance(data.get("agents"), dict):
+        raise AgentConfigError("配置文件必须包含 agents 对象")
+    agents = {agent_id: _validate_agent(agent_id, agent) for agent_id, agent in data["agents"].items()}
+    rooms = data.get("rooms")
+    if rooms is None:
+        return agents, None
+    if not isinstance(rooms, dict):
+        raise AgentConfigError("rooms 必须是对象")
+    for room_id, room in rooms.items():
+        if not isinstance(room, dict) or not isinstance(room.get("agents", []), list):
+            raise AgentConfigError(f"房间 {room_id} 的配置必须是带 agents 列表的对象")
+        unknown = [agent_id for agent_id in room.get("agents", []) if agent_id not in agents]
+        if unknown:
+            raise AgentConfigError(f"房间 {room_id} 引用了不存在的 Agent: {unknown}")
+    return agents, {room_id: {"name": room.get("name", room_id), "agents": list(room.get("agents", []))}
+                    for room_id, room in rooms.items()}
+
+
+def apply_agent_config(agents: Dict[str, Dict[str, Any]], rooms: Dict[str, Dict[str, Any]] | None) -> set[str]:
+    """
+    把新配置写入 config.AGENTS / config.ROOMS，返回需要重启发言循环的 Agent
+    (新增、删除、定义变化，或者所在的房间有变化)。
+    没有提供 rooms 时：新增的 Agent 加入默认房间 (和 config.py 的默认分配一致)，删除的 Agent 从所有房间移除。
+    """
+    changed = {agent_id for agent_id in set(agents) | set(config.AGENTS)
+               if agents.get(agent_id) != config.AGENTS.get(agent_id)}
+    if rooms is None:
+        rooms = {room_id: {**room, "agents": [agent_id for agent_id in room.get("agents", []) if agent_id in agents]}
+                 for room_id, room in config.ROOMS.items()}
+        default_room = rooms.setdefault(config.DEFAULT_ROOM_ID, {"name": config.DEFAULT_ROOM_ID, "agents": []})
+        default_room["agents"] += [agent_id for agent_id in agents
+                                   if agent_id not in config.AGENTS and agent_id not in default_room["agents"]]
+    for room_id in set(rooms) | set(config.ROOMS):
+        before = set(config.ROOMS.get(room_id, {}).get("agents", []))
+        after = set(rooms.get(room_id, {}).get("agents", []))
+        changed |= before ^ after
+
+    config.AGENTS.clear()
+    config.AGENTS.update(agents)
+    config.ROOMS.clear()
+    config.ROOMS.update(rooms)
+    return changed
+
+
+class AgentConfigWatcher:
+    """轮询配置文件的修改时间，变化时重新加载并调用 on_change(changed_agent_ids)"""
+    def __init__(self, path: str = config.AGENTS_FILE, on_change: Callable[[set[str]], None] | None = None,
+                 interval: float = config.AGENTS_RELOAD_INTERVAL):
+        self.path = path
+        self.on_change = on_change
+        self.interval = interval
+        self._stamp: tuple[int, int] | None = None # (mtime_ns, size)
+
+    def check(self) -> bool:
+        """文件有变化时重新加载，返回是否应用了新配置"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False # 没有配置文件时使用 config.py 中的 Agent
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        try:
+            with open(self.path, encoding="utf-8") as f:
+                agents, rooms = parse_agent_config(json.load(f))
+        except (OSError, ValueError) as e: # JSONDecodeError 和 AgentConfigError 都是 ValueError
+            logger.error(f"Agent 配置文件 {self.path} 无效，保留当前配置: {e}")
+            return False
+        changed = apply_agent_config(agents, rooms)
+        logger.info(f"已加载 Agent 配置文件 {self.path}: {len(agents)} 个 Agent，"
+                    f"变化的 Agent: {sorted(changed) or '无'}")
+        if changed and self.on_change:
+            self.on_change(changed)
+        return True
+
+    async def run(self):
+        """后台任务：定期检查配置文件"""
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                self.check()
+            except Exception as e:
+                logger.error(f"重新加载 Agent 配置出错: {e}", exc_info=True)
@@ -1,112 +1,81 @@
-import httpx
+import asyncio
+import json
 import logging
 import random
+import time
+import uuid
+from collections import deque
 from datetime import datetime, timezone
-from sqlalchemy.orm import Session
-from database import SessionLocal # 直接导入 SessionLocal
-from models import Message as MessageModel, MessageTypeEnum
+from typing import Dict
+from models import MessageTypeEnum
+from repository import MessageRepository
+from message_writer import MessageWriter
+from message_cache import RecentMessageCache
 from connection_manager import ConnectionManager # 需要 manager 来广播
+from model_client import ModelClient, ModelAPIError
+from prompt_builder import PromptBuilder, estimate_tokens
+from metrics import (AGENT_DIRECTOR_REPLIES, AGENT_DIRECTOR_SAVED_CALLS, AGENT_DIRECTOR_SAVED_TOKENS,
+                     MODEL_CALL_SECONDS, MODEL_ERRORS, Trace, record_model_usage)
 import config # 导入配置
 
 logger = logging.getLogger(__name__)
 
+DIRECTOR_ID = "director" # 导演模式调用在指标中的 agent 标签
+
+
+class SpeculativeReply:
+    """提前生成 (或导演模式一次生成) 的回复，last_id 是生成时上下文里最后一条消息的 id (用来判断回复是否过时)"""
+    def __init__(self, content: str, last_id: int):
+        self.content = content
+        self.last_id = last_id
+        # 导演模式：该 Agent 单独调用时的输入 token 数和这次共享调用的输入 token 数 (本地估算，用于统计节省)
+        self.separate_tokens = 0
+        self.shared_tokens = 0
+
+
 class AgentManager:
-    def __init__(self, connection_manager: ConnectionManager):
+    def __init__(self, connection_manager: ConnectionManager, message_repository: MessageRepository,
+                 message_writer: MessageWriter, message_cache: RecentMessageCache):
         self.agents = config.AGENTS
         self.api_key = config.API_KEY
-        self.base_url = config.BASE_URL
         self.connection_manager = connection_manager # 保存 ConnectionManager 实例
-        self.http_client = httpx.AsyncClient(timeout=60.0) # 创建异步 HTTP 客户端，设置超时
-
-    def get_db_session(self) -> Session:
-        """为后台任务创建独立的数据库会话"""
-        return SessionLocal()
+        self.message_repository = message_repository # 数据库访问统一经过 repository，不阻塞事件循环
+        self.message_writer = message_writer # 消息写入走批量管道
+        self.message_cache = message_cache # 最近消息缓存，Agent 上下文优先从这里读取
+        self.model_client = ModelClient() # 连接池、重试、断路器和对冲都在模型客户端里
+        self.prompt_builder = PromptBuilder(self.model_client, self._load_messages_between) # 系统提示缓存、token 预算和聊天摘要
+        self.director_savings: deque[tuple[float, int, int]] = deque() # 最近一小时导演模式的 (时间, 节省调用数, 节省 token 数)
 
-    async def _get_chat_history(self, db: Session, count: int) -> list[MessageModel]:
-        """从数据库获取最近的聊天记录"""
+    async def _get_chat_history(self, count: int, room_id: str) -> list[dict]:
+        """获取房间最近的聊天记录 (前端消息结构)，缓存不足时才查询数据库"""
+        cached = self.message_cache.get_recent(count, room_id)
+        if cached is not None:
+            return cached
         try:
-            history = db.query(MessageModel).order_by(MessageModel.timestamp.desc()).limit(count).all()
-            return history[::-1] # 返回按时间正序排列
+            await self.message_writer.flush_all() # 确保排队中的消息已落盘
+            history = await self.message_repository.get_recent_messages(count, room_id=room_id) # 已按时间正序排列
+            return [msg.to_payload() for msg in history]
         except Exception as e:
             logger.error(f"获取聊天记录失败: {e}", exc_info=True)
             return []
-        finally:
-            db.close() # 确保会话关闭
-
-    def _format_history_for_prompt(self, history: list[MessageModel], agent_id: str) -> list[dict]:
-        """将数据库消息格式化为 API 需要的格式"""
-        formatted_messages = []
-        agent_config = self.agents.get(agent_id)
-        if not agent_config:
-            return []
-
-        for msg in history:
-            role = "assistant" if msg.sender_id == agent_id else "user"
-            # 对于 user 角色，我们通常需要显示是谁说的
-            sender_name = msg.sender_name
-            # 如果消息是来自其他 AI Agent，也明确标出
-            if msg.sender_id.startswith('agent_') and msg.sender_id != agent_id:
-                 other_agent_conf = self.agents.get(msg.sender_id)
-                 if other_agent_conf:
-                     sender_name = other_agent_conf['name'] # 使用配置中的名字
-
-            formatted_messages.append({
-                "role": role,
-                "content": f"{sender_name}: {msg.content}" if role == 'user' else msg.content
-            })
-        return formatted_messages
-
-    def _get_system_prompt(self, agent_id: str) -> str:
-        """为指定 Agent 生成系统提示"""
-        agent_config = self.agents.get(agent_id)
-        if not agent_config:
-            return "你是一个通用的聊天助手。"
-
-        # 构建其他参与者的描述
-        other_participants_desc = []
-        for other_id, other_conf in self.agents.items():
-            if other_id != agent_id:
-                other_participants_desc.append(f"- {other_conf['name']}: {other_conf['description']}")
-        # 也可以加入对普通用户的描述，如果需要的话
-        # other_participants_desc.append("- 其他真实用户: 身份随机")
-
-        participants_str = "\n".join(other_participants_desc)
-        if not participants_str:
-            participants_str = "(当前只有你一个 AI Agent)"
-
-        return f"""你是一个名叫 {agent_config['name']} 的真实人物，正在一个关于"健康生活与减肥"的群聊中（也可能有其他话题）。
-
-你的人物设定：{agent_config['description']}
-
-请根据上面的人物设定和当前的聊天记录，以自然、真实的方式参与讨论。你的回复应该：
-1. 始终保持角色一致性，不要跳出角色。
-2. 不要过于机械或官方，要像真人聊天一样自然，可以使用表情符号、口头禅或口语化表达。
-3. 回复长度适中，不要太长或太短。
-4. 回应最近几条消息，或者基于整体聊天氛围发表看法。
-5. 偶尔可以提问、表达情绪或适当转换话题，但尽量保持对话的连贯性。
-6. 绝对不要提及或暗示你是AI、语言模型或程序。
-7. 你不是群主或管理员，只是一个普通的参与者。
 
-你正在和以下人物（可能还包括其他真实用户）聊天：
-{participants_str}
+    async def _load_messages_between(self, room_id: str, after_id: int, before_id: int, limit: int) -> list[dict]:
+        """读取 id 在 (after_id, before_id) 之间最新的 limit 条消息，用于生成聊天摘要"""
+        messages = self.message_cache.get_by_id(limit, room_id, before_id=before_id)
+        if messages is None:
+            await self.message_writer.flush_all()
+            history = await self.message_repository.get_messages_by_id(limit, before_id, None, room_id)
+            messages = [msg.to_payload() for msg in history]
+        return [msg for msg in messages if msg["id"] > after_id]
 
-请基于当前的聊天历史，给出一个自然、符合你角色的回复。直接输出你的发言内容，不要带任何前缀如 '{agent_config['name']}:'。"""
-
-    async def _call_model_api(self, agent_id: str, history: list[dict]) -> str | None:
-        """调用 OpenRouter API 获取模型回复"""
+    def _build_request(self, agent_id: str, history: list[dict], room_id: str) -> dict | None:
+        """构造模型请求体 (系统提示 + 预算内的聊天记录)"""
         agent_config = self.agents.get(agent_id)
         if not agent_config or not self.api_key:
             logger.error(f"Agent 配置或 API Key 丢失: {agent_id}")
             return None
 
-        headers = {
-            "Authorization": f"Bearer {self.api_key}",
-            "Content-Type": "application/json"
-        }
-        messages = [
-            {"role": "system", "content": self._get_system_prompt(agent_id)},
-            *history # 将格式化后的历史记录解包传入
-        ]
+        messages = self.prompt_builder.build_messages(agent_id, history, room_id)
 
         # 如果历史为空，可能需要引导性发言
         if not history:
@@ -117,79 +86,328 @@ class AgentManager:
             "model": agent_config["model"],
             "messages": messages,
             "temperature": 0.8, # 增加随机性
-            "max_tokens": 200 # 限制回复长度
+            "max_tokens": config.AGENT_REPLY_MAX_TOKENS # 限制回复长度
         }
+        return data
 
-        try:
-            logger.info(f"Agent {agent_id} 正在调用模型 {agent_config['model']}...")
-            response = await self.http_client.post(self.base_url, headers=headers, json=data)
-            response.raise_for_status() # 检查 HTTP 错误
-            result = response.json()
-            message = result["choices"][0]["message"]["content"].strip()
+    def _visible_reply(self, agent_config: dict, text: str, final: bool = True) -> str:
+        """移除可能由模型错误添加的名字前缀；流式生成中还不能确定是否是前缀时先不显示"""
+        text = text.lstrip()
+        possible_prefix = f"{agent_config['name']}:"
+        if text.startswith(possible_prefix):
+            return text[len(possible_prefix):].lstrip()
+        if not final and possible_prefix.startswith(text):
+            return ""
+        return text
 
+    def _record_model_call(self, agent_id: str, data: dict, started: float, reply: str | None,
+                           usage: dict | None = None, cancelled: bool = False):
+        """记录一次模型调用的耗时、token 数和费用；响应里没有 usage 时按本地估算的 token 数计"""
+        model = data["model"]
+        outcome = "cancelled" if cancelled else "ok" if reply else "error"
+        MODEL_CALL_SECONDS.labels(agent_id, model, outcome).observe(time.perf_counter() - started)
+        if cancelled: # 房间没人了或应用关闭，不算模型的错误
+            return
+        if not reply:
+            MODEL_ERRORS.labels(agent_id, model).inc()
+            return
+        if usage and "prompt_tokens" in usage:
+            record_model_usage(agent_id, model, usage["prompt_tokens"], usage.get("completion_tokens", 0),
+                               usage.get("cost"))
+        else:
+            prompt_tokens = sum(estimate_tokens(m["content"]) for m in data["messages"])
+            record_model_usage(agent_id, model, prompt_tokens, estimate_tokens(reply))
+
+    async def _call_model_api(self, agent_id: str, data: dict) -> str | None:
+        """调用 OpenRouter API 获取模型回复"""
+        agent_config = self.agents[agent_id]
+        started = time.perf_counter()
+        message = None
+        usage = None
+        cancelled = False
+        try:
+            logger.debug(f"Agent {agent_id} 正在调用模型 {agent_config['model']}...")
+            result = await self.model_client.complete(data) # 可重试的错误已在客户端内重试
+            usage = result.get("usage")
             # 后处理：移除可能由模型错误添加的前缀
-            possible_prefix = f"{agent_config['name']}:"
-            if message.startswith(possible_prefix):
-                message = message[len(possible_prefix):].strip()
+            message = self._visible_reply(agent_config, result["choices"][0]["message"]["content"]).strip()
 
-            logger.info(f"Agent {agent_id} 收到模型回复: {message[:50]}...")
+            logger.debug(f"Agent {agent_id} 收到模型回复: {message[:50]}...")
             return message
-        except httpx.RequestError as e:
-            logger.error(f"调用 OpenRouter API 网络错误 for {agent_id}: {e}")
-        except httpx.HTTPStatusError as e:
-            logger.error(f"调用 OpenRouter API HTTP 错误 for {agent_id}: {e.response.status_code} - {e.response.text}")
+        except ModelAPIError as e:
+            logger.error(f"调用 OpenRouter API 失败 for {agent_id}: {e}")
         except (KeyError, IndexError, TypeError) as e:
              logger.error(f"解析 OpenRouter API 响应错误 for {agent_id}: {e} - 响应: {result if 'result' in locals() else 'N/A'}")
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
         except Exception as e:
             logger.error(f"调用 OpenRouter API 未知错误 for {agent_id}: {e}", exc_info=True)
+        finally:
+            self._record_model_call(agent_id, data, started, message, usage, cancelled)
         return None
 
-    async def agent_speak(self, agent_id: str):
-        """核心函数：让指定的 Agent 发言"""
+    async def _call_model_api_streaming(self, agent_id: str, data: dict, room_id: str, stream_id: str) -> str | None:
+        """
+        流式调用模型，生成过程中向房间广播 message_delta 帧 (按 STREAM_TICK_MS 合并)，
+        返回完整回复。失败时广播 aborted 帧让前端丢弃草稿，并返回 None。
+        """
+        agent_config = self.agents[agent_id]
+        tick = config.STREAM_TICK_MS / 1000
+        frame = {
+            "type": "message_delta",
+            "streamId": stream_id,
+            "roomId": room_id,
+            "sender": {"id": agent_config["agent_id"], "name": agent_config["name"]},
+        }
+
+        raw = "" # 模型返回的原始文本
+        sent = 0 # 已广播的可见文本长度
+        last_flush = 0.0 # 第一段文本立即发送
+        started = time.perf_counter()
+        message = None
+        cancelled = False
+        try:
+            logger.debug(f"Agent {agent_id} 正在流式调用模型 {agent_config['model']}...")
+            async for piece in self.model_client.stream(data):
+                raw += piece
+                now = time.monotonic()
+                if now - last_flush < tick:
+                    continue
+                visible = self._visible_reply(agent_config, raw, final=False)
+                if len(visible) > sent:
+                    # offset 是这段文本在回复中的起始位置，前端可据此发现被丢弃的帧
+                    await self.connection_manager.broadcast(
+                        {**frame, "delta": visible[sent:], "offset": sent}, room_id)
+                    sent = len(visible)
+                    last_flush = now
+
+            message = self._visible_reply(agent_config, raw).strip()
+            if message:
+                logger.debug(f"Agent {agent_id} 收到模型流式回复: {message[:50]}...")
+                return message
+            logger.error(f"Agent {agent_id} 的模型流式回复为空")
+        except ModelAPIError as e:
+            logger.error(f"流式调用 OpenRouter API 失败 for {agent_id}: {e}")
+        except (ValueError, KeyError, IndexError, TypeError) as e:
+            logger.error(f"解析 OpenRouter API 流式响应错误 for {agent_id}: {e}")
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        except Exception as e:
+            logger.error(f"流式调用 OpenRouter API 未知错误 for {agent_id}: {e}", exc_info=True)
+        finally:
+            # 流式响应不带 usage，按估算计
+            self._record_model_call(agent_id, data, started, message, cancelled=cancelled)
+
+        if sent:
+            await self.connection_manager.broadcast({**frame, "done": True, "aborted": True}, room_id)
+        return None
+
+    async def pregenerate(self, agent_id: str, room_id: str) -> SpeculativeReply | None:
+        """在发言时间到达之前生成回复 (总是非流式，草稿不能提前出现在房间里)，失败时返回 None"""
         agent_config = self.agents.get(agent_id)
         if not agent_config:
-            logger.warning(f"尝试让不存在的 Agent 发言: {agent_id}")
+            return None
+        history = await self._get_chat_history(agent_config["context_message_count"], room_id)
+        data = self._build_request(agent_id, history, room_id)
+        if data is None:
+            return None
+        content = await self._call_model_api(agent_id, data)
+        if not content:
+            return None
+        return SpeculativeReply(content, history[-1]["id"] if history else 0)
+
+    def is_fresh(self, reply: SpeculativeReply, room_id: str, allowance: int = 0) -> bool:
+        """
+        生成之后房间里新增的消息不超过 AGENT_SPECULATIVE_MAX_NEW_MESSAGES 条 (缓存无法判断时按过时处理)。
+        allowance 是允许额外出现的消息数 (导演模式同一轮里已经发出的发言)。
+        """
+        limit = config.AGENT_SPECULATIVE_MAX_NEW_MESSAGES + allowance
+        newer = self.message_cache.get_by_id(limit + 1, room_id, after_id=reply.last_id)
+        return newer is not None and len(newer) <= limit
+
+    def speculative_lead(self, agent_id: str) -> float:
+        """提前多久开始生成：该模型最近调用耗时的分位数，样本不足时用配置的默认值"""
+        stats = self.model_client.stats.get(self.agents[agent_id]["model"])
+        lead = stats.latency_percentile(config.AGENT_SPECULATIVE_LEAD_PERCENTILE) if stats else None
+        return lead if lead is not None else config.AGENT_SPECULATIVE_LEAD
+
+    # --- 导演模式 ---
+    async def director_turn(self, agent_ids: list[str], room_id: str) -> Dict[str, SpeculativeReply] | None:
+        """
+        导演模式：一次模型调用为多个 Agent 各写一条发言，返回校验通过的 {agent_id: 回复}。
+        调用失败或返回的不是约定的 JSON 时返回 None，调用方回退到每个 Agent 单独调用。
+        """
+        agent_ids = [agent_id for agent_id in agent_ids if agent_id in self.agents]
+        if not agent_ids or not self.api_key:
+            return None
+        count = max(self.agents[agent_id]["context_message_count"] for agent_id in agent_ids)
+        history = await self._get_chat_history(count, room_id)
+        model = config.AGENT_DIRECTOR_MODEL or self.agents[agent_ids[0]]["model"]
+        messages = self.prompt_builder.build_director_messages(agent_ids, model, history, room_id)
+        messages.append({"role": "user", "content": "请按要求输出接下来的发言 (JSON)。"})
+        data = {
+            "model": model,
+            "messages": messages,
+            "temperature": 0.8,
+            "max_tokens": config.AGENT_DIRECTOR_MAX_TOKENS,
+            "response_format": {"type": "json_object"},
+        }
+
+        started = time.perf_counter()
+        content = None
+        usage = None
+        cancelled = False
+        try:
+            logger.debug(f"导演模式正在为 {agent_ids} 调用模型 {model}...")
+            result = await self.model_client.complete(data)
+            usage = result.get("usage")
+            content = result["choices"][0]["message"]["content"]
+        except ModelAPIError as e:
+            logger.error(f"导演模式调用 OpenRouter API 失败: {e}")
+        except (KeyError, IndexError, TypeError) as e:
+            logger.error(f"解析导演模式的 API 响应错误: {e}")
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+        finally:
+            self._record_model_call(DIRECTOR_ID, data, started, content, usage, cancelled)
+        if not content:
+            return None
+
+        replies = self._parse_director_replies(content, agent_ids)
+        if replies is None:
+            logger.warning(f"导演模式返回的不是约定的 JSON，回退到单独调用: {content[:100]!r}")
+            return None
+        last_id = history[-1]["id"] if history else 0
+        shared_tokens = sum(estimate_tokens(m["content"]) for m in data["messages"])
+        results = {}
+        for agent_id, text in replies.items():
+            reply = results[agent_id] = SpeculativeReply(text, last_id)
+            reply.shared_tokens = shared_tokens
+            reply.separate_tokens = sum(estimate_tokens(m["content"])
+                                        for m in self.prompt_builder.build_messages(agent_id, history, room_id))
+        return results
+
+    def _parse_director_replies(self, content: str, agent_ids: list[str]) -> Dict[str, str] | None:
+        """解析 {"replies": [{"agent_id", "content"}]}，逐个 Agent 校验；整体格式不对时返回 None"""
+        text = content.strip()
+        if text.startswith("```"): # 有的模型会把 JSON 包在代码块里
+            text = text.strip("`").removeprefix("json").strip()
+        try:
+            parsed = json.loads(text)
+        except ValueError:
+            return None
+        items = parsed.get("replies") if isinstance(parsed, dict) else parsed
+        if not isinstance(items, list):
+            return None
+
+        by_name = {self.agents[agent_id]["name"]: agent_id for agent_id in agent_ids}
+        replies: Dict[str, str] = {}
+        invalid = set()
+        for item in items:
+            if not isinstance(item, dict):
+                continue
+            agent_id = item.get("agent_id")
+            agent_id = agent_id if agent_id in agent_ids else by_name.get(agent_id) # 模型有时会填名字
+            if agent_id is None or agent_id in replies:
+                continue
+            reply = self._validate_persona_reply(agent_id, item.get("content"))
+            if reply is None:
+                invalid.add(agent_id)
+            else:
+                replies[agent_id] = reply
+        for agent_id in agent_ids:
+            if agent_id not in replies:
+                AGENT_DIRECTOR_REPLIES.labels(agent_id, "invalid" if agent_id in invalid else "missing").inc()
+        return replies
+
+    def _validate_persona_reply(self, agent_id: str, content) -> str | None:
+        """导演模式中单个 Agent 的发言：非空、不超过长度上限，且没有混进其他人物的发言"""
+        if not isinstance(content, str):
+            return None
+        text = self._visible_reply(self.agents[agent_id], content).strip()
+        if not text or len(text) > config.MESSAGE_MAX_LENGTH:
+            return None
+        for other_id, other in self.agents.items():
+            if other_id != agent_id and (f"{other['name']}:" in text or f"{other['name']}：" in text):
+                return None
+        return text
+
+    def record_director_savings(self, posted: list[SpeculativeReply]):
+        """一轮导演模式实际发出的发言，和每个 Agent 单独调用相比节省的调用数和输入 token 数"""
+        if len(posted) < 2:
             return
+        saved_calls = len(posted) - 1
+        saved_tokens = max(0, sum(reply.separate_tokens for reply in posted) - posted[0].shared_tokens)
+        AGENT_DIRECTOR_SAVED_CALLS.inc(saved_calls)
+        AGENT_DIRECTOR_SAVED_TOKENS.inc(saved_tokens)
+        self.director_savings.append((time.monotonic(), saved_calls, saved_tokens))
+
+    def director_savings_last_hour(self) -> tuple[int, int]:
+        """最近一小时导演模式节省的 (调用数, 输入 token 数)"""
+        now = time.monotonic()
+        while self.director_savings and now - self.director_savings[0][0] >= 3600:
+            self.director_savings.popleft()
+        return (sum(calls for _, calls, _ in self.director_savings),
+                sum(tokens for _, _, tokens in self.director_savings))
+
+    async def agent_speak(self, agent_id: str, room_id: str = config.DEFAULT_ROOM_ID,
+                          reply: SpeculativeReply | None = None) -> bool:
+        """核心函数：让指定的 Agent 在指定房间发言，返回是否成功发言。传入 reply 时直接发出已经生成好的回复"""
+        agent_config = self.agents.get(agent_id)
+        if not agent_config:
+            logger.warning(f"尝试让不存在的 Agent 发言: {agent_id}")
+            return False
 
-        logger.info(f"轮到 Agent {agent_id} ({agent_config['name']}) 发言...")
-        db = self.get_db_session() # 获取独立会话
-        history_models = await self._get_chat_history(db, agent_config["context_message_count"])
-        formatted_history = self._format_history_for_prompt(history_models, agent_id)
+        logger.debug(f"轮到 Agent {agent_id} ({agent_config['name']}) 在房间 {room_id} 发言...")
+        trace = Trace(agent_id) # 各阶段耗时记入 chat_agent_speak_stage_seconds
+        stream_id = None
+        if reply is not None:
+            ai_response_content = reply.content
+        else:
+            with trace.stage("history"):
+                history = await self._get_chat_history(agent_config["context_message_count"], room_id)
+            with trace.stage("prompt"):
+                data = self._build_request(agent_id, history, room_id)
+            if data is None:
+                trace.finish("no_request")
+                return False
 
-        ai_response_content = await self._call_model_api(agent_id, formatted_history)
+            with trace.stage("model"):
+                if config.AGENT_STREAMING:
+                    stream_id = uuid.uuid4().hex
+                    ai_response_content = await self._call_model_api_streaming(agent_id, data, room_id, stream_id)
+                else:
+                    ai_response_content = await self._call_model_api(agent_id, data)
 
         if ai_response_content:
-            logger.info(f"Agent {agent_id} 准备发送消息: {ai_response_content[:50]}...")
-            # --- 存储 Agent 消息到数据库 ---
-            db_message = MessageModel(
-                sender_id=agent_config["agent_id"],
-                sender_name=agent_config["name"],
-                content=ai_response_content,
-                message_type=MessageTypeEnum.TEXT # Agent 只发文本消息
-                # timestamp 由数据库自动生成
-            )
             try:
-                db.add(db_message)
-                db.commit()
-                db.refresh(db_message)
-                logger.info(f"Agent {agent_id} 的消息已存入数据库: ID={db_message.id}")
+                # --- 存储 Agent 消息到数据库 ---
+                with trace.stage("persist"):
+                    db_message = await self.message_writer.submit(
+                        sender_id=agent_config["agent_id"],
+                        sender_name=agent_config["name"],
+                        content=ai_response_content,
+                        message_type=MessageTypeEnum.TEXT, # Agent 只发文本消息
+                        room_id=room_id
+                    )
 
                 # --- 广播 Agent 消息 ---
-                message_to_broadcast = {
-                    "type": "message",
-                    "content": db_message.content,
-                    "messageType": db_message.message_type.name,
-                    "sender": {"id": db_message.sender_id, "name": db_message.sender_name},
-                    "timestamp": db_message.timestamp.isoformat() + "Z"
-                }
-                await self.connection_manager.broadcast(message_to_broadcast)
-                logger.info(f"Agent {agent_id} 的消息已广播.")
+                with trace.stage("broadcast"):
+                    payload = db_message.to_payload()
+                    if stream_id:
+                        payload["streamId"] = stream_id # 前端用最终消息替换流式草稿
+                    await self.connection_manager.broadcast(payload, room_id)
+                logger.debug(f"Agent {agent_id} 的消息已广播: ID={db_message.id}")
+                trace.finish("spoke_pregenerated" if reply is not None else "spoke")
+                return True
 
             except Exception as e:
-                db.rollback()
                 logger.error(f"存储或广播 Agent {agent_id} 的消息失败: {e}", exc_info=True)
-            finally:
-                db.close() # 确保会话关闭
+                trace.finish("error")
         else:
             logger.warning(f"Agent {agent_id} 未能生成有效回复。")
-            db.close() # 即使没有回复也要关闭会话 
\ No newline at end of file
+            trace.finish("no_reply")
+        return False
@@ -0,0 +1,241 @@
+# backend/backplane.py
+import asyncio
+import json
+import logging
+import os
+import socket
+import sqlite3
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List
+import config
+
+logger = logging.getLogger(__name__)
+
+EventHandler = Callable[[Dict[str, Any]], None]
+
+
+def make_origin_id() -> str:
+    """当前 worker 的唯一标识 (主机名:进程号:随机后缀)"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+
+class Backplane:
+    """
+    广播总线：把本 worker 产生的事件 (广播消息、在线用户) 转发给其他 worker。
+    publish 不等待网络/磁盘，事件由各实现自己的后台任务批量发送。
+    """
+    cross_process = False # 是否真正跨进程 (决定消息 id 的分配方式和 leader 选举)
+
+    def __init__(self):
+        self.origin = make_origin_id()
+        self._handler: EventHandler | None = None
+
+    async def start(self, handler: EventHandler):
+        """开始接收其他 worker 的事件，handler 在事件循环中同步调用"""
+        self._handler = handler
+
+    def publish(self, event: Dict[str, Any]):
+        """发布一个事件给其他 worker (非阻塞)"""
+
+    async def stop(self):
+        pass
+
+
+class InProcessBackplane(Backplane):
+    """单进程部署：没有其他 worker，发布的事件直接丢弃"""
+
+
+class SQLiteBackplane(Backplane):
+    """
+    基于共享 SQLite 文件的本地广播总线，同一台机器上的多个 worker 无需外部服务即可互通。
+    每个 worker 批量写入自己的事件，并按固定间隔轮询其他 worker 写入的新事件。
+    """
+    cross_process = True
+
+    def __init__(self, path: str = config.BACKPLANE_DB_FILE,
+                 poll_interval: float = config.BACKPLANE_POLL_INTERVAL,
+                 retention: float = config.BACKPLANE_RETENTION):
+        super().__init__()
+        self.path = path
+        self.poll_interval = poll_interval
+        self.retention = retention
+        self._outbox: List[Dict[str, Any]] = []
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="backplane")
+        self._conn: sqlite3.Connection | None = None
+        self._last_id = 0
+        self._last_prune = 0.0
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    async def _run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    def _open(self):
+        self._conn = sqlite3.connect(self.path, timeout=5.0, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=OFF") # 事件只是转发用，不需要持久化
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS backplane_events (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            origin TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            created_at REAL NOT NULL)""")
+        self._conn.commit()
+        # 只接收启动之后的事件
+        self._last_id = self._conn.execute("SELECT COALESCE(MAX(id), 0) FROM backplane_events").fetchone()[0]
+
+    def _exchange(self, outbox: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """写入本 worker 的事件，并读取其他 worker 的新事件"""
+        now = time.time()
+        if outbox:
+            self._conn.executemany(
+                "INSERT INTO backplane_events (origin, payload, created_at) VALUES (?, ?, ?)",
+                [(self.origin, json.dumps(event), now) for event in outbox])
+        if now - self._last_prune > self.retention:
+            self._conn.execute("DELETE FROM backplane_events WHERE created_at < ?", (now - self.retention,))
+            self._last_prune = now
+        self._conn.commit()
+
+        rows = self._conn.execute(
+            "SELECT id, origin, payload FROM backplane_events WHERE id > ? ORDER BY id LIMIT 1000",
+            (self._last_id,)).fetchall()
+        if rows:
+            self._last_id = rows[-1][0]
+        return [json.loads(payload) for _, origin, payload in rows if origin != self.origin]
+
+    async def start(self, handler: EventHandler):
+        await super().start(handler)
+        await self._run(self._open)
+        self._task = asyncio.create_task(self._poll_loop())
+        logger.info(f"SQLite 广播总线已启动: {self.path}, worker={self.origin}")
+
+    def publish(self, event: Dict[str, Any]):
+        event["origin"] = self.origin
+        self._outbox.append(event)
+
+    async def _poll_loop(self):
+        while not self._stopping:
+            try:
+                outbox, self._outbox = self._outbox, []
+                events = await self._run(self._exchange, outbox)
+                for event in events:
+                    try:
+                        self._handler(event)
+                    except Exception as e:
+                        logger.error(f"处理广播总线事件出错: {e}", exc_info=True)
+            except Exception as e:
+                logger.error(f"广播总线轮询出错: {e}", exc_info=True)
+            await asyncio.sleep(self.poll_interval)
+
+    async def stop(self):
+        self._stopping = True
+        if self._task:
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self._outbox: # 把最后的事件发出去
+            await self._run(self._exchange, self._outbox)
+            self._outbox = []
+        if self._conn:
+            await self._run(self._conn.close)
+        self._executor.shutdown(wait=True)
+        logger.info("SQLite 广播总线已关闭。")
+
+
+class LeaderElector:
+    """
+    基于 SQLite 租约的 leader 选举：持有租约的 worker 定期续约，
+    租约过期后其他 worker 可以接管。用于保证只有一个 worker 运行 Agent 调度。
+    """
+    def __init__(self, origin: str, path: str = config.BACKPLANE_DB_FILE,
+                 name: str = "agent_scheduler", ttl: float = config.LEADER_LEASE_TTL):
+        self.origin = origin
+        self.path = path
+        self.name = name
+        self.ttl = ttl
+        self.is_leader = False
+        self._on_change: Callable[[bool], None] | None = None
+        self._task: asyncio.Task | None = None
+
+    def _try_acquire(self) -> bool:
+        conn = sqlite3.connect(self.path, timeout=5.0)
+        try:
+            conn.execute("""CREATE TABLE IF NOT EXISTS leases (
+                name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL)""")
+            conn.execute("BEGIN IMMEDIATE") # 获取写锁，保证检查和更新是原子的
+            now = time.time()
+            row = conn.execute("SELECT holder, expires_at FROM leases WHERE name = ?", (self.name,)).fetchone()
+            if row is None or row[0] == self.origin or row[1] < now:
+                conn.execute("INSERT OR REPLACE INTO leases (name, holder, expires_at) VALUES (?, ?, ?)",
+                             (self.name, self.origin, now + self.ttl))
+                conn.commit()
+                return True
+            conn.rollback()
+            return False
+        finally:
+            conn.close()
+
+    def _release(self):
+        conn = sqlite3.connect(self.path, timeout=5.0)
+        try:
+            conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.name, self.origin))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _set_leader(self, is_leader: bool):
+        if is_leader != self.is_leader:
+            self.is_leader = is_leader
+            logger.info(f"worker {self.origin} {'成为' if is_leader else '不再是'} {self.name} 的 leader")
+            if self._on_change:
+                self._on_change(is_leader)
+
+    async def start(self, on_change: Callable[[bool], None]):
+        """开始竞选，leader 身份变化时调用 on_change(is_leader)"""
+        self._on_change = on_change
+        self._task = asyncio.create_task(self._loop())
+
+    async def _loop(self):
+        while True:
+            try:
+                self._set_leader(await asyncio.to_thread(self._try_acquire))
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"leader 选举出错: {e}", exc_info=True)
+                self._set_leader(False) # 无法确认租约时保守地放弃
+            await asyncio.sleep(self.ttl / 3)
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+        if self.is_leader:
+            await asyncio.to_thread(self._release) # 主动释放，其他 worker 不必等租约过期
+            self._set_leader(False)
+
+
+class LocalLeaderElector(LeaderElector):
+    """单进程部署：自己永远是 leader"""
+    def __init__(self, origin: str):
+        super().__init__(origin)
+
+    async def start(self, on_change: Callable[[bool], None]):
+        self._on_change = on_change
+        self._set_leader(True)
+
+    async def stop(self):
+        self._set_leader(False)
+
+
+def create_backplane(kind: str = config.BACKPLANE) -> Backplane:
+    if kind == "inprocess":
+        return InProcessBackplane()
+    if kind == "sqlite":
+        return SQLiteBackplane()
+    raise ValueError(f"未知的广播总线类型: {kind}")
+
+
+def create_leader_elector(backplane: Backplane) -> LeaderElector:
+    if backplane.cross_process:
+        return LeaderElector(backplane.origin)
+    return LocalLeaderElector(backplane.origin)
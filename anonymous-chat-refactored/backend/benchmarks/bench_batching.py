@@ -0,0 +1,156 @@
+# backend/benchmarks/bench_batching.py
+"""
+广播批量 (config.BROADCAST_BATCH_MS) 的延迟和吞吐对比。
+
+在进程内创建一个房间和 N 个假的 WebSocket 连接，按固定速率向房间广播聊天消息 (可选地同时有流式回复的增量)，
+分别在关闭批量和不同 tick 下运行，输出：
+  - 发出的帧数、字节数 (每个连接的写入次数就是 socket 写入的系统调用次数)
+  - 事件循环的 CPU 时间 (编码 + 入队 + 发送)
+  - 从广播到写入 socket 的延迟百分位 (在第一个连接上按消息的 seq 统计)
+  - 批次中被合并或取代的事件数
+假连接的 send_text 按 --send-cost-us 模拟每次写 socket 的固定开销 (帧头、掩码、系统调用)，
+真实开销和网络栈有关，可以用 loadtest.py 在真实 uvicorn 上验证。
+
+用法:
+    python benchmarks/bench_batching.py
+    python benchmarks/bench_batching.py --connections 500 --rate 200 --ticks 0 20 50
+    python benchmarks/bench_batching.py --rate 2          # 安静的房间：批量不应该增加延迟
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from connection_manager import ConnectionManager
+from metrics import BROADCAST_BATCH_SUPERSEDED
+
+
+class FakeWebSocket:
+    """只统计写入的假连接；probe 连接解析每一帧，记录每条消息从广播到写入的延迟"""
+    def __init__(self, send_cost: float, sent_at: dict | None = None):
+        self.send_cost = send_cost
+        self.sent_at = sent_at
+        self.frames = 0
+        self.bytes = 0
+        self.latencies: list[float] = []
+
+    async def accept(self, subprotocol=None):
+        pass
+
+    async def close(self, code: int = 1000):
+        pass
+
+    async def send_text(self, frame: str):
+        now = time.perf_counter()
+        deadline = now + self.send_cost
+        while time.perf_counter() < deadline: # 模拟写 socket 的固定 CPU 开销
+            pass
+        self.frames += 1
+        self.bytes += len(frame.encode())
+        if self.sent_at is not None:
+            data = json.loads(frame)
+            for event in data if isinstance(data, list) else [data]:
+                seq = event.get("seq")
+                if seq is not None:
+                    self.latencies.append(now - self.sent_at.pop(seq))
+        await asyncio.sleep(0)
+
+
+def percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+async def run_once(tick_ms: int, connections: int, rate: float, duration: float,
+                   streams: int, delta_interval: float, send_cost: float) -> dict:
+    config.BROADCAST_BATCH_MS = tick_ms
+    manager = ConnectionManager()
+    room_id = config.DEFAULT_ROOM_ID
+    sent_at: dict[int, float] = {}
+    sockets = [FakeWebSocket(send_cost, sent_at if i == 0 else None) for i in range(connections)]
+    for i, ws in enumerate(sockets):
+        await manager.connect(ws, f"user_{i:04d}", f"匿名用户{i}", room_id, batch=True)
+    await asyncio.sleep(config.PRESENCE_COALESCE_MS / 1000 + 0.2) # 等连接时的在线用户列表发完
+    for ws in sockets:
+        ws.frames = ws.bytes = 0
+    superseded_before = BROADCAST_BATCH_SUPERSEDED.value
+
+    async def chat():
+        seq, started = 0, time.perf_counter()
+        while (elapsed := time.perf_counter() - started) < duration:
+            while seq < elapsed * rate:
+                sent_at[seq] = time.perf_counter()
+                await manager.broadcast({
+                    "type": "message", "seq": seq, "id": seq, "roomId": room_id,
+                    "content": "晚饭后散步半小时，对血糖控制很有帮助。大家有没有试过把含糖饮料换成无糖茶？",
+                    "messageType": "TEXT", "sender": {"id": f"user_{seq % connections:04d}", "name": "匿名用户"},
+                }, room_id)
+                seq += 1
+            await asyncio.sleep(0.001)
+        return seq
+
+    async def stream(stream_id: str):
+        offset, started = 0, time.perf_counter()
+        while time.perf_counter() - started < duration:
+            delta = "多吃蔬菜少喝饮料，"
+            await manager.broadcast({"type": "message_delta", "streamId": stream_id, "roomId": room_id,
+                                     "sender": {"id": "agent", "name": "AI"}, "delta": delta, "offset": offset}, room_id)
+            offset += len(delta)
+            await asyncio.sleep(delta_interval)
+
+    cpu0 = time.process_time()
+    results = await asyncio.gather(chat(), *(stream(f"s{i}") for i in range(streams)))
+    await asyncio.sleep(max(0.2, tick_ms / 1000 * 2)) # 等最后一个批次和发送队列写完
+    cpu = time.process_time() - cpu0
+    manager.close_all()
+
+    latencies = sockets[0].latencies
+    return {
+        "tick_ms": tick_ms,
+        "messages": results[0],
+        "frames": sum(ws.frames for ws in sockets),
+        "bytes": sum(ws.bytes for ws in sockets),
+        "cpu_s": cpu,
+        "delivered": len(latencies) / max(1, results[0]),
+        "p50_ms": percentile(latencies, 0.5) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "mean_ms": (statistics.fmean(latencies) if latencies else 0.0) * 1000,
+        "superseded": BROADCAST_BATCH_SUPERSEDED.value - superseded_before,
+    }
+
+
+async def run(args):
+    print(f"{args.connections} 个连接，{args.rate} 条消息/秒，{args.streams} 路流式回复 (每 {args.delta_interval_ms} ms 一个增量)，"
+          f"持续 {args.duration} 秒，每次写入开销 {args.send_cost_us} µs")
+    print(f"{'tick':>6}{'帧数':>10}{'MB':>8}{'CPU 秒':>9}{'送达率':>8}{'p50 ms':>9}{'p99 ms':>9}{'平均 ms':>9}{'被合并':>8}")
+    for tick in args.ticks:
+        r = await run_once(tick, args.connections, args.rate, args.duration, args.streams,
+                           args.delta_interval_ms / 1000, args.send_cost_us / 1e6)
+        label = "关闭" if tick == 0 else f"{tick}ms"
+        print(f"{label:>6}{r['frames']:>10}{r['bytes'] / 1e6:>8.2f}{r['cpu_s']:>9.2f}{r['delivered']:>8.2%}"
+              f"{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['mean_ms']:>9.2f}{r['superseded']:>8.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="广播批量的延迟和吞吐对比")
+    parser.add_argument("--connections", type=int, default=200, help="房间内的连接数")
+    parser.add_argument("--rate", type=float, default=100, help="每秒广播的聊天消息数")
+    parser.add_argument("--duration", type=float, default=3, help="每种配置的运行时间 (秒)")
+    parser.add_argument("--streams", type=int, default=1, help="同时进行的流式回复数")
+    parser.add_argument("--delta-interval-ms", type=float, default=10, help="流式回复增量的间隔 (毫秒)")
+    parser.add_argument("--send-cost-us", type=float, default=5, help="每次写 socket 的模拟开销 (微秒)")
+    parser.add_argument("--ticks", type=int, nargs="+", default=[0, 10, 20, 50], help="要对比的 tick (毫秒)，0 表示关闭批量")
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
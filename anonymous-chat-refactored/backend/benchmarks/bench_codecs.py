@@ -0,0 +1,109 @@
+# backend/benchmarks/bench_codecs.py
+"""
+WebSocket 帧编码基准测试。
+
+对典型的 message 和 user_list_update 事件，比较：
+  - json (旧): 标准库 json.dumps 默认参数 (Starlette send_json 的行为，中文转义为 \\uXXXX)
+  - json (紧凑): ensure_ascii=False + 紧凑分隔符
+  - orjson: 安装了 orjson 时 JSONCodec 使用的实现
+  - msgpack: 安装了 msgpack 时可选的二进制编码
+输出每种编码的帧大小、permessage-deflate 压缩后的大小和每次编码耗时，
+以及一次广播给 N 个连接时 "每个连接各编码一次" 和 "每种编码只编码一次" 的耗时对比。
+
+用法:
+    python benchmarks/bench_codecs.py
+    python benchmarks/bench_codecs.py --users 200 --connections 1000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+import zlib
+from datetime import datetime, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import config
+from wire_codec import orjson, msgpack
+
+
+def sample_events(users: int) -> dict:
+    now = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+    return {
+        "message": {
+            "type": "message",
+            "id": 123456,
+            "roomId": config.DEFAULT_ROOM_ID,
+            "content": "晚饭后散步半小时，对血糖控制很有帮助。大家有没有试过把含糖饮料换成无糖茶？",
+            "messageType": "TEXT",
+            "sender": {"id": "agent_1", "name": "小雅"},
+            "timestamp": now,
+        },
+        f"user_list_update ({users} 人)": {
+            "type": "user_list_update",
+            "users": [{"id": f"user_{i:04d}", "name": f"匿名用户{i}"} for i in range(users)],
+        },
+    }
+
+
+def encoders() -> dict:
+    result = {
+        "json (旧)": lambda m: json.dumps(m),
+        "json (紧凑)": lambda m: json.dumps(m, ensure_ascii=False, separators=(",", ":")),
+    }
+    if orjson is not None:
+        result["orjson"] = lambda m: orjson.dumps(m).decode()
+    if msgpack is not None:
+        result["msgpack"] = lambda m: msgpack.packb(m, use_bin_type=True)
+    return result
+
+
+def deflated_size(frame: str | bytes) -> int:
+    """按服务器的 permessage-deflate 参数压缩后的大小 (raw deflate，不共享上下文)"""
+    data = frame.encode() if isinstance(frame, str) else frame
+    compressor = zlib.compressobj(config.WS_DEFLATE_LEVEL, zlib.DEFLATED,
+                                  -config.WS_DEFLATE_MAX_WINDOW_BITS, config.WS_DEFLATE_MEM_LEVEL)
+    return len(compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)) - 4 # 去掉 00 00 ff ff 尾部
+
+
+def time_encode(encode, message, repeat: int) -> float:
+    """返回每次编码的平均耗时 (微秒)"""
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        encode(message)
+    return (time.perf_counter() - t0) / repeat * 1e6
+
+
+def run(users: int, connections: int, repeat: int):
+    codecs = encoders()
+    events = sample_events(users)
+    for event_name, message in events.items():
+        print(f"\n== {event_name} ==")
+        print(f"{'编码':<14}{'字节':>10}{'deflate 后':>12}{'编码 µs':>12}")
+        for codec_name, encode in codecs.items():
+            frame = encode(message)
+            size = len(frame.encode() if isinstance(frame, str) else frame)
+            print(f"{codec_name:<14}{size:>10}{deflated_size(frame):>12}{time_encode(encode, message, repeat):>12.2f}")
+
+    # 广播: 旧实现对每个连接调用 send_json (每个连接编码一次)，现在每种编码只编码一次
+    message = events["message"]
+    best = codecs.get("orjson", codecs["json (紧凑)"])
+    per_connection = time_encode(lambda m: [codecs["json (旧)"](m) for _ in range(connections)], message, max(1, repeat // 100))
+    encode_once = time_encode(best, message, repeat)
+    print(f"\n== 广播一条消息给 {connections} 个连接 ==")
+    print(f"每个连接编码一次 (旧): {per_connection / 1000:.2f} ms")
+    print(f"每种编码只编码一次:   {encode_once / 1000:.4f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="WebSocket 帧编码基准测试")
+    parser.add_argument("--users", type=int, default=50, help="user_list_update 中的用户数")
+    parser.add_argument("--connections", type=int, default=500, help="广播对比中的连接数")
+    parser.add_argument("--repeat", type=int, default=10000, help="每种编码重复次数")
+    args = parser.parse_args()
+    run(args.users, args.connections, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,111 @@
+# backend/benchmarks/bench_pagination.py
+"""
+/api/messages 分页延迟基准测试。
+
+在临时 SQLite 文件中生成 N 条消息 (时间戳为秒级精度，和线上一致)，比较：
+  - timestamp (无索引): 旧的 before_timestamp 分页，强制不走索引，相当于旧表结构
+  - timestamp (有索引): before_timestamp 分页 + ix_messages_timestamp
+  - id 游标: before_id 键集分页
+
+用法:
+    python benchmarks/bench_pagination.py                 # 默认 1M 和 10M 行
+    python benchmarks/bench_pagination.py --rows 100000   # 快速验证
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from database import Base, SessionLocal
+from repository import MessageRepository
+import models # 注册 Message 表
+import config
+
+PAGE_SIZE = 30
+INSERT_CHUNK = 50000
+
+def build_database(path: str, rows: int):
+    """用和线上相同的表结构生成测试数据库"""
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    start = datetime(2025, 1, 1)
+    senders = [(f"user_{i}", f"用户{i}") for i in range(200)]
+    inserted = 0
+    while inserted < rows:
+        chunk = min(INSERT_CHUNK, rows - inserted)
+        batch = []
+        for i in range(inserted, inserted + chunk):
+            sender_id, sender_name = random.choice(senders)
+            # 平均每秒 3 条消息，大量消息共享同一个秒级时间戳
+            timestamp = (start + timedelta(seconds=i // 3)).strftime("%Y-%m-%d %H:%M:%S")
+            batch.append((sender_id, sender_name, f"消息内容 {i}", "TEXT", timestamp))
+        conn.executemany(
+            "INSERT INTO messages (sender_id, sender_name, content, message_type, timestamp) VALUES (?, ?, ?, ?, ?)",
+            batch)
+        conn.commit()
+        inserted += chunk
+    conn.execute("ANALYZE")
+    conn.close()
+
+def time_call(func, repeat: int) -> float:
+    """返回多次调用的中位数耗时 (毫秒)"""
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples)
+
+def run(rows: int, repeat: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        t0 = time.perf_counter()
+        build_database(path, rows)
+        print(f"\n== {rows:,} 行 (生成耗时 {time.perf_counter() - t0:.1f}s) ==")
+
+        engine = create_engine(f"sqlite:///{path}")
+        SessionLocal.configure(bind=engine)
+        repository = MessageRepository(use_executor=False)
+        raw = sqlite3.connect(path)
+
+        print(f"{'页位置':<10}{'timestamp(无索引)':>20}{'timestamp(有索引)':>20}{'id 游标':>12}  (ms, 中位数)")
+        for depth in (0.0, 0.5, 0.99):
+            cursor_id = max(2, int(rows * (1 - depth)))
+            cursor_ts = raw.execute("SELECT timestamp FROM messages WHERE id = ?", (cursor_id,)).fetchone()[0]
+            cursor_dt = datetime.fromisoformat(cursor_ts)
+
+            legacy = time_call(lambda: raw.execute(
+                "SELECT * FROM messages NOT INDEXED WHERE timestamp < ? ORDER BY timestamp DESC LIMIT ?",
+                (cursor_ts, PAGE_SIZE)).fetchall(), max(1, repeat // 5))
+            by_timestamp = time_call(lambda: repository._get_recent_messages_sync(
+                PAGE_SIZE, cursor_dt, config.DEFAULT_ROOM_ID), repeat)
+            by_id = time_call(lambda: repository._get_messages_by_id_sync(
+                PAGE_SIZE, cursor_id, None, config.DEFAULT_ROOM_ID), repeat)
+            print(f"{f'{depth:.0%}':<10}{legacy:>20.2f}{by_timestamp:>20.2f}{by_id:>12.2f}")
+
+        raw.close()
+        engine.dispose()
+
+def main():
+    parser = argparse.ArgumentParser(description="/api/messages 分页延迟基准测试")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000, 10_000_000], help="测试的数据行数")
+    parser.add_argument("--repeat", type=int, default=20, help="每个查询重复次数")
+    args = parser.parse_args()
+    for rows in args.rows:
+        run(rows, args.repeat)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+# backend/benchmarks/bench_search.py
+"""
+/api/search 全文检索延迟基准测试。
+
+在临时 SQLite 文件中生成 N 条中文消息 (由常见短句随机拼接，不同检索词的命中率差别很大)，
+测量索引重建耗时、索引体积，以及以下查询的延迟：
+  - 常见词 / 罕见词 (按相关度排序，第一页)
+  - 常见词 + 发送者过滤、按时间倒序
+  - 深翻页 (offset 接近上限)
+  - 短词 (少于 3 个字，退化为有上限的 LIKE 扫描)
+  - 对照：对全部命中计算 bm25 排序、LIKE 全表扫描 (没有全文索引时的做法)
+
+用法:
+    python benchmarks/bench_search.py                 # 默认 1M 和 5M 行
+    python benchmarks/bench_search.py --rows 100000   # 快速验证
+"""
+import argparse
+import os
+import random
+import sqlite3
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from database import Base, SessionLocal
+from repository import MessageRepository
+from search_index import rebuild_search_index
+import models # 注册 Message 表
+import config
+
+INSERT_CHUNK = 50000
+PHRASES = [
+    "今天中午只吃了一碗蔬菜沙拉", "控制体重最重要的是长期坚持", "晚饭后散步半小时", "对血糖控制很有帮助",
+    "把含糖饮料换成无糖茶", "睡眠不足的时候特别容易饿", "周末去爬山了", "最近在学做低脂餐",
+    "体脂率终于降下来了", "跑步膝盖有点疼", "有没有推荐的健身房", "早餐一定要吃",
+    "我觉得健康比体重更重要", "今天天气不错", "哈哈哈", "好的", "同意", "明天继续打卡",
+]
+RARE_WORD = "牛油果奶昔" # 大约每 1 万条出现一次
+
+
+def build_database(path: str, rows: int):
+    """用和线上相同的表结构生成测试数据库"""
+    engine = create_engine(f"sqlite:///{path}")
+    Base.metadata.create_all(bind=engine)
+    engine.dispose()
+
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=OFF")
+    start = datetime(2025, 1, 1)
+    senders = [(f"user_{i}", f"用户{i}") for i in range(200)]
+    inserted = 0
+    while inserted < rows:
+        chunk = min(INSERT_CHUNK, rows - inserted)
+        batch = []
+        for i in range(inserted, inserted + chunk):
+            sender_id, sender_name = random.choice(senders)
+            content = "，".join(random.sample(PHRASES, k=random.randint(1, 3)))
+            if random.random() < 0.0001:
+                content += f"，{RARE_WORD}"
+            timestamp = (start + timedelta(seconds=i // 3)).strftime("%Y-%m-%d %H:%M:%S")
+            batch.append((config.DEFAULT_ROOM_ID, sender_id, sender_name, content, "TEXT", timestamp))
+        conn.executemany(
+            "INSERT INTO messages (room_id, sender_id, sender_name, content, message_type, timestamp) "
+            "VALUES (?, ?, ?, ?, ?, ?)", batch)
+        conn.commit()
+        inserted += chunk
+    conn.execute("ANALYZE")
+    conn.close()
+
+
+def time_call(func, repeat: int) -> float:
+    """返回多次调用的中位数耗时 (毫秒)"""
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        samples.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(samples)
+
+
+def run(rows: int, repeat: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        t0 = time.perf_counter()
+        build_database(path, rows)
+        print(f"\n== {rows:,} 行 (生成耗时 {time.perf_counter() - t0:.1f}s) ==")
+
+        engine = create_engine(f"sqlite:///{path}")
+        size_before = os.path.getsize(path)
+        t0 = time.perf_counter()
+        rebuild_search_index(engine)
+        print(f"重建索引耗时 {time.perf_counter() - t0:.1f}s，数据库 {size_before / 2**20:.0f} MB -> "
+              f"{os.path.getsize(path) / 2**20:.0f} MB")
+
+        SessionLocal.configure(bind=engine)
+        repository = MessageRepository(use_executor=False)
+        raw = sqlite3.connect(path)
+        search = repository._search_messages_sync
+        room = config.DEFAULT_ROOM_ID
+        cases = [
+            ("短词 (LIKE 扫描)", lambda: search("体重", room, None, None, None, None, "relevance", 20, 0)),
+            ("常见词", lambda: search("无糖茶", room, None, None, None, None, "relevance", 20, 0)),
+            ("罕见词", lambda: search(RARE_WORD, room, None, None, None, None, "relevance", 20, 0)),
+            ("多个词", lambda: search("散步 血糖控制", room, None, None, None, None, "relevance", 20, 0)),
+            ("发送者 + 按时间", lambda: search("无糖茶", room, "user_7", None, None, None, "recent", 20, 0)),
+            ("深翻页 offset=1000", lambda: search("无糖茶", room, None, None, None, None, "relevance", 20, 1000)),
+            ("全部命中按 bm25 (对照)", lambda: raw.execute(
+                "SELECT m.* FROM messages m JOIN messages_fts f ON f.rowid = m.id WHERE messages_fts MATCH ? "
+                "ORDER BY f.rank LIMIT 20", ('"无糖茶"',)).fetchall()),
+            ("LIKE 全表扫描 (对照)", lambda: raw.execute(
+                "SELECT * FROM messages WHERE content LIKE ? ORDER BY id DESC LIMIT 20", (f"%{RARE_WORD}%",)).fetchall()),
+        ]
+        print(f"{'查询':<24}{'ms (中位数)':>12}")
+        for name, func in cases:
+            print(f"{name:<24}{time_call(func, repeat):>12.2f}")
+
+        raw.close()
+        engine.dispose()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="/api/search 全文检索延迟基准测试")
+    parser.add_argument("--rows", type=int, nargs="+", default=[1_000_000, 5_000_000], help="测试的数据行数")
+    parser.add_argument("--repeat", type=int, default=10, help="每个查询重复次数")
+    args = parser.parse_args()
+    for rows in args.rows:
+        run(rows, args.repeat)
+
+
+if __name__ == "__main__":
+    main()
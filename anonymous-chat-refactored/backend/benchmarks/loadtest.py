@@ -0,0 +1,574 @@
+# backend/benchmarks/loadtest.py
+"""
+端到端负载测试：在本进程内启动完整的 FastAPI 应用 (uvicorn，和线上相同的 WebSocket 实现) 和本地模型测试桩
+(tools/fake_llm_server.py)，依次执行以下阶段，结果写入 JSON 文件，方便对比改动前后的表现：
+
+  ws          N 个 WebSocket 客户端在同一房间内按固定速率发言 (开环：按计划时间发送，不等上一条送达)，
+              统计端到端送达延迟 (发送 -> 房间内其他客户端收到) 的分位数、送达吞吐和连接耗时
+  pagination  预先写入一段历史消息，多个并发客户端用 /api/messages 的 before_id / after_id 翻页
+  upload      并发上传随机内容的 PNG 图片 (/api/upload)
+  agents      房间内有人时 AgentScheduler 对接测试桩运行，可注入模型延迟和错误，
+              统计 Agent 发言次数、模型调用耗时分位数和失败次数
+
+所有数据写在临时目录中，不影响 backend 目录下的 chat.db 和 uploads。
+客户端和服务端在同一个事件循环里运行，结果反映的是单进程的容量上限 (包括客户端自身的开销)，
+适合对比同一台机器上改动前后的变化，而不是估算生产环境的绝对容量。
+
+用法:
+    python benchmarks/loadtest.py                                          # 默认参数，执行全部阶段
+    python benchmarks/loadtest.py --clients 500 --rate 0.5 --duration 60 --output after.json
+    python benchmarks/loadtest.py --phases agents --llm-latency 2 --llm-error-rate 0.2
+    python benchmarks/loadtest.py --compare before.json after.json         # 对比两次运行的结果
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import platform
+import random
+import socket
+import struct
+import sys
+import tempfile
+import time
+import zlib
+from datetime import datetime, timedelta, timezone
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, BACKEND_DIR)
+sys.path.insert(0, os.path.join(BACKEND_DIR, "tools"))
+
+import httpx
+import uvicorn
+from websockets.asyncio.client import connect as ws_connect
+
+PHASES = ("ws", "pagination", "upload", "agents")
+WS_ROOM = "loadtest" # 未配置的房间，没有 Agent
+HISTORY_ROOM = "loadtest-history"
+INSERT_CHUNK = 50000
+
+
+# --- 统计 ---
+def percentiles(samples: list[float]) -> dict:
+    """延迟分位数 (毫秒)"""
+    if not samples:
+        return {"count": 0}
+    ordered = sorted(samples)
+
+    def pick(p):
+        return round(ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))] * 1000, 2)
+    return {"count": len(ordered), "p50_ms": pick(50), "p90_ms": pick(90), "p99_ms": pick(99),
+            "max_ms": round(ordered[-1] * 1000, 2), "mean_ms": round(sum(ordered) / len(ordered) * 1000, 2)}
+
+
+def histogram_summary(histogram) -> dict:
+    """合并 metrics 直方图所有标签的分桶，估算分位数 (桶内线性插值，和 Prometheus 的 histogram_quantile 相同)"""
+    children = list(histogram._children.values()) if histogram.labelnames else [histogram]
+    counts = [sum(child.counts[i] for child in children) for i in range(len(histogram.buckets) + 1)]
+    total = sum(counts)
+    if not total:
+        return {"count": 0}
+
+    def quantile(q):
+        rank, cumulative, lower = q * total, 0, 0.0
+        for bound, count in zip(histogram.buckets, counts):
+            if cumulative + count >= rank and count:
+                return round((lower + (bound - lower) * (rank - cumulative) / count) * 1000, 2)
+            cumulative += count
+            lower = bound
+        return round(histogram.buckets[-1] * 1000, 2) # 落在 +Inf 桶里，只能给出下限
+    mean = sum(child.sum for child in children) / total
+    return {"count": total, "p50_ms": quantile(0.5), "p90_ms": quantile(0.9), "p99_ms": quantile(0.99),
+            "mean_ms": round(mean * 1000, 2)}
+
+
+def counter_values(counter) -> dict:
+    """按标签展开计数器的值"""
+    return {"/".join(key): child.value for key, child in counter._children.items()}
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def make_png(size: int) -> bytes:
+    """生成大约 size 字节、内容随机 (不会被去重) 的合法 PNG 图片"""
+    width = 256
+    height = max(1, size // (width * 3))
+    raw = b"".join(b"\x00" + os.urandom(width * 3) for _ in range(height)) # 随机像素几乎不可压缩
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xFFFFFFFF)
+    return (b"\x89PNG\r\n\x1a\n" + chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 2, 0, 0, 0))
+            + chunk(b"IDAT", zlib.compress(raw, 1)) + chunk(b"IEND", b""))
+
+
+# --- 被测服务 ---
+class Harness:
+    """在临时目录中启动模型测试桩和聊天应用 (同一个事件循环)"""
+    def __init__(self, args):
+        self.args = args
+        self.workdir = tempfile.TemporaryDirectory(prefix="chat-loadtest-")
+        self.port = free_port()
+        self.llm_port = free_port()
+        self.base_url = f"http://127.0.0.1:{self.port}"
+        self.ws_url = f"ws://127.0.0.1:{self.port}"
+        self._servers: list[tuple[uvicorn.Server, asyncio.Task]] = []
+
+    def load_app(self):
+        """
+        配置在导入时就会被读取 (BASE_URL 是 ModelClient 的默认参数，上传目录在导入 main 时创建)，
+        所以先设置环境变量、切换到临时目录，再导入应用。
+        """
+        args = self.args
+        os.environ["OPENROUTER_BASE_URL"] = f"http://127.0.0.1:{self.llm_port}/v1/chat/completions"
+        os.environ["AGENT_STREAMING"] = "1" if args.streaming else "0"
+        os.environ["AGENT_SPECULATIVE"] = "1" if args.speculative else "0"
+        os.environ["AGENT_DIRECTOR"] = "1" if args.director else "0"
+        os.chdir(self.workdir.name)
+
+        import config
+        import fake_llm_server
+        import main
+        import metrics
+        self.config, self.fake_llm, self.main, self.metrics = config, fake_llm_server, main, metrics
+
+        if args.durability:
+            config.MESSAGE_DURABILITY = args.durability
+        # 所有模拟客户端都来自 127.0.0.1，按 IP 限流会把它们当成一个用户
+        config.RATE_LIMIT_ENABLED = args.rate_limit
+        # Agent 阶段：缩短发言间隔和防抖时间，放开调用预算，让测试时间内有足够多的模型调用
+        for agent in config.AGENTS.values():
+            agent["talk_interval_range"] = tuple(args.agent_interval)
+        config.AGENT_REPLY_DEBOUNCE = (0.5, 1.5)
+        config.AGENT_REPLY_MAX_DELAY = 3
+        config.AGENT_DIRECTOR_SPACING = (0.5, 1.5)
+        config.AGENT_CALLS_PER_MINUTE = 1_000_000
+        config.AGENT_MAX_CONCURRENT_CALLS = args.agent_concurrency
+        config.AGENT_ERROR_BACKOFF = (1, 5)
+        fake_llm_server.settings.update({
+            "first_token_delay": args.llm_latency,
+            "token_delay": args.llm_token_delay,
+            "error_rate": args.llm_error_rate,
+            "rate_limit_rate": args.llm_rate_limit_rate,
+            "slow_rate": args.llm_slow_rate,
+            "slow_delay": args.llm_slow_delay,
+            "invalid_json_rate": args.llm_invalid_json_rate,
+        })
+
+    def seed_history(self, rows: int):
+        """直接写入 SQLite，给翻页阶段准备 rows 条历史消息 (超出最近消息缓存，翻页会查询数据库)"""
+        import sqlite3
+        from database import DATABASE_FILE, init_db
+        init_db()
+        conn = sqlite3.connect(DATABASE_FILE)
+        start = datetime(2025, 1, 1)
+        inserted = 0
+        while inserted < rows:
+            chunk = min(INSERT_CHUNK, rows - inserted)
+            conn.executemany(
+                "INSERT INTO messages (room_id, sender_id, sender_name, content, message_type, timestamp) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                [(HISTORY_ROOM, f"user_{i % 200}", f"用户{i % 200}", f"历史消息 {i}", "TEXT",
+                  (start + timedelta(seconds=i)).strftime("%Y-%m-%d %H:%M:%S"))
+                 for i in range(inserted, inserted + chunk)])
+            conn.commit()
+            inserted += chunk
+        conn.close()
+
+    async def _serve(self, app, port: int, **options):
+        server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning", **options))
+        task = asyncio.create_task(server.serve())
+        while not server.started:
+            if task.done():
+                task.result() # 启动失败，抛出原因
+            await asyncio.sleep(0.05)
+        self._servers.append((server, task))
+
+    async def start(self):
+        from wire_codec import DEFLATE_PROTOCOL
+        config = self.config
+        await self._serve(self.fake_llm.app, self.llm_port)
+        await self._serve(self.main.app, self.port, ws=DEFLATE_PROTOCOL,
+                          ws_per_message_deflate=config.WS_PER_MESSAGE_DEFLATE and not self.args.no_deflate,
+                          ws_max_size=config.WS_MAX_SIZE)
+
+    async def stop(self):
+        for server, task in reversed(self._servers):
+            server.should_exit = True
+            await task
+        os.chdir(BACKEND_DIR)
+        self.workdir.cleanup()
+
+
+# --- 阶段 1: WebSocket 发言和广播 ---
+class WSStats:
+    def __init__(self):
+        self.sent = 0
+        self.delivered = 0
+        self.latencies: list[float] = []
+        self.connect_times: list[float] = []
+        self.errors = 0
+
+
+async def ws_client(harness: Harness, index: int, args, stats: WSStats, go: asyncio.Event, stop_at: list[float]):
+    """一个模拟用户：连接、等待所有人到齐、按 rate 条/秒发言，同时接收房间内的广播"""
+    codec = harness.main.get_codec(args.codec)
+    record_latency = index < args.latency_receivers # 只在部分客户端上记录延迟样本，送达数全部统计
+    url = f"{harness.ws_url}/ws/lt{index}/loadtest{index}?room_id={WS_ROOM}&codec={args.codec}&presence=delta"
+    t0 = time.perf_counter()
+    try:
+        async with ws_connect(url, max_size=None, compression=None if args.no_deflate else "deflate",
+                              open_timeout=60) as ws:
+            stats.connect_times.append(time.perf_counter() - t0)
+
+            async def receive():
+                async for frame in ws:
+                    message = codec.decode(frame)
+                    if message.get("type") != "message":
+                        continue
+                    content = message.get("content", "")
+                    if not content.startswith("lt "):
+                        continue
+                    stats.delivered += 1
+                    if record_latency:
+                        stats.latencies.append(time.perf_counter() - float(content.rsplit(" ", 1)[1]))
+
+            receiver = asyncio.create_task(receive())
+            await go.wait()
+            interval = 1 / args.rate
+            next_send = time.perf_counter() + random.uniform(0, interval) # 错开各客户端的发送时间
+            seq = 0
+            while next_send < stop_at[0]:
+                await asyncio.sleep(max(0.0, next_send - time.perf_counter()))
+                await ws.send(codec.encode({"type": "message", "content": f"lt {index} {seq} {time.perf_counter():.6f}"}))
+                stats.sent += 1
+                seq += 1
+                next_send += interval # 开环：按计划时间发送，服务端变慢时不会跟着放慢 (避免协调遗漏)
+            await asyncio.sleep(args.drain) # 等待在途的消息送达
+            receiver.cancel()
+    except Exception as e:
+        stats.errors += 1
+        logging.getLogger(__name__).warning(f"客户端 {index} 出错: {e!r}")
+
+
+async def run_ws_phase(harness: Harness, args) -> dict:
+    metrics = harness.metrics
+    stats = WSStats()
+    go = asyncio.Event()
+    stop_at = [0.0]
+    tasks = []
+    t0 = time.perf_counter()
+    for index in range(args.clients):
+        tasks.append(asyncio.create_task(ws_client(harness, index, args, stats, go, stop_at)))
+        if index % args.connect_batch == args.connect_batch - 1:
+            await asyncio.sleep(0.05) # 分批建立连接，避免超出监听队列
+    while len(stats.connect_times) + stats.errors < args.clients:
+        await asyncio.sleep(0.05)
+    connect_seconds = time.perf_counter() - t0
+    await asyncio.sleep(1) # 等在线用户变化合并广播完
+    fanout_before = metrics.BROADCAST_FANOUT.count
+    started = time.perf_counter()
+    stop_at[0] = started + args.duration
+    go.set()
+    await asyncio.gather(*tasks)
+    elapsed = args.duration
+
+    expected = stats.sent * len(stats.connect_times) # 每条消息应送达房间内的所有客户端 (包括发送者)
+    return {
+        "clients": args.clients,
+        "connected": len(stats.connect_times),
+        "client_errors": stats.errors,
+        "connect_all_seconds": round(connect_seconds, 2),
+        "connect_latency": percentiles(stats.connect_times),
+        "sent": stats.sent,
+        "sent_per_second": round(stats.sent / elapsed, 1),
+        "delivered": stats.delivered,
+        "delivered_per_second": round(stats.delivered / elapsed, 1),
+        "delivery_ratio": round(stats.delivered / expected, 4) if expected else None,
+        "delivery_latency": percentiles(stats.latencies),
+        "server": {
+            "broadcasts": metrics.BROADCAST_FANOUT.count - fanout_before,
+            "broadcast_enqueue": histogram_summary(metrics.BROADCAST_SECONDS),
+            "send_delay": histogram_summary(metrics.WS_SEND_DELAY),
+            "db_commit": histogram_summary(metrics.DB_COMMIT_SECONDS),
+            "dropped_frames": metrics.WS_DROPPED_FRAMES.value,
+            "coalesced_frames": metrics.WS_COALESCED_FRAMES.value,
+            "send_failures": counter_values(metrics.WS_SEND_FAILURES),
+        },
+    }
+
+
+# --- 阶段 2: 历史消息翻页 ---
+async def run_pagination_phase(harness: Harness, args) -> dict:
+    latencies: dict[str, list[float]] = {"latest": [], "before_id": [], "after_id": []}
+    errors = 0
+
+    async def timed_get(client: httpx.AsyncClient, kind: str, params: dict) -> list:
+        nonlocal errors
+        t0 = time.perf_counter()
+        response = await client.get("/api/messages", params={"room_id": HISTORY_ROOM, "limit": args.page_size, **params})
+        latencies[kind].append(time.perf_counter() - t0)
+        if response.status_code != 200:
+            errors += 1
+            return []
+        return response.json()
+
+    async def walker(offset: int):
+        """从最新一页往前翻 pages 页，再从其中一个位置往后翻 pages 页"""
+        async with httpx.AsyncClient(base_url=harness.base_url, timeout=60) as client:
+            page = await timed_get(client, "latest", {})
+            for _ in range(offset): # 各个客户端从不同的位置开始
+                if not page:
+                    break
+                page = await timed_get(client, "before_id", {"before_id": page[0]["id"]})
+            for _ in range(args.pages):
+                if not page:
+                    break
+                page = await timed_get(client, "before_id", {"before_id": page[0]["id"]})
+            after_id = max(0, args.history_rows // 2 - offset * args.page_size)
+            for _ in range(args.pages):
+                page = await timed_get(client, "after_id", {"after_id": after_id})
+                if not page:
+                    break
+                after_id = page[-1]["id"]
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(walker(i) for i in range(args.http_concurrency)))
+    elapsed = time.perf_counter() - t0
+    requests = sum(len(samples) for samples in latencies.values())
+    return {
+        "history_rows": args.history_rows,
+        "concurrency": args.http_concurrency,
+        "requests": requests,
+        "errors": errors,
+        "requests_per_second": round(requests / elapsed, 1),
+        **{kind: percentiles(samples) for kind, samples in latencies.items()},
+    }
+
+
+# --- 阶段 3: 图片上传 ---
+async def run_upload_phase(harness: Harness, args) -> dict:
+    latencies: list[float] = []
+    statuses: dict[str, int] = {}
+    images = [make_png(args.upload_kb * 1024) for _ in range(min(args.uploads, 20))]
+    queue: asyncio.Queue = asyncio.Queue()
+    for index in range(args.uploads):
+        queue.put_nowait(index)
+
+    async def uploader():
+        async with httpx.AsyncClient(base_url=harness.base_url, timeout=60) as client:
+            while not queue.empty():
+                index = queue.get_nowait()
+                # 前 20 张是不同的图片，之后重复上传，同时覆盖新文件和去重两种路径
+                image = images[index % len(images)]
+                t0 = time.perf_counter()
+                response = await client.post("/api/upload", data={"user_id": f"lt{index}"},
+                                             files={"file": (f"{index}.png", image, "image/png")})
+                latencies.append(time.perf_counter() - t0)
+                key = str(response.status_code)
+                statuses[key] = statuses.get(key, 0) + 1
+
+    t0 = time.perf_counter()
+    await asyncio.gather(*(uploader() for _ in range(args.http_concurrency)))
+    elapsed = time.perf_counter() - t0
+    total_bytes = sum(len(images[i % len(images)]) for i in range(args.uploads))
+    return {
+        "uploads": args.uploads,
+        "image_bytes": len(images[0]),
+        "concurrency": args.http_concurrency,
+        "statuses": statuses,
+        "uploads_per_second": round(args.uploads / elapsed, 1),
+        "mb_per_second": round(total_bytes / elapsed / 2**20, 2),
+        "latency": percentiles(latencies),
+    }
+
+
+# --- 阶段 4: Agent 对接模型测试桩 ---
+async def run_agents_phase(harness: Harness, args) -> dict:
+    config, metrics = harness.config, harness.metrics
+    room_id = next((room for room, room_config in config.ROOMS.items() if room_config.get("agents")), None)
+    if room_id is None:
+        return {"skipped": "没有配置了 Agent 的房间"}
+    codec = harness.main.get_codec("json")
+    agent_messages = 0
+    human_sent = 0
+    stop_at = time.perf_counter() + args.agent_duration
+
+    async def human(index: int):
+        """在有 Agent 的房间里偶尔发言的用户 (触发防抖回复)，第一个用户同时统计 Agent 的发言"""
+        nonlocal agent_messages, human_sent
+        url = f"{harness.ws_url}/ws/human{index}/用户{index}?room_id={room_id}"
+        async with ws_connect(url, max_size=None) as ws:
+            async def receive():
+                nonlocal agent_messages
+                async for frame in ws:
+                    message = codec.decode(frame)
+                    if index == 0 and message.get("type") == "message" and message["sender"]["id"] in config.AGENTS:
+                        agent_messages += 1
+
+            receiver = asyncio.create_task(receive())
+            while time.perf_counter() < stop_at:
+                await asyncio.sleep(random.uniform(*args.human_interval))
+                await ws.send(codec.encode({"type": "message", "content": "大家晚饭都吃了什么？"}))
+                human_sent += 1
+            await asyncio.sleep(args.drain)
+            receiver.cancel()
+
+    harness.fake_llm.request_counts.clear()
+    await asyncio.gather(*(human(i) for i in range(args.agent_clients)))
+    return {
+        "room": room_id,
+        "agents": len(harness.main.agent_scheduler.get_room_agents(room_id)),
+        "duration_seconds": args.agent_duration,
+        "human_messages": human_sent,
+        "agent_messages": agent_messages,
+        "agent_messages_per_minute": round(agent_messages / args.agent_duration * 60, 1),
+        "agent_speak": counter_values(metrics.AGENT_SPEAK_TOTAL),
+        "speculative": {outcome: sum(value for key, value in counter_values(metrics.AGENT_SPECULATIVE).items()
+                                     if key.endswith(f"/{outcome}"))
+                        for outcome in ("used", "stale", "cancelled", "failed", "skipped")},
+        "director": {
+            "replies": counter_values(metrics.AGENT_DIRECTOR_REPLIES),
+            "saved_calls": metrics.AGENT_DIRECTOR_SAVED_CALLS.value,
+            "saved_prompt_tokens": metrics.AGENT_DIRECTOR_SAVED_TOKENS.value,
+            "saved_calls_per_hour": round(metrics.AGENT_DIRECTOR_SAVED_CALLS.value / args.agent_duration * 3600),
+            "saved_prompt_tokens_per_hour": round(metrics.AGENT_DIRECTOR_SAVED_TOKENS.value / args.agent_duration * 3600),
+        },
+        "model_tokens": counter_values(metrics.MODEL_TOKENS),
+        "agent_speak_latency": {
+            stage: histogram_summary(_stage_histogram(metrics, stage))
+            for stage in ("history", "prompt", "model", "persist", "broadcast")
+        },
+        "model_call": histogram_summary(metrics.MODEL_CALL_SECONDS),
+        "model_errors": sum(counter_values(metrics.MODEL_ERRORS).values()),
+        "model_client": harness.main.agent_manager.model_client.get_stats(),
+        "upstream_requests": dict(harness.fake_llm.request_counts),
+    }
+
+
+def _stage_histogram(metrics, stage: str):
+    """只保留 stage 标签等于指定阶段的子指标 (各 Agent 合并)"""
+    merged = metrics.Histogram("stage", "", ["agent"], metrics.AGENT_STAGE_SECONDS.buckets)
+    merged._children = {key: child for key, child in metrics.AGENT_STAGE_SECONDS._children.items() if key[1] == stage}
+    return merged
+
+
+# --- 结果对比 ---
+def flatten(data, prefix: str = "") -> dict:
+    flat = {}
+    for key, value in data.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(value, dict):
+            flat.update(flatten(value, name))
+        elif isinstance(value, (int, float)) and not isinstance(value, bool):
+            flat[name] = value
+    return flat
+
+
+def compare(before_path: str, after_path: str):
+    with open(before_path, encoding="utf-8") as f:
+        before = flatten(json.load(f)["results"])
+    with open(after_path, encoding="utf-8") as f:
+        after = flatten(json.load(f)["results"])
+    print(f"{'指标':<56}{'之前':>14}{'之后':>14}{'变化':>10}")
+    for name in sorted(set(before) | set(after)):
+        old, new = before.get(name), after.get(name)
+        change = f"{(new - old) / old * 100:+.1f}%" if old and new is not None else ""
+        print(f"{name:<56}{'' if old is None else old:>14}{'' if new is None else new:>14}{change:>10}")
+
+
+# --- 入口 ---
+async def run(args) -> dict:
+    harness = Harness(args)
+    harness.load_app()
+    if "pagination" in args.phases:
+        harness.seed_history(args.history_rows)
+    await harness.start()
+    results = {}
+    try:
+        for phase in PHASES:
+            if phase not in args.phases:
+                continue
+            print(f"== {phase} ==", flush=True)
+            t0 = time.perf_counter()
+            runner = {"ws": run_ws_phase, "pagination": run_pagination_phase,
+                      "upload": run_upload_phase, "agents": run_agents_phase}[phase]
+            results[phase] = await runner(harness, args)
+            print(json.dumps(results[phase], ensure_ascii=False, indent=2))
+            print(f"({time.perf_counter() - t0:.1f}s)", flush=True)
+    finally:
+        await harness.stop()
+    return {
+        "timestamp": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "durability": harness.config.MESSAGE_DURABILITY,
+            "deflate": harness.config.WS_PER_MESSAGE_DEFLATE and not args.no_deflate,
+            "rate_limit": harness.config.RATE_LIMIT_ENABLED,
+        },
+        "params": {key: value for key, value in vars(args).items() if key not in ("compare", "output")},
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="聊天后端端到端负载测试")
+    parser.add_argument("--phases", nargs="+", choices=PHASES, default=list(PHASES), help="要执行的阶段")
+    parser.add_argument("--output", default="loadtest-results.json", help="结果 JSON 文件")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="对比两次运行的结果文件，不执行测试")
+    # ws
+    parser.add_argument("--clients", type=int, default=50, help="WebSocket 客户端数")
+    parser.add_argument("--rate", type=float, default=1.0, help="每个客户端每秒发送的消息数")
+    parser.add_argument("--duration", type=float, default=20, help="发送持续时间 (秒)")
+    parser.add_argument("--drain", type=float, default=2, help="停止发送后等待在途消息送达的时间 (秒)")
+    parser.add_argument("--codec", default="json", help="帧编码 (json / msgpack)")
+    parser.add_argument("--no-deflate", action="store_true", help="关闭 permessage-deflate 压缩")
+    parser.add_argument("--rate-limit", action="store_true", help="保留上行限流 (默认关闭，否则同一 IP 的模拟客户端会被限流)")
+    parser.add_argument("--durability", choices=("write_behind", "group_commit", "sync"), help="消息写入模式")
+    parser.add_argument("--latency-receivers", type=int, default=20, help="记录送达延迟样本的客户端数")
+    parser.add_argument("--connect-batch", type=int, default=50, help="每批同时建立的连接数")
+    # pagination / upload
+    parser.add_argument("--history-rows", type=int, default=100_000, help="翻页阶段预先写入的历史消息数")
+    parser.add_argument("--pages", type=int, default=20, help="每个客户端向前和向后各翻多少页")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--http-concurrency", type=int, default=10, help="翻页和上传的并发客户端数")
+    parser.add_argument("--uploads", type=int, default=100, help="上传的图片数")
+    parser.add_argument("--upload-kb", type=int, default=200, help="每张图片的大小 (KB)")
+    # agents
+    parser.add_argument("--agent-duration", type=float, default=30, help="Agent 阶段的持续时间 (秒)")
+    parser.add_argument("--agent-clients", type=int, default=5, help="Agent 房间里的用户数")
+    parser.add_argument("--agent-interval", type=float, nargs=2, default=[2, 5], help="Agent 主动发言的间隔范围 (秒)")
+    parser.add_argument("--agent-concurrency", type=int, default=2, help="同时进行的模型调用上限")
+    parser.add_argument("--human-interval", type=float, nargs=2, default=[3, 8], help="用户发言的间隔范围 (秒)")
+    parser.add_argument("--streaming", action="store_true", help="Agent 使用流式调用")
+    parser.add_argument("--speculative", action="store_true", help="开启 Agent 回复的提前生成")
+    parser.add_argument("--director", action="store_true", help="开启导演模式 (一次调用为多个 Agent 写发言)")
+    parser.add_argument("--llm-latency", type=float, default=0.3, help="测试桩首个 token 前的延迟 (秒)")
+    parser.add_argument("--llm-token-delay", type=float, default=0.02, help="测试桩每个 token 的延迟 (秒)")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="测试桩返回 500 的概率")
+    parser.add_argument("--llm-rate-limit-rate", type=float, default=0.0, help="测试桩返回 429 的概率")
+    parser.add_argument("--llm-slow-rate", type=float, default=0.0, help="测试桩额外延迟的概率")
+    parser.add_argument("--llm-slow-delay", type=float, default=5.0, help="额外延迟的时长 (秒)")
+    parser.add_argument("--llm-invalid-json-rate", type=float, default=0.0, help="导演模式下测试桩返回非 JSON 内容的概率")
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+
+    output = os.path.abspath(args.output) # 运行期间会切换到临时目录
+    logging.basicConfig(level=logging.WARNING) # 应用每条连接和发言都有日志，压测时只保留警告和错误
+    report = asyncio.run(run(args))
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {output}")
+
+
+if __name__ == "__main__":
+    main()
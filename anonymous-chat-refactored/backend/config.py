@@ -4,7 +4,57 @@ import os
 # 警告：直接在代码中写入 API Key 是不安全的。建议使用环境变量。
 # API_KEY = os.getenv("OPENROUTER_API_KEY", "YOUR_OPENROUTER_API_KEY")
 API_KEY = "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" # 请替换为你自己的 Key
-BASE_URL = "https://openrouter.ai/api/v1/chat/completions"
+# 可通过环境变量指向兼容 OpenRouter 的其他服务，例如本地测试桩 tools/fake_llm_server.py
+BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1/chat/completions")
+
+# --- 模型客户端配置 ---
+MODEL_TIMEOUT = 60.0 # 读取响应的超时 (秒)
+MODEL_CONNECT_TIMEOUT = 5.0 # 建立连接的超时 (秒)
+MODEL_MAX_CONNECTIONS = 20 # 连接池上限
+MODEL_MAX_KEEPALIVE = 10 # 保持的空闲连接数，复用连接省去 TCP/TLS 握手
+MODEL_KEEPALIVE_EXPIRY = 30.0 # 空闲连接保留时间 (秒)
+MODEL_HTTP2 = True # 安装了 h2 (pip install httpx[http2]) 时使用 HTTP/2，多个请求复用一条连接
+MODEL_MAX_RETRIES = 2 # 网络错误、429 和 5xx 的最大重试次数
+MODEL_RETRY_BACKOFF_BASE = 0.5 # 指数退避的基数 (秒)
+MODEL_RETRY_BACKOFF_MAX = 8.0 # 单次退避的上限 (秒)
+MODEL_RETRY_AFTER_MAX = 30.0 # 最多遵守多长的 Retry-After (秒)
+MODEL_BREAKER_FAILURES = 5 # 连续失败多少次后打开断路器
+MODEL_BREAKER_RESET_TIMEOUT = 30.0 # 断路器打开后多久放行探测请求 (秒)
+# 主模型 -> 备用模型：主模型断路器打开时改用备用模型；非流式请求超过主模型的延迟分位数时
+# 同时向备用模型发出对冲请求，取先返回的结果
+MODEL_FALLBACKS: dict[str, str] = {
+    # "deepseek/deepseek-chat-v3-0324": "google/gemini-2.0-flash-001",
+}
+MODEL_HEDGE_PERCENTILE = 95
+MODEL_HEDGE_MIN_SAMPLES = 20 # 样本数不足时不对冲
+MODEL_HEDGE_MIN_DELAY = 1.0 # 对冲等待时间的下限 (秒)
+# 每个模型的价格 (美元 / 百万 token)：(输入, 输出)。接口响应带 usage.cost 时以响应为准，
+# 都没有时 chat_model_cost_usd_total 不计费用
+MODEL_PRICES: dict[str, tuple[float, float]] = {
+    # "deepseek/deepseek-chat-v3-0324": (0.27, 1.10),
+}
+
+# --- 提示词组装配置 ---
+AGENT_REPLY_MAX_TOKENS = 200 # 限制回复长度 (同时从上下文预算中预留)
+# 每个模型的上下文 token 预算 (系统提示 + 摘要 + 聊天记录 + 回复)，用本地估算的 token 数计算
+PROMPT_TOKEN_BUDGETS: dict[str, int] = {
+    "deepseek/deepseek-chat-v3-0324": 4000,
+    "openai/gpt-4o-2024-11-20": 4000,
+    "google/gemini-2.0-flash-001": 6000,
+}
+PROMPT_DEFAULT_TOKEN_BUDGET = 3000
+PROMPT_MAX_MESSAGE_TOKENS = 300 # 单条聊天记录最多占用的 token，超出部分截断
+# 滚动摘要：设置为一个便宜的模型后，上下文窗口之前的聊天内容会在后台被总结成摘要放进提示词
+PROMPT_SUMMARY_MODEL: str | None = None # 例如 "google/gemini-2.0-flash-001"
+PROMPT_SUMMARY_MIN_INTERVAL = 120 # 同一房间两次刷新摘要的最小间隔 (秒)
+PROMPT_SUMMARY_MAX_MESSAGES = 100 # 每次刷新最多总结多少条消息
+PROMPT_SUMMARY_MAX_TOKENS = 300
+
+# --- 流式回复配置 ---
+# 为 True 时以 SSE 流式请求模型，生成过程中向房间广播增量的 message_delta 帧，
+# 完整回复生成后再持久化并广播一次最终消息 (带相同的 streamId，前端据此替换草稿)
+AGENT_STREAMING = os.getenv("AGENT_STREAMING", "0") == "1"
+STREAM_TICK_MS = 100 # 增量帧的合并间隔 (毫秒)，同一间隔内收到的 token 合并为一帧
 
 # --- AI Agent 配置 ---
 # 结构类似你的参考代码，但 agent_id 用作 key
@@ -38,6 +88,166 @@ AGENTS = {
     }
 }
 
+# --- 聊天室配置 ---
+DEFAULT_ROOM_ID = "lobby" # 默认聊天室 (不指定房间时进入)
+# 每个房间分配各自的 Agent；Agent 只在房间有人在线时发言
+ROOMS = {
+    DEFAULT_ROOM_ID: {
+        "name": "健康生活与减肥",
+        "agents": list(AGENTS.keys()),
+    },
+}
+ALLOW_UNLISTED_ROOMS = True # 是否允许进入未配置的房间 (没有 Agent)
+# Agent 定义也可以放在 JSON 文件里 (格式见 agent_config.py)，文件存在时覆盖上面的 AGENTS 和 ROOMS，
+# 运行中修改文件会在 AGENTS_RELOAD_INTERVAL 秒内生效，只重启定义有变化的 Agent 的发言循环
+AGENTS_FILE = os.getenv("CHAT_AGENTS_FILE", "agents.json")
+AGENTS_RELOAD_INTERVAL = 2.0 # 检查文件修改时间的间隔 (秒)
+
+# --- Agent 调度配置 ---
+# 房间有人在线时每个 Agent 按 talk_interval_range 随机间隔主动发言；房间没人时全部暂停。
+# 有人发言后，等聊天安静 AGENT_REPLY_DEBOUNCE 秒 (范围内随机，有新消息则重新计时) 再挑一个 Agent 回复，
+# 持续有人发言时最迟 AGENT_REPLY_MAX_DELAY 秒后回复。
+AGENT_REPLY_ENABLED = True
+AGENT_REPLY_DEBOUNCE = (3, 8)
+AGENT_REPLY_MAX_DELAY = 20
+AGENT_MAX_CONCURRENT_CALLS = 2 # 所有 Agent 同时进行的模型调用上限
+AGENT_CALLS_PER_MINUTE = 20 # 所有 Agent 每分钟的模型调用预算 (包括聊天摘要)，用完后跳过本次发言
+AGENT_ERROR_BACKOFF = (10, 600) # 发言连续失败时的额外等待 (秒)：从下限开始按指数增长，不超过上限
+# 提前生成：主动发言的时间到达之前 (按该模型最近的延迟分位数估计) 在后台生成回复，时间到了直接发出，
+# 模型延迟不再出现在聊天时间线上。生成后房间里又出现超过 AGENT_SPECULATIVE_MAX_NEW_MESSAGES 条消息时
+# 回复已经跟不上话题，丢弃后重新生成。被丢弃或取消的调用仍然计费，超过每小时上限后暂停提前生成。
+AGENT_SPECULATIVE = os.getenv("AGENT_SPECULATIVE", "0") == "1" # 默认关闭：话题变化时提前生成的回复会被丢弃，多出计费调用
+AGENT_SPECULATIVE_LEAD = 10.0 # 模型延迟样本不足时提前多久开始生成 (秒)
+AGENT_SPECULATIVE_LEAD_PERCENTILE = 90 # 按该模型最近调用耗时的哪个分位数提前
+AGENT_SPECULATIVE_MAX_NEW_MESSAGES = 2
+AGENT_SPECULATIVE_MAX_WASTED_PER_HOUR = 30 # 最近一小时内浪费的提前生成调用达到该数时暂停提前生成
+# 导演模式：房间有多个 Agent 时不再各自调用模型，而是一次调用同时为其中几个 Agent 写发言
+# (聊天记录只发送一次)，按顺序间隔 AGENT_DIRECTOR_SPACING 秒依次发出。返回的 JSON 逐个 Agent 校验，
+# 无效或缺失的 Agent 回退到单独调用。节省的调用数和 token 数见 /metrics 的 chat_agent_director_* 指标。
+AGENT_DIRECTOR = os.getenv("AGENT_DIRECTOR", "0") == "1"
+AGENT_DIRECTOR_MODEL: str | None = None # 导演调用使用的模型，None 时使用本轮第一个 Agent 的模型
+AGENT_DIRECTOR_MAX_AGENTS = 3 # 每轮最多为几个 Agent 写发言
+AGENT_DIRECTOR_MAX_TOKENS = 600 # 导演调用的 max_tokens (多条发言加上 JSON 结构)
+AGENT_DIRECTOR_SPACING = (5, 20) # 同一轮中相邻两条发言的间隔 (秒)
+
+# --- 数据库访问配置 ---
+# 为 True 时所有数据库操作在专用的数据库线程中执行，不阻塞事件循环；
+# 设为 False 可切回旧的同步调用路径 (仅用于性能对比)
+DB_EXECUTOR_ENABLED = True
+DB_EXECUTOR_MAX_PENDING = 1000 # 排队中的数据库操作上限，超过时调用方等待 (背压)
+SQLITE_JOURNAL_MODE = "WAL" # WAL 模式下读写互不阻塞，提交只需追加日志
+SQLITE_SYNCHRONOUS = "NORMAL" # WAL + NORMAL：只在 checkpoint 时 fsync
+
+# --- 全文检索配置 ---
+# 关闭后不创建索引和触发器，写入没有额外开销；已有的索引需要手动删除 (DROP TABLE messages_fts 及其触发器)
+SEARCH_ENABLED = os.getenv("CHAT_SEARCH_ENABLED", "1") == "1"
+SEARCH_MAX_QUERY_LENGTH = 100
+SEARCH_MAX_OFFSET = 1000 # 结果翻页的最大深度，更深的结果应缩小检索条件
+SEARCH_RANK_CANDIDATES = 2000 # 按相关度排序时只对最近的这么多条命中计算 bm25 (常见词的延迟有上限)
+SEARCH_LIKE_SCAN_LIMIT = 200_000 # 只有少于 3 个字的检索词时，最多扫描最近的多少条消息
+
+# --- 消息保留与归档配置 ---
+# 超过保留期的消息按月移动到 ARCHIVE_DIR 下的独立 SQLite 文件，/api/messages 翻页时仍然可以读到；0 表示不归档
+MESSAGE_RETENTION_DAYS = int(os.getenv("CHAT_RETENTION_DAYS", "90"))
+ARCHIVE_DIR = "archive"
+ARCHIVE_INTERVAL = 3600 # 归档任务的运行间隔 (秒)
+ARCHIVE_BATCH_SIZE = 1000 # 每批移动的消息数，一批在一个短事务中完成
+ARCHIVE_BATCH_PAUSE = 0.2 # 批次之间的暂停 (秒)，让正常的消息写入拿到写锁
+VACUUM_PAGES_PER_STEP = 2000 # 每次 incremental_vacuum 归还的页数 (4KB/页)
+
+# --- 批量导出配置 (/api/export 与 tools/export_messages.py) ---
+EXPORT_BATCH_SIZE = 5000 # 每批读取的行数，也是每个 gzip member / zstd frame 包含的行数
+EXPORT_GZIP_LEVEL = 6
+EXPORT_ZSTD_LEVEL = 3
+
+# --- 消息写入管道配置 ---
+# 持久化模式：
+#   "write_behind": 进程内分配 id 和时间戳，立即广播，后台批量写入 (崩溃时可能丢失最后一个批次)
+#   "group_commit": 批量提交，但在提交完成后才广播 (持久化后再广播，id 由数据库分配)
+#   "sync": 每条消息单独提交 (旧行为)
+MESSAGE_DURABILITY = "write_behind"
+MESSAGE_BATCH_SIZE = 200 # 积累到多少条立即写入
+MESSAGE_FLUSH_INTERVAL = 0.05 # 最长多久写入一次 (秒)
+MESSAGE_MAX_PENDING = 10000 # 未写入消息的上限，超过时发送方等待写入完成 (背压)
+
+# --- 最近消息缓存配置 ---
+RECENT_MESSAGE_CACHE_SIZE = 500 # 每个房间在内存中保留的最近消息条数
+REPLAY_MAX_MESSAGES = 200 # 重连时最多补发多少条错过的消息，超出部分由客户端通过 after_id 分页获取
+
+# --- WebSocket 发送队列配置 ---
+SEND_QUEUE_MAX_SIZE = 256 # 每个连接最多排队的待发送帧数
+# 慢客户端处理策略 (队列满时)：
+#   "drop_oldest": 丢弃最旧的待发送帧
+#   "coalesce": 可合并的帧 (如用户列表) 只保留最新一份，队列满时再丢弃最旧的帧
+#   "disconnect": 直接断开该连接
+SLOW_CONSUMER_POLICY = "coalesce"
+SLOW_CONSUMER_MAX_DROPS = 1000 # SLOW_CONSUMER_DROP_WINDOW 秒内因队列已满丢弃的帧数达到该值后断开连接 (0 表示不限)
+SLOW_CONSUMER_DROP_WINDOW = 60.0 # 统计丢帧的滑动窗口 (秒)；偶尔落后的长连接不会因为累计丢帧被断开
+SEND_TIMEOUT = 10.0 # 单帧发送超时 (秒)，超时视为连接已失效
+# permessage-deflate 压缩：中文聊天消息能压缩到原来的一半左右，但压缩是每个连接单独做的，
+# 大房间里每条广播都要压缩 N 次；CPU 是瓶颈时可以关闭 (客户端改用 msgpack 也能减小体积)
+WS_PER_MESSAGE_DEFLATE = os.getenv("WS_PER_MESSAGE_DEFLATE", "1") == "1"
+WS_DEFLATE_LEVEL = 6 # zlib 压缩级别 (1 最快，9 压缩率最高)
+WS_DEFLATE_MEM_LEVEL = 5 # zlib 内存级别 (1-9)
+WS_DEFLATE_MAX_WINDOW_BITS = 12 # 服务端压缩窗口 2^12 = 4KB (默认 32KB)，聊天消息很短，小窗口省内存
+WS_MAX_SIZE = 1024 * 1024 # 客户端单帧的最大字节数
+# 广播批量：客户端用 ?batch=true 声明能处理数组帧后，同一房间一个 tick 内的广播合并成一帧 (事件数组) 发出，
+# 被取代的事件 (旧的在线用户列表、已被最终消息替换的流式增量) 不再发送；房间安静时第一条事件立即发出不等 tick。
+# 0 表示关闭；消息频率很高的大房间建议 20-50 毫秒
+BROADCAST_BATCH_MS = int(os.getenv("CHAT_BROADCAST_BATCH_MS", "0"))
+BROADCAST_BATCH_MAX_EVENTS = 64 # 批次达到该事件数时立即发出
+# 在线用户同步：变化在合并窗口内累积，窗口结束时每个连接只收到一帧 (增量或完整列表)
+PRESENCE_COALESCE_MS = 200 # 合并窗口 (毫秒)，加入风暴时 N 个人进来只广播一次而不是 N 次
+# 连接心跳：失效连接由定期清理统一移除，不在广播路径上逐个处理
+WS_REAP_INTERVAL = 5 # 清理失效连接的间隔 (秒)
+WS_HEARTBEAT_INTERVAL = 20 # 向声明支持心跳 (?heartbeat=true) 的客户端发送 ping 的间隔 (秒)
+WS_IDLE_TIMEOUT = 60 # 支持心跳的客户端超过该时间没有发来任何帧 (包括 pong) 视为已断开 (秒)
+
+# --- 上行限流配置 ---
+# 每个用户和每个 IP 一个令牌桶 (每秒补充 RATE 个，最多积攒 BURST 个)，每收到一帧消耗一个令牌，
+# 超限的帧在解码之前直接丢弃，不写库也不广播
+RATE_LIMIT_ENABLED = os.getenv("CHAT_RATE_LIMIT", "1") == "1"
+RATE_LIMIT_USER_RATE = 2.0
+RATE_LIMIT_USER_BURST = 10
+RATE_LIMIT_IP_RATE = 10.0 # 同一 IP 后面可能有多个用户 (NAT)，限制放宽一些
+RATE_LIMIT_IP_BURST = 40
+RATE_LIMIT_MAX_BUCKETS = 100_000 # 每种令牌桶最多保留的 key 数，超过时淘汰最久没有活动的
+# 超限后的处理：
+#   "drop": 只丢弃超限的帧
+#   "penalty": 连续超限 RATE_LIMIT_STRIKES 次后封禁 RATE_LIMIT_PENALTY_SECONDS 秒
+#   "disconnect": 连续超限 RATE_LIMIT_STRIKES 次后断开连接 (1008)
+RATE_LIMIT_POLICY = "penalty"
+RATE_LIMIT_STRIKES = 20
+RATE_LIMIT_PENALTY_SECONDS = 30
+RATE_LIMIT_TRUST_FORWARDED = False # 部署在反向代理后面时设为 True，按 X-Forwarded-For 的第一个地址限流
+WS_MAX_FRAME_SIZE = 16 * 1024 # 单帧的最大长度 (文本帧按字符、二进制帧按字节)，超过时丢弃该帧但不断开连接
+WS_CONTROL_FRAME_MAX_SIZE = 128 # 不超过该长度的帧先解码判断是否是控制帧 (pong)，控制帧不计入发送频率
+MESSAGE_MAX_LENGTH = 2000 # 消息内容的最大字符数
+
+# --- 图片上传配置 ---
+UPLOAD_DIR = "uploads"
+UPLOAD_MAX_SIZE = 10 * 1024 * 1024 # 单个文件最大字节数，超过时在接收过程中立即拒绝
+UPLOAD_THUMBNAIL_SIZES = [256] # 生成的缩略图尺寸 (最长边像素)，需要安装 Pillow，未安装时不生成
+UPLOAD_THUMBNAIL_WORKERS = 2 # 生成缩略图的进程数 (图片解码是 CPU 密集型，不能放在事件循环里)
+UPLOAD_MAX_IMAGE_PIXELS = 40_000_000 # 超过该像素数的图片不生成缩略图 (防止解压炸弹)
+UPLOAD_CACHE_MAX_AGE = 365 * 24 * 3600 # /uploads 的缓存时间 (秒)，文件名由内容决定，可以永久缓存
+
+# --- 多 worker 部署配置 ---
+# 广播总线类型：
+#   "inprocess": 单进程部署 (默认)
+#   "sqlite": 同一台机器上的多个 worker 通过共享的 SQLite 文件互相转发广播和在线用户，
+#             例如 gunicorn main:app --workers 4 --worker-class uvicorn.workers.UvicornWorker
+BACKPLANE = os.getenv("CHAT_BACKPLANE", "inprocess")
+BACKPLANE_DB_FILE = "backplane.db"
+BACKPLANE_POLL_INTERVAL = 0.05 # 轮询其他 worker 事件的间隔 (秒)
+BACKPLANE_RETENTION = 60 # 事件保留时间 (秒)
+BACKPLANE_PRESENCE_INTERVAL = 10 # 各 worker 广播自己在线用户的间隔 (秒)，超过 3 倍间隔未更新视为该 worker 已退出
+LEADER_LEASE_TTL = 15 # Agent 调度 leader 租约时长 (秒)，只有 leader worker 运行 Agent
+# 发布新版本前调用 POST /api/admin/drain：不再接受新连接，写完待落盘的消息，
+# 通知客户端在 0 到 DRAIN_RECONNECT_SPREAD 秒内的随机时刻重连 (错开重连，避免新实例被同时涌入的连接压垮)
+DRAIN_RECONNECT_SPREAD = 30
+ADMIN_TOKEN = os.getenv("CHAT_ADMIN_TOKEN", "") # 管理接口的令牌 (Authorization: Bearer ...)，为空时只允许本机访问
+
 # --- 日志配置 (如果需要更详细的日志) ---
 # import logging
 # logging.basicConfig(level=logging.INFO)
@@ -1,97 +1,682 @@
 # backend/connection_manager.py
 from fastapi import WebSocket
-from typing import List, Dict, Tuple, Any
+from typing import Awaitable, Callable, List, Dict, Any
+from collections import deque
+import asyncio
 import logging
-import json
+import random
+import time
+from backplane import Backplane
+from metrics import (BROADCAST_BATCH_EVENTS, BROADCAST_BATCH_SUPERSEDED, BROADCAST_FANOUT, BROADCAST_SECONDS,
+                     WS_COALESCED_FRAMES, WS_CONNECTIONS, WS_DROPPED_FRAMES, WS_SEND_DELAY, WS_SEND_FAILURES)
+from wire_codec import Codec, get_codec
+import config
 
 logger = logging.getLogger(__name__)
 
+SLOW_CONSUMER_POLICIES = ("drop_oldest", "coalesce", "disconnect")
+# full: 每次变化收到完整的 user_list_update (旧客户端)；delta: 收到带版本号的 presence_delta 增量
+PRESENCE_MODES = ("full", "delta")
+DRAIN_MIN_CLOSE_DELAY = 1.0 # 排空时发出重连提示后至少等待多久再关闭连接 (秒)
+
+class ClientConnection:
+    """
+    单个客户端连接。
+    每个连接拥有一个有界的发送队列和独立的写任务，广播只需入队，
+    一个慢客户端不会拖慢其他客户端或调用广播的协程。
+    """
+    def __init__(self, manager: "ConnectionManager", websocket: WebSocket, user_id: str, user_name: str,
+                 room_id: str = config.DEFAULT_ROOM_ID,
+                 max_queue_size: int = config.SEND_QUEUE_MAX_SIZE,
+                 policy: str = config.SLOW_CONSUMER_POLICY,
+                 max_drops: int = config.SLOW_CONSUMER_MAX_DROPS,
+                 drop_window: float = config.SLOW_CONSUMER_DROP_WINDOW,
+                 send_timeout: float = config.SEND_TIMEOUT,
+                 codec: Codec | None = None,
+                 presence_mode: str = "full",
+                 heartbeat: bool = False,
+                 batch: bool = False):
+        if policy not in SLOW_CONSUMER_POLICIES:
+            raise ValueError(f"未知的慢客户端策略: {policy}")
+        if presence_mode not in PRESENCE_MODES:
+            raise ValueError(f"未知的在线用户同步方式: {presence_mode}")
+        self.manager = manager
+        self.websocket = websocket
+        self.user_id = user_id
+        self.user_name = user_name
+        self.room_id = room_id
+        self.max_queue_size = max_queue_size
+        self.policy = policy
+        self.max_drops = max_drops
+        self.drop_window = drop_window
+        self.send_timeout = send_timeout
+        self.codec = codec or get_codec(None) # 连接时协商的帧编码
+        self.presence_mode = presence_mode
+        self.heartbeat = heartbeat # 客户端会回应 ping，可以按空闲时间判断连接是否还活着
+        self.batch = batch # 广播按房间的 tick 合并成数组帧 (客户端声明能处理数组帧时才开启)
+        self.last_seen = time.monotonic() # 最后一次收到客户端的帧
+        self.last_ping = self.last_seen
+        self.queue: deque[tuple[str | None, str | bytes, float]] = deque() # (合并键, 已编码的帧, 入队时间)
+        self.closed = False
+        # 计数器
+        self.sent_frames = 0
+        self.dropped_frames = 0 # 队列已满而丢弃的帧
+        self.coalesced_frames = 0 # 被同类新帧替换的过时帧 (不算丢帧)
+        self.max_queue_depth = 0
+        self._recent_drops: deque[float] = deque(maxlen=max_drops or None) # 最近 max_drops 次丢帧的时间
+        self._ready = asyncio.Event()
+        self._writer_task = asyncio.create_task(self._writer_loop())
+
+    def enqueue(self, frame: str | bytes, coalesce_key: str | None = None) -> bool:
+        """把一帧放入发送队列，返回是否入队成功 (不会等待网络发送)"""
+        if self.closed:
+            return False
+
+        if coalesce_key and self.policy == "coalesce":
+            # 队列里还没发出去的同类帧已经过时，直接替换
+            for index, (key, _, enqueued_at) in enumerate(self.queue):
+                if key == coalesce_key:
+                    self.queue[index] = (coalesce_key, frame, enqueued_at)
+                    self.coalesced_frames += 1
+                    WS_COALESCED_FRAMES.inc()
+                    return True
+
+        if len(self.queue) >= self.max_queue_size:
+            if self.policy == "disconnect":
+                logger.warning(f"用户 {self.user_id} 发送队列已满 ({len(self.queue)})，断开慢连接")
+                self.dropped_frames += 1
+                WS_DROPPED_FRAMES.inc()
+                self.close(close_code=1008, reason="slow_consumer")
+                return False
+            self.queue.popleft() # drop_oldest / coalesce：丢弃最旧的帧
+            if not self._count_drop():
+                return False
+
+        self.queue.append((coalesce_key, frame, time.monotonic()))
+        self.max_queue_depth = max(self.max_queue_depth, len(self.queue))
+        self._ready.set()
+        return True
+
+    def _count_drop(self) -> bool:
+        """记录一次队列溢出丢帧，drop_window 秒内丢帧达到 max_drops 时断开连接，返回连接是否仍然可用"""
+        self.dropped_frames += 1
+        WS_DROPPED_FRAMES.inc()
+        if not self.max_drops:
+            return True
+        now = time.monotonic()
+        self._recent_drops.append(now)
+        if len(self._recent_drops) >= self.max_drops and now - self._recent_drops[0] <= self.drop_window:
+            logger.warning(f"用户 {self.user_id} 在 {self.drop_window:g} 秒内丢帧 {self.max_drops} 次，断开慢连接")
+            self.close(close_code=1008, reason="slow_consumer")
+            return False
+        return True
+
+    async def _writer_loop(self):
+        """写任务：依次发送队列中的帧"""
+        try:
+            while not self.closed:
+                await self._ready.wait()
+                while self.queue and not self.closed:
+                    _, frame, enqueued_at = self.queue.popleft()
+                    send = self.websocket.send_bytes if isinstance(frame, bytes) else self.websocket.send_text
+                    await asyncio.wait_for(send(frame), timeout=self.send_timeout)
+                    self.sent_frames += 1
+                    WS_SEND_DELAY.observe(time.monotonic() - enqueued_at)
+                self._ready.clear()
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # 发送失败或超时，连接已不可用 (由 ConnectionManager 的定期清理从房间中移除)
+            logger.warning(f"发送消息给 {self.user_id} ({self.user_name}) 失败: {e!r}. 标记为断开连接.")
+            self.close(reason="timeout" if isinstance(e, asyncio.TimeoutError) else "error")
+
+    def touch(self):
+        """收到客户端的任意帧 (包括 pong) 时调用"""
+        self.last_seen = time.monotonic()
+
+    def close(self, close_code: int | None = None, reason: str | None = None):
+        """
+        停止写任务；服务器主动断开 (慢客户端 1008、心跳超时 1001) 时同时关闭 WebSocket。
+        reason 是因发送失败断开时记入 chat_ws_send_failures_total 的原因，正常断开时为 None。
+        """
+        if self.closed:
+            return
+        self.closed = True
+        if reason:
+            WS_SEND_FAILURES.labels(reason).inc()
+        self.queue.clear()
+        self._ready.set()
+        if close_code is not None:
+            asyncio.create_task(self._close_websocket(close_code))
+
+    async def _close_websocket(self, code: int):
+        try:
+            await self.websocket.close(code=code)
+        except Exception:
+            pass
+
+    def get_stats(self) -> Dict[str, Any]:
+        return {
+            "id": self.user_id,
+            "name": self.user_name,
+            "room_id": self.room_id,
+            "codec": self.codec.name,
+            "presence": self.presence_mode,
+            "batch": self.batch,
+            "idle_seconds": round(time.monotonic() - self.last_seen, 1),
+            "queue_depth": len(self.queue),
+            "max_queue_depth": self.max_queue_depth,
+            "sent_frames": self.sent_frames,
+            "dropped_frames": self.dropped_frames,
+            "coalesced_frames": self.coalesced_frames,
+        }
+
+
+class RoomPresence:
+    """
+    房间在线用户的版本化状态。
+    announced 是最近一次发给客户端的在线用户，每次发出变化版本号加一；
+    客户端收到的增量 baseVersion 和本地版本不一致时 (丢帧或乱序)，发送 presence_sync 请求完整快照。
+    """
+    def __init__(self):
+        self.version = 0
+        self.announced: Dict[str, str] = {} # user_id -> user_name
+        self.local_dirty = False # 本 worker 的在线用户有变化，需要发布给其他 worker
+        self.flush_handle: asyncio.TimerHandle | None = None
+
+
+class RoomBatch:
+    """
+    房间的广播批次：一个 tick 内的事件先在这里合并，tick 结束时每个开启批量的连接只收到一帧 (事件数组)。
+    每条事件是 (合并键, 消息, 接收者的在线用户同步方式)，同步方式为 None 时发给所有批量连接。
+    """
+    def __init__(self):
+        self.events: list[tuple[str | None, Dict[str, Any], str | None]] = []
+        self.flush_handle: asyncio.TimerHandle | None = None
+        self.last_flush = float("-inf") # 上次发出批次的时间 (事件循环时钟)
+
+    def add(self, message: Dict[str, Any], coalesce_key: str | None, presence_mode: str | None):
+        """加入一条事件，并丢弃被它取代的事件"""
+        message_type = message.get("type")
+        stream_id = message.get("streamId")
+        if coalesce_key:
+            # 同类帧 (如完整在线用户列表) 只保留最新一份
+            self._discard(lambda key, msg, mode: key == coalesce_key and mode == presence_mode)
+        elif message_type == "message" and stream_id:
+            # 流式回复的最终消息会替换前端的草稿，同一批次里还没发出的增量不用再发
+            self._discard(lambda key, msg, mode: msg.get("type") == "message_delta" and msg.get("streamId") == stream_id)
+        elif message_type == "message_delta" and stream_id and "delta" in message:
+            # 同一条流式回复的相邻增量拼成一个
+            for index in range(len(self.events) - 1, -1, -1):
+                previous = self.events[index][1]
+                if previous.get("type") == "message_delta" and previous.get("streamId") == stream_id:
+                    if "delta" in previous and previous["offset"] + len(previous["delta"]) == message["offset"]:
+                        self.events[index] = (None, {**previous, "delta": previous["delta"] + message["delta"]},
+                                              presence_mode)
+                        BROADCAST_BATCH_SUPERSEDED.inc()
+                        return
+                    break
+        self.events.append((coalesce_key, message, presence_mode))
+
+    def _discard(self, superseded: Callable[[str | None, Dict[str, Any], str | None], bool]):
+        kept = [event for event in self.events if not superseded(*event)]
+        BROADCAST_BATCH_SUPERSEDED.inc(len(self.events) - len(kept))
+        self.events = kept
+
+
 class ConnectionManager:
-    """管理 WebSocket 连接、用户和消息广播"""
+    """管理各个聊天室的 WebSocket 连接、用户和消息广播"""
     def __init__(self):
-        # 存储活跃的连接，键是 user_id，值是包含 WebSocket 连接和用户名的元组
-        self.active_connections: Dict[str, Tuple[WebSocket, str]] = {}
+        # 按房间存储活跃的连接：room_id -> {user_id: ClientConnection}
+        # 广播只遍历目标房间，开销与房间人数成正比，而不是总连接数
+        self.rooms: Dict[str, Dict[str, ClientConnection]] = {}
+        # 房间从无人变为有人 (active=True) 或从有人变为无人 (active=False) 时的回调
+        self._room_activity_listeners: List[Callable[[str, bool], None]] = []
+        self._active_rooms: set[str] = set() # 本 worker 或其他 worker 上有人的房间
+        # 多 worker 部署：广播总线和其他 worker 上的在线用户
+        self.backplane: Backplane | None = None
+        # room_id -> {worker origin: (最后更新时间, {user_id: user_name})}
+        self.remote_presence: Dict[str, Dict[str, tuple[float, Dict[str, str]]]] = {}
+        # 收到其他 worker 广播的消息时的回调 (如更新最近消息缓存)
+        self._remote_broadcast_listeners: List[Callable[[Dict[str, Any], str], None]] = []
+        # room_id -> 在线用户同步状态 (只跟踪本 worker 上有连接的房间)
+        self.presence: Dict[str, RoomPresence] = {}
+        # room_id -> 广播批次 (只有开启了批量的连接使用，见 config.BROADCAST_BATCH_MS)
+        self.batches: Dict[str, RoomBatch] = {}
+        # 排空模式 (发布前调用 drain)：不再接受新连接，已有连接收到重连提示后被错开关闭
+        self.draining = False
+        # 其他 worker 发起排空时的处理 (由 main 设置为 "先落盘写入管道、再 drain")，未设置时直接 drain
+        self.remote_drain_handler: Callable[[float], Awaitable[Any]] | None = None
+        self._remote_drain_task: asyncio.Task | None = None
+
+    def attach_backplane(self, backplane: Backplane):
+        """接入广播总线，之后的广播和在线用户变化会同步给其他 worker"""
+        self.backplane = backplane
+
+    def add_remote_broadcast_listener(self, listener: Callable[[Dict[str, Any], str], None]):
+        """注册其他 worker 广播消息的回调 listener(message, room_id)"""
+        self._remote_broadcast_listeners.append(listener)
+
+    def add_room_activity_listener(self, listener: Callable[[str, bool], None]):
+        """注册房间活跃状态变化的回调 listener(room_id, active)"""
+        self._room_activity_listeners.append(listener)
+
+    def _update_room_activity(self, room_id: str):
+        """房间 (所有 worker 合计) 在有人/无人之间切换时通知监听者"""
+        active = self.get_room_size(room_id) > 0
+        if active == (room_id in self._active_rooms):
+            return
+        if active:
+            self._active_rooms.add(room_id)
+        else:
+            self._active_rooms.discard(room_id)
+        for listener in self._room_activity_listeners:
+            try:
+                listener(room_id, active)
+            except Exception as e:
+                logger.error(f"房间 {room_id} 活跃状态回调出错: {e}", exc_info=True)
 
-    async def connect(self, websocket: WebSocket, user_id: str, user_name: str):
-        """接受新的 WebSocket 连接并存储"""
+    async def connect(self, websocket: WebSocket, user_id: str, user_name: str,
+                      room_id: str = config.DEFAULT_ROOM_ID, codec: Codec | None = None,
+                      presence_mode: str = "full", heartbeat: bool = False, batch: bool = False) -> ClientConnection:
+        """接受新的 WebSocket 连接并存储到对应房间，先发给它一份在线用户快照，其他人在合并窗口结束时收到变化"""
         await websocket.accept()
-        self.active_connections[user_id] = (websocket, user_name)
-        logger.info(f"用户 {user_id} ({user_name}) 连接成功. 当前在线: {len(self.active_connections)}")
+        room = self.rooms.setdefault(room_id, {})
+        old_conn = room.get(user_id)
+        if old_conn:
+            old_conn.close() # 同一用户在同一房间重复连接，旧连接不再接收消息
+        conn = room[user_id] = ClientConnection(self, websocket, user_id, user_name, room_id, codec=codec,
+                                                presence_mode=presence_mode, heartbeat=heartbeat,
+                                                batch=batch and config.BROADCAST_BATCH_MS > 0)
+        WS_CONNECTIONS.labels(room_id).set(len(room))
+        logger.info(f"用户 {user_id} ({user_name}) 进入房间 {room_id}. 房间在线: {len(room)}")
+        self._mark_presence_dirty(room_id, local=True)
+        self.send_presence_snapshot(user_id, room_id)
+        self._update_room_activity(room_id)
+        return conn
 
-    def disconnect(self, websocket: WebSocket, user_id: str):
+    def _remove(self, room_id: str, user_id: str):
+        room = self.rooms.get(room_id)
+        if room is None:
+            return
+        room.pop(user_id, None)
+        if room:
+            WS_CONNECTIONS.labels(room_id).set(len(room))
+        else:
+            del self.rooms[room_id]
+            WS_CONNECTIONS.remove(room_id) # 房间名由客户端决定，空房间不保留时间序列
+            self._drop_batch(room_id)
+        self._mark_presence_dirty(room_id, local=True)
+        self._update_room_activity(room_id)
+
+    def disconnect(self, websocket: WebSocket, user_id: str, room_id: str = config.DEFAULT_ROOM_ID):
         """断开指定用户的 WebSocket 连接"""
-        if user_id in self.active_connections:
-            del self.active_connections[user_id]
-            logger.info(f"用户 {user_id} 连接已移除. 当前在线: {len(self.active_connections)}")
+        conn = self.rooms.get(room_id, {}).get(user_id)
+        if conn and conn.websocket is websocket: # 只移除本连接，不影响同一用户的新连接
+            conn.close()
+            self._remove(room_id, user_id)
+            logger.info(f"用户 {user_id} 离开房间 {room_id}. 房间在线: {self.get_room_size(room_id)}")
         # 注意: FastAPI 的 WebSocket 对象不需要显式 close()
 
-    def get_user_name(self, user_id: str) -> str | None:
+    def remove_connection(self, conn: ClientConnection):
+        """从房间中移除失效连接，房间内其他用户在合并窗口结束时收到变化"""
+        if self.rooms.get(conn.room_id, {}).get(conn.user_id) is conn:
+            self._remove(conn.room_id, conn.user_id)
+            logger.info(f"清理了断开的连接: {conn.user_id} (房间 {conn.room_id})")
+
+    def reap_connections(self) -> int:
+        """
+        一次清理所有失效连接 (写任务失败、慢客户端被断开、心跳超时)，并向支持心跳的客户端发送 ping。
+        返回清理的连接数。
+        """
+        now = time.monotonic()
+        reaped = 0
+        pings: Dict[str, str | bytes] = {} # 每种编码只序列化一次
+        for room in list(self.rooms.values()):
+            for conn in list(room.values()):
+                if not conn.closed and conn.heartbeat and now - conn.last_seen > config.WS_IDLE_TIMEOUT:
+                    logger.info(f"用户 {conn.user_id} 超过 {config.WS_IDLE_TIMEOUT} 秒没有响应心跳，断开连接")
+                    conn.close(close_code=1001)
+                if conn.closed:
+                    self.remove_connection(conn)
+                    reaped += 1
+                elif conn.heartbeat and now - conn.last_ping >= config.WS_HEARTBEAT_INTERVAL:
+                    conn.last_ping = now
+                    frame = pings.get(conn.codec.name)
+                    if frame is None:
+                        frame = pings[conn.codec.name] = conn.codec.encode({"type": "ping", "ts": int(time.time() * 1000)})
+                    conn.enqueue(frame)
+        return reaped
+
+    async def run_reaper(self):
+        """定期清理失效连接的后台任务"""
+        while True:
+            await asyncio.sleep(config.WS_REAP_INTERVAL)
+            try:
+                reaped = self.reap_connections()
+                if reaped:
+                    logger.info(f"清理了 {reaped} 个失效连接")
+            except Exception as e:
+                logger.error(f"清理失效连接出错: {e}", exc_info=True)
+
+    def close_all(self):
+        """停止所有连接的写任务 (应用关闭时调用)"""
+        for room_id, room in self.rooms.items():
+            self._publish({"kind": "presence", "room_id": room_id, "users": {}}) # 通知其他 worker 这些用户已离开
+            for conn in room.values():
+                conn.close()
+        self.rooms.clear()
+        for state in self.presence.values():
+            if state.flush_handle:
+                state.flush_handle.cancel()
+        self.presence.clear()
+        for room_id in list(self.batches):
+            self._drop_batch(room_id)
+
+    def drain(self, spread: float = config.DRAIN_RECONNECT_SPREAD) -> int:
+        """
+        进入排空模式：给每个连接发一个 reconnect 提示 (delayMs 是建议的重连等待时间)，
+        并在同一时刻以 1012 (服务重启) 关闭连接。等待时间在 0 到 spread 秒之间均匀错开，
+        不认识 reconnect 帧、断开后立即重连的旧客户端也会被错开。返回收到提示的连接数。
+        """
+        self.draining = True
+        conns = [conn for room in self.rooms.values() for conn in room.values() if not conn.closed]
+        random.shuffle(conns)
+        loop = asyncio.get_running_loop()
+        for index, conn in enumerate(conns):
+            delay = spread * (index + random.random()) / len(conns)
+            conn.enqueue(conn.codec.encode({"type": "reconnect", "delayMs": int(delay * 1000)}))
+            # 至少留一点时间让写任务把提示发出去 (close 会清空发送队列)
+            loop.call_later(max(delay, DRAIN_MIN_CLOSE_DELAY), conn.close, 1012)
+        logger.info(f"进入排空模式，{len(conns)} 个连接将在 {spread} 秒内陆续断开")
+        return len(conns)
+
+    def _get_remote_users(self, room_id: str) -> Dict[str, str]:
+        users = {}
+        for _, remote_users in self.remote_presence.get(room_id, {}).values():
+            users.update(remote_users)
+        return users
+
+    def get_room_size(self, room_id: str) -> int:
+        """房间在线人数 (包括其他 worker 上的连接)"""
+        local = self.rooms.get(room_id, {})
+        return len(local) + sum(1 for uid in self._get_remote_users(room_id) if uid not in local)
+
+    def get_active_rooms(self) -> Dict[str, int]:
+        """当前有人的房间及其在线人数"""
+        room_ids = set(self.rooms) | set(self.remote_presence)
+        return {room_id: size for room_id in room_ids if (size := self.get_room_size(room_id))}
+
+    def get_user_name(self, user_id: str, room_id: str = config.DEFAULT_ROOM_ID) -> str | None:
         """根据 user_id 获取用户名"""
-        conn_info = self.active_connections.get(user_id)
-        return conn_info[1] if conn_info else None
+        conn = self.rooms.get(room_id, {}).get(user_id)
+        return conn.user_name if conn else None
+
+    def get_active_users_list(self, room_id: str = config.DEFAULT_ROOM_ID) -> List[Dict[str, str]]:
+        """获取房间内所有在线用户的列表 [{id: 'xxx', name: 'yyy'}, ...] (包括其他 worker 上的用户)"""
+        local = self.rooms.get(room_id, {})
+        users = [{"id": uid, "name": conn.user_name} for uid, conn in local.items()]
+        users.extend({"id": uid, "name": name} for uid, name in self._get_remote_users(room_id).items() if uid not in local)
+        return users
+
+    def get_connection_stats(self, room_id: str | None = None) -> List[Dict[str, Any]]:
+        """每个连接的发送队列深度和丢帧计数 (不指定房间时返回全部)"""
+        room_ids = [room_id] if room_id is not None else list(self.rooms)
+        return [conn.get_stats() for rid in room_ids for conn in self.rooms.get(rid, {}).values()]
+
+    def _enqueue_all(self, message: Dict[str, Any], room_id: str, coalesce_key: str | None = None,
+                     presence_mode: str | None = None):
+        """
+        把消息放入房间内所有连接的发送队列 (presence_mode 不为 None 时只发给使用该同步方式的连接)。
+        开启了批量的连接不在这里入队，而是交给房间的广播批次。
+        """
+        room = self.rooms.get(room_id)
+        if not room:
+            return
+        t0 = time.perf_counter()
+        frames: Dict[str, str | bytes] = {} # 每种编码只序列化一次
+        fanout = 0
+        batched = False
+        for conn in list(room.values()): # 创建副本，入队时可能移除慢连接
+            if presence_mode is not None and conn.presence_mode != presence_mode:
+                continue
+            if conn.batch:
+                batched = True
+                continue
+            frame = frames.get(conn.codec.name)
+            if frame is None:
+                frame = frames[conn.codec.name] = conn.codec.encode(message)
+            conn.enqueue(frame, coalesce_key)
+            fanout += 1
+        if batched:
+            self._add_to_batch(room_id, message, coalesce_key, presence_mode)
+        if fanout:
+            BROADCAST_SECONDS.observe(time.perf_counter() - t0)
+            BROADCAST_FANOUT.observe(fanout)
+
+    # --- 广播批量 ---
+    def _add_to_batch(self, room_id: str, message: Dict[str, Any], coalesce_key: str | None,
+                      presence_mode: str | None):
+        """
+        房间安静时 (距上次发出批次超过一个 tick 且没有待发的批次) 立即发出，延迟和不开批量时一样；
+        否则加入批次，在 tick 结束或批次达到 BROADCAST_BATCH_MAX_EVENTS 条时一起发出。
+        """
+        batch = self.batches.get(room_id)
+        if batch is None:
+            batch = self.batches[room_id] = RoomBatch()
+        batch.add(message, coalesce_key, presence_mode)
+        loop = asyncio.get_running_loop()
+        tick = config.BROADCAST_BATCH_MS / 1000
+        if batch.flush_handle is None and loop.time() - batch.last_flush >= tick:
+            self._flush_batch(room_id)
+        elif len(batch.events) >= config.BROADCAST_BATCH_MAX_EVENTS:
+            if batch.flush_handle:
+                batch.flush_handle.cancel()
+            self._flush_batch(room_id)
+        elif batch.flush_handle is None:
+            batch.flush_handle = loop.call_at(batch.last_flush + tick, self._flush_batch, room_id)
+
+    def _flush_batch(self, room_id: str):
+        """发出房间的广播批次：每个批量连接一帧，只有一条事件时发单个对象，多条时发数组"""
+        batch = self.batches.get(room_id)
+        if batch is None:
+            return
+        batch.flush_handle = None
+        batch.last_flush = asyncio.get_running_loop().time()
+        events, batch.events = batch.events, []
+        room = self.rooms.get(room_id)
+        if not events or not room:
+            return
+        t0 = time.perf_counter()
+        frames: Dict[tuple[str, str], tuple[str | None, str | bytes] | None] = {} # (同步方式, 编码) -> (合并键, 帧)
+        fanout = 0
+        for conn in list(room.values()):
+            if not conn.batch:
+                continue
+            key = (conn.presence_mode, conn.codec.name)
+            if key not in frames:
+                selected = [(coalesce_key, message) for coalesce_key, message, mode in events
+                            if mode is None or mode == conn.presence_mode]
+                if not selected:
+                    frames[key] = None
+                elif len(selected) == 1:
+                    frames[key] = (selected[0][0], conn.codec.encode(selected[0][1]))
+                else:
+                    frames[key] = (None, conn.codec.encode([message for _, message in selected]))
+            if frames[key] is not None:
+                conn.enqueue(frames[key][1], frames[key][0])
+                fanout += 1
+        BROADCAST_BATCH_EVENTS.observe(len(events))
+        if fanout:
+            BROADCAST_SECONDS.observe(time.perf_counter() - t0)
+            BROADCAST_FANOUT.observe(fanout)
 
-    def get_active_users_list(self) -> List[Dict[str, str]]:
-        """获取当前所有在线用户的列表 [{id: 'xxx', name: 'yyy'}, ...]"""
-        return [{"id": uid, "name": info[1]} for uid, info in self.active_connections.items()]
+    def _drop_batch(self, room_id: str):
+        batch = self.batches.pop(room_id, None)
+        if batch and batch.flush_handle:
+            batch.flush_handle.cancel()
 
-    async def broadcast(self, message: Dict[str, Any]):
-        """将 JSON 消息广播给所有连接的客户端"""
-        message_json = json.dumps(message) # 序列化一次即可
-        disconnected_users = []
-        active_users = list(self.active_connections.items()) # 创建副本以允许在迭代时修改字典
+    def _publish(self, event: Dict[str, Any]):
+        if self.backplane is not None:
+            self.backplane.publish(event)
 
-        for user_id, (websocket, user_name) in active_users:
+    def _publish_presence(self, room_id: str):
+        """把本 worker 在该房间的在线用户发布给其他 worker"""
+        self._publish({
+            "kind": "presence",
+            "room_id": room_id,
+            "users": {uid: conn.user_name for uid, conn in self.rooms.get(room_id, {}).items()},
+        })
+
+    def publish_all_presence(self):
+        """定期发布本 worker 所有房间的在线用户 (心跳)，并清理已退出 worker 的在线用户"""
+        for room_id in list(self.rooms):
+            self._publish_presence(room_id)
+        expire_before = time.monotonic() - config.BACKPLANE_PRESENCE_INTERVAL * 3
+        for room_id, origins in list(self.remote_presence.items()):
+            stale = [origin for origin, (updated_at, _) in origins.items() if updated_at < expire_before]
+            for origin in stale:
+                del origins[origin]
+            if not origins:
+                del self.remote_presence[room_id]
+            if stale:
+                self._update_room_activity(room_id)
+                self._mark_presence_dirty(room_id)
+
+    async def run_presence_heartbeat(self):
+        """多 worker 部署时的在线用户心跳任务"""
+        while True:
+            await asyncio.sleep(config.BACKPLANE_PRESENCE_INTERVAL)
             try:
-                await websocket.send_text(message_json)
-                logger.debug(f"消息已发送给 {user_id} ({user_name})")
+                self.publish_all_presence()
             except Exception as e:
-                # 发送失败，可能连接已断开
-                logger.warning(f"发送消息给 {user_id} ({user_name}) 失败: {e}. 标记为断开连接.")
-                disconnected_users.append(user_id)
-
-        # 清理广播时发现已断开的连接
-        for user_id in disconnected_users:
-            if user_id in self.active_connections: # 再次检查，防止并发问题
-                 del self.active_connections[user_id]
-                 logger.info(f"在广播期间清理了断开的连接: {user_id}")
-                 # 可选：在这里也广播用户离开消息
-                 # await self.broadcast_system_message(f"{self.get_user_name(user_id) or user_id} 离开了聊天")
-                 await self.broadcast_user_list() # 需要更新用户列表
-
-
-    async def broadcast_user_list(self):
-        """广播当前在线用户列表"""
-        user_list_message = {
-            "type": "user_list_update",
-            "users": self.get_active_users_list()
+                logger.error(f"在线用户心跳出错: {e}", exc_info=True)
+
+    def handle_backplane_event(self, event: Dict[str, Any]):
+        """处理其他 worker 发来的事件，只投递给本 worker 的连接，不再转发"""
+        kind = event.get("kind")
+        room_id = event.get("room_id", config.DEFAULT_ROOM_ID)
+        if kind == "broadcast":
+            message = event["message"]
+            for listener in self._remote_broadcast_listeners:
+                listener(message, room_id)
+            self._enqueue_all(message, room_id)
+        elif kind == "presence":
+            users = event.get("users") or {}
+            origins = self.remote_presence.setdefault(room_id, {})
+            if users:
+                origins[event["origin"]] = (time.monotonic(), users)
+            else:
+                origins.pop(event["origin"], None)
+                if not origins:
+                    del self.remote_presence[room_id]
+            self._update_room_activity(room_id)
+            self._mark_presence_dirty(room_id)
+        elif kind == "drain":
+            spread = event.get("spread", config.DRAIN_RECONNECT_SPREAD)
+            if self.remote_drain_handler is None:
+                self.drain(spread)
+            else:
+                self.draining = True # 落盘期间就拒绝新连接
+                self._remote_drain_task = asyncio.create_task(self.remote_drain_handler(spread))
+
+    # --- 在线用户同步 ---
+    def _mark_presence_dirty(self, room_id: str, local: bool = False):
+        """
+        记录房间在线用户有变化 (local=True 表示本 worker 的连接变化)，合并窗口结束时统一发出。
+        加入风暴时每个窗口只产生一帧，而不是每次进出都给每个人发一次完整列表。
+        """
+        state = self.presence.get(room_id)
+        if state is None:
+            if room_id not in self.rooms and not local:
+                return # 本 worker 没有人在这个房间，其他 worker 的变化与我们无关
+            state = self.presence[room_id] = RoomPresence()
+        state.local_dirty = state.local_dirty or local
+        if state.flush_handle is None:
+            state.flush_handle = asyncio.get_running_loop().call_later(
+                config.PRESENCE_COALESCE_MS / 1000, self._flush_presence, room_id)
+
+    def _flush_presence(self, room_id: str):
+        """合并窗口结束：和上次发出的在线用户比较，把变化发给房间内的连接"""
+        state = self.presence.get(room_id)
+        if state is None:
+            return
+        state.flush_handle = None
+        if state.local_dirty:
+            state.local_dirty = False
+            self._publish_presence(room_id)
+        room = self.rooms.get(room_id)
+        if not room:
+            del self.presence[room_id]
+            return
+
+        current = {user["id"]: user["name"] for user in self.get_active_users_list(room_id)}
+        joined = [{"id": uid, "name": name} for uid, name in current.items() if state.announced.get(uid) != name]
+        left = [uid for uid in state.announced if uid not in current]
+        if not joined and not left:
+            return # 窗口内有人进来又走了，结果没有变化
+        state.version += 1
+        state.announced = current
+        delta = {
+            "type": "presence_delta",
+            "roomId": room_id,
+            "baseVersion": state.version - 1,
+            "version": state.version,
+            "joined": joined, # 新加入或改了名字的用户
+            "left": left, # 离开的 user_id
         }
-        await self.broadcast(user_list_message)
-        logger.info("已广播用户列表更新")
+        full = {"type": "user_list_update", "version": state.version,
+                "users": [{"id": uid, "name": name} for uid, name in current.items()]}
+
+        # 完整列表可以用新的替换队列里旧的；增量不能合并，丢了会造成版本号断档
+        self._enqueue_all(full, room_id, "user_list_update", presence_mode="full")
+        self._enqueue_all(delta, room_id, presence_mode="delta")
+
+    def send_presence_snapshot(self, user_id: str, room_id: str = config.DEFAULT_ROOM_ID):
+        """
+        给单个连接发送在线用户快照 (连接时，或客户端发现版本号不连续时)，之后的增量都以这个版本为基础。
+        用户列表取当前的实际在线用户而不是上次发出的 announced：合并窗口还没结束时，announced 里没有刚进入的用户
+        (包括这个连接自己)。快照比版本号新一些没有关系，下一个增量里的 joined / left 重复应用结果不变。
+        """
+        conn = self.rooms.get(room_id, {}).get(user_id)
+        if conn is None:
+            return
+        state = self.presence.get(room_id) or RoomPresence()
+        users = self.get_active_users_list(room_id)
+        if conn.presence_mode == "delta":
+            message = {"type": "presence_snapshot", "roomId": room_id, "version": state.version, "users": users}
+        else:
+            message = {"type": "user_list_update", "version": state.version, "users": users}
+        conn.enqueue(conn.codec.encode(message))
+
+    async def broadcast(self, message: Dict[str, Any], room_id: str = config.DEFAULT_ROOM_ID):
+        """将 JSON 消息广播给房间内所有连接的客户端 (O(N) 入队，不等待网络发送)，并转发给其他 worker"""
+        self._enqueue_all(message, room_id)
+        self._publish({"kind": "broadcast", "room_id": room_id, "message": message})
 
-    async def broadcast_system_message(self, content: str):
+    async def broadcast_user_list(self, room_id: str = config.DEFAULT_ROOM_ID):
+        """广播房间的在线用户列表 (在合并窗口结束时发出)"""
+        self._mark_presence_dirty(room_id, local=True)
+
+    async def broadcast_system_message(self, content: str, room_id: str = config.DEFAULT_ROOM_ID):
         """广播系统消息"""
         system_message = {
             "type": "system",
             "content": content
         }
-        await self.broadcast(system_message)
-        logger.info(f"已广播系统消息: {content}")
-
-    async def send_personal_message(self, message: Dict[str, Any], user_id: str):
-        """向特定用户发送消息"""
-        conn_info = self.active_connections.get(user_id)
-        if conn_info:
-            websocket, user_name = conn_info
-            try:
-                await websocket.send_json(message)
-                logger.info(f"私信已发送给 {user_id} ({user_name})")
+        await self.broadcast(system_message, room_id)
+        logger.debug(f"已向房间 {room_id} 广播系统消息: {content}")
+
+    async def send_personal_message(self, message: Dict[str, Any], user_id: str,
+                                    room_id: str = config.DEFAULT_ROOM_ID):
+        """向特定房间内的特定用户发送消息"""
+        conn = self.rooms.get(room_id, {}).get(user_id)
+        if conn:
+            if conn.enqueue(conn.codec.encode(message)):
+                logger.debug(f"私信已放入 {user_id} ({conn.user_name}) 的发送队列")
                 return True
-            except Exception as e:
-                logger.warning(f"发送私信给 {user_id} ({user_name}) 失败: {e}")
-                # 可以考虑在这里处理断开连接
-                self.disconnect(websocket, user_id)
-                await self.broadcast_user_list()
-                return False
+            logger.warning(f"发送私信给 {user_id} ({conn.user_name}) 失败: 连接已关闭")
+            return False
         else:
             logger.warning(f"尝试向不存在或已断开的用户 {user_id} 发送私信")
             return False
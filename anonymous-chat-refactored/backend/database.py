@@ -1,7 +1,8 @@
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, inspect, text
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
 import os
+import config
 
 # 定义 SQLite 数据库文件路径
 # 将数据库文件放在项目根目录下的 backend 文件夹中
@@ -17,6 +18,16 @@ engine = create_engine(
     SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False}
 )
 
+@event.listens_for(engine, "connect")
+def _set_sqlite_pragmas(dbapi_connection, connection_record):
+    """每个新连接设置 SQLite 的日志模式和同步级别"""
+    cursor = dbapi_connection.cursor()
+    # 只对新建的数据库生效 (必须在切换 WAL 和建表之前设置)，旧数据库需要执行一次 VACUUM 才能切换
+    cursor.execute("PRAGMA auto_vacuum=INCREMENTAL")
+    cursor.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+    cursor.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+    cursor.close()
+
 # 创建数据库会话工厂
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
@@ -31,10 +42,35 @@ def init_db():
     logger.info("正在创建数据库表...")
     try:
         Base.metadata.create_all(bind=engine)
+        # create_all 不会修改已存在的表，旧的 chat.db 需要补充新增的列和索引
+        _add_missing_columns()
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=engine, checkfirst=True)
         logger.info("数据库表创建成功 (如果尚不存在)。")
     except Exception as e:
         logger.error(f"创建数据库表失败: {e}", exc_info=True)
 
+def _add_missing_columns():
+    """给已存在的表补充模型中新增的列 (新增列必须可为空或带有 server_default)"""
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            if not inspector.has_table(table.name):
+                continue
+            existing = {col["name"] for col in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name in existing:
+                    continue
+                column_type = column.type.compile(dialect=engine.dialect)
+                ddl = f"ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}"
+                if column.server_default is not None:
+                    ddl += f" DEFAULT '{column.server_default.arg}'"
+                if not column.nullable:
+                    ddl += " NOT NULL"
+                conn.execute(text(ddl))
+                logger.info(f"已为表 {table.name} 添加列 {column.name}")
+
 # --- 获取数据库会话的依赖项 ---
 def get_db():
     db = SessionLocal()
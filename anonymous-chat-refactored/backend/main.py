@@ -1,25 +1,34 @@
 # backend/main.py
 import uvicorn
 import asyncio # 导入 asyncio
-from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, Form, Depends, Query
-from fastapi.responses import FileResponse
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, WebSocket, WebSocketDisconnect, UploadFile, File, Form, Depends, Query, Request, HTTPException
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware # 导入 CORS 中间件
 from typing import List, Optional, Union
 import logging
 import os
-import shutil
+import time
 import uuid # 导入 uuid 库
-from connection_manager import ConnectionManager # 稍后创建
-from sqlalchemy.orm import Session # 导入 Session
-from database import init_db, get_db # 导入数据库相关函数
-from models import Message as MessageModel, MessageTypeEnum # 导入模型和枚举
-from datetime import datetime # 导入 datetime
+from connection_manager import ClientConnection, ConnectionManager, PRESENCE_MODES # 稍后创建
+from database import DATABASE_FILE, init_db, engine # 导入数据库相关函数
+from search_index import ensure_search_index, rebuild_search_index # 全文检索
+from message_archive import MessageArchive # 过期消息归档
+from message_export import ExportError, MessageExport # 批量导出
+from models import MessageTypeEnum # 导入枚举
+from repository import MessageRepository # 异步数据库访问层
+from message_writer import MessageWriter # 批量消息写入管道
+from message_cache import RecentMessageCache # 最近消息缓存
+from datetime import datetime, timezone # 导入 datetime
 # --- Agent 相关导入 ---
 import config # 导入配置，虽然不直接用，但 agent_manager 和 scheduler 会用
 from agent_manager import AgentManager
 from scheduler import AgentScheduler
-from sqlalchemy import desc # 导入 desc
+from agent_config import AgentConfigWatcher # Agent 配置热加载
+from backplane import Backplane, LeaderElector, create_backplane, create_leader_elector # 多 worker 广播总线
+from upload_store import UploadStore, UploadError, ImmutableStaticFiles # 图片上传管道
+from metrics import REGISTRY, Gauge, HTTPMetricsMiddleware # /metrics 指标
+from rate_limiter import CONTROL_FRAME_TYPES, IngestLimiter # 上行限流
+from wire_codec import CODECS, DEFAULT_CODEC, DEFLATE_PROTOCOL, get_codec, receive_frame # WebSocket 帧编解码
 
 # 配置日志记录
 logging.basicConfig(level=logging.INFO)
@@ -27,35 +36,114 @@ logger = logging.getLogger(__name__)
 
 # --- 全局变量 (用于在启动和关闭事件中访问) ---
 connection_manager: ConnectionManager | None = None
+message_repository: MessageRepository | None = None
+message_writer: MessageWriter | None = None
+message_cache: RecentMessageCache | None = None
 agent_manager: AgentManager | None = None
 agent_scheduler: AgentScheduler | None = None
+backplane: Backplane | None = None
+leader_elector: LeaderElector | None = None
+presence_heartbeat_task: asyncio.Task | None = None
+reaper_task: asyncio.Task | None = None
+upload_store: UploadStore | None = None
+search_available = False
+search_index_task: asyncio.Task | None = None # 已有消息第一次建立全文索引 (完成前检索返回 503)
+message_archive: MessageArchive | None = None
+maintenance_task: asyncio.Task | None = None
+ingest_limiter: IngestLimiter | None = None
+agent_config_watcher: AgentConfigWatcher | None = None
+agent_config_task: asyncio.Task | None = None
 
 app = FastAPI()
 
 # --- 应用启动事件 ---
 @app.on_event("startup")
 async def on_startup(): # 改为 async
-    global connection_manager, agent_manager, agent_scheduler
+    global connection_manager, message_repository, message_writer, message_cache, agent_manager, agent_scheduler
+    global backplane, leader_elector, presence_heartbeat_task, reaper_task, upload_store, search_available, search_index_task
+    global message_archive, maintenance_task, ingest_limiter, agent_config_watcher, agent_config_task
     logger.info("应用程序启动...")
+    backplane = create_backplane()
 
     # 1. 初始化数据库
     logger.info("开始初始化数据库...")
     init_db()
+    search_needs_build = False
+    if config.SEARCH_ENABLED:
+        search_available, search_needs_build = ensure_search_index(engine)
+    message_repository = MessageRepository()
+    if search_needs_build:
+        search_index_task = asyncio.create_task(build_search_index())
+    # 归档在缓存之前加载：房间有归档消息时，缓存不能认为主库中的消息就是全部历史
+    message_archive = MessageArchive()
+    message_cache = RecentMessageCache(has_archive=message_archive.has_room)
+    for room_id in config.ROOMS:
+        await message_cache.warm_up(message_repository, room_id)
+    durability = config.MESSAGE_DURABILITY
+    if backplane.cross_process and durability == "write_behind":
+        # 多个 worker 各自在进程内分配 id 会冲突，改为批量提交并由数据库分配 id
+        logger.warning("多 worker 部署不支持 write_behind，改用 group_commit 模式。")
+        durability = "group_commit"
+    message_writer = MessageWriter(message_repository, message_cache, mode=durability)
+    await message_writer.start()
     logger.info("数据库初始化完成。")
 
     # 2. 初始化 ConnectionManager
     connection_manager = ConnectionManager()
+    connection_manager.attach_backplane(backplane)
+    connection_manager.remote_drain_handler = drain_worker # 其他 worker 发起排空时也先落盘
+    connection_manager.add_remote_broadcast_listener(message_cache.add_remote) # 其他 worker 的消息也进入最近消息缓存
+    connection_manager.add_room_activity_listener(message_cache.on_room_activity) # 未配置的房间没人时释放缓存
+    await backplane.start(connection_manager.handle_backplane_event)
+    if backplane.cross_process:
+        presence_heartbeat_task = asyncio.create_task(connection_manager.run_presence_heartbeat())
+    reaper_task = asyncio.create_task(connection_manager.run_reaper()) # 定期清理失效连接、发送心跳
+    ingest_limiter = IngestLimiter()
     logger.info("ConnectionManager 初始化完成。")
 
     # 3. 初始化 AgentManager (需要 ConnectionManager)
-    agent_manager = AgentManager(connection_manager)
+    agent_manager = AgentManager(connection_manager, message_repository, message_writer, message_cache)
     logger.info("AgentManager 初始化完成。")
 
     # 4. 初始化并启动 AgentScheduler (需要 AgentManager)
+    # Agent 只在房间有人在线时运行，由 ConnectionManager 的房间活跃状态驱动
+    # 多 worker 部署时只有选举出的 leader 运行 Agent
     agent_scheduler = AgentScheduler(agent_manager)
-    agent_scheduler.start_all_agents()
+    agent_scheduler.is_leader = False
+    # Agent 定义文件存在时覆盖 config.py 中的默认配置，之后修改文件只重启受影响的 Agent
+    agent_config_watcher = AgentConfigWatcher(on_change=agent_scheduler.reload_agents)
+    agent_config_watcher.check()
+    agent_config_task = asyncio.create_task(agent_config_watcher.run())
+    connection_manager.add_room_activity_listener(agent_scheduler.on_room_activity)
+    connection_manager.add_remote_broadcast_listener(on_remote_broadcast) # 其他 worker 上的发言也触发回复
+    leader_elector = create_leader_elector(backplane)
+    await leader_elector.start(agent_scheduler.set_leader)
     logger.info("AgentScheduler 初始化并启动完成。")
 
+    upload_store = UploadStore()
+
+    # 5. 过期消息归档 (多 worker 部署时只由 leader 执行)
+    if config.MESSAGE_RETENTION_DAYS > 0:
+        maintenance_task = asyncio.create_task(
+            message_archive.run_maintenance(message_repository, lambda: leader_elector.is_leader))
+
+async def build_search_index() -> bool:
+    """在数据库线程中为已有消息建立全文索引 (和消息写入串行执行，期间写入排队等待)，返回是否成功"""
+    started = time.perf_counter()
+    try:
+        await message_repository.run(rebuild_search_index, engine)
+    except Exception as e:
+        logger.error(f"建立全文索引失败，全文检索不可用 (可以运行 python tools/rebuild_search_index.py): {e}",
+                     exc_info=True)
+        return False
+    logger.info(f"全文索引建立完成，耗时 {time.perf_counter() - started:.1f}s")
+    return True
+
+def on_remote_broadcast(payload: dict, room_id: str):
+    """其他 worker 广播的聊天消息：交给 (可能是 leader 的) 本 worker 的 Agent 调度"""
+    if payload.get("type") == "message" and agent_scheduler:
+        agent_scheduler.notify_message(room_id, payload["sender"]["id"])
+
 # --- CORS 配置 ---
 # 定义允许的前端来源 (根据你的前端开发服务器地址修改)
 origins = [
@@ -67,6 +155,8 @@ origins = [
     # "http://your-frontend-domain.com",
 ]
 
+app.add_middleware(HTTPMetricsMiddleware) # 记录各 HTTP 接口的处理耗时
+
 app.add_middleware(
     CORSMiddleware,
     allow_origins=origins, # 允许指定的来源
@@ -77,42 +167,196 @@ app.add_middleware(
 
 
 # 创建用于存储上传文件的目录
-UPLOAD_DIR = "uploads"
+UPLOAD_DIR = config.UPLOAD_DIR
 os.makedirs(UPLOAD_DIR, exist_ok=True)
 
-# 挂载静态文件目录，用于访问上传的图片
-app.mount("/uploads", StaticFiles(directory=UPLOAD_DIR), name="uploads")
+# 挂载静态文件目录，用于访问上传的图片 (文件永不覆盖，返回 immutable 缓存头)
+app.mount("/uploads", ImmutableStaticFiles(directory=UPLOAD_DIR), name="uploads")
 
 # manager = ConnectionManager() # 不再在这里实例化，改为在 startup 事件中实例化并赋值给全局变量
 
+async def replay_missed_messages(user_id: str, room_id: str, last_seen_id: int):
+    """
+    向重连的客户端补发 id 大于 last_seen_id 的消息。
+    优先从最近消息缓存读取，缓存覆盖不到时回退到有上限的数据库范围查询，
+    重连风暴的代价与错过的消息数成正比，而不是每个客户端一次完整的历史查询。
+    """
+    limit = config.REPLAY_MAX_MESSAGES
+    # 多取一条用来判断是否还有更多
+    messages = message_cache.get_by_id(limit + 1, room_id, after_id=last_seen_id)
+    if messages is None or cache_misses_archive(messages, limit + 1, last_seen_id):
+        messages = await load_messages_by_id(limit + 1, None, last_seen_id, room_id)
+
+    complete = len(messages) <= limit
+    # 补发期间到达的新消息可能同时出现在补发和实时广播中，客户端按 id 去重
+    await connection_manager.send_personal_message({
+        "type": "replay",
+        "messages": messages[:limit],
+        "complete": complete # False 表示还有更多，客户端继续用 after_id 分页获取
+    }, user_id, room_id)
+    logger.debug(f"已向 {user_id} 补发 {min(len(messages), limit)} 条消息 (after_id={last_seen_id}, complete={complete})")
+
+
+def cache_misses_archive(cached: list[dict], limit: int, after_id: int | None) -> bool:
+    """
+    缓存以为自己包含了房间从头开始的全部消息 (所以会返回不满一页的结果)，
+    但主库之前的消息已经被归档，这时要改为查询主库和归档。
+    """
+    if not message_archive or not message_archive.max_id:
+        return False
+    return len(cached) < limit or (after_id is not None and after_id < message_archive.max_id)
+
+
+async def load_messages_by_id(limit: int, before_id: int | None, after_id: int | None, room_id: str) -> list[dict]:
+    """
+    缓存覆盖不到时的 id 游标分页：先查主库，翻过主库最早的消息时从归档继续读取。
+    返回按 id 升序排列的前端消息结构。
+    """
+    await message_writer.flush_all() # 先让排队中的消息落盘
+    archived: list[dict] = []
+    if after_id is not None and message_archive and message_archive.max_id > after_id:
+        # 向后翻页的起点在归档里：先读归档，不够再接着读主库
+        archived = await message_archive.get_messages_by_id(limit, before_id, after_id, room_id)
+        if archived:
+            after_id = archived[-1]["id"]
+    live: list[dict] = []
+    if len(archived) < limit:
+        history_messages = await message_repository.get_messages_by_id(limit - len(archived), before_id, after_id, room_id)
+        live = [msg.to_payload() for msg in history_messages]
+    if after_id is None and len(live) < limit and message_archive:
+        # 向前翻页翻过了主库最早的消息
+        archived = await message_archive.get_messages_by_id(
+            limit - len(live), live[0]["id"] if live else before_id, None, room_id)
+    # 归档过程中崩溃时同一条消息可能同时在主库和归档里
+    merged = {msg["id"]: msg for msg in archived + live}
+    return [merged[msg_id] for msg_id in sorted(merged)]
+
+
+async def load_recent_messages(limit: int, before_dt: datetime | None, room_id: str) -> list[dict]:
+    """缓存覆盖不到时的时间戳分页 (旧参数)：先查主库，翻过主库最早的消息时从归档继续读取，按时间正序返回"""
+    await message_writer.flush_all() # 先让排队中的消息落盘
+    history_messages = await message_repository.get_recent_messages(limit, before_dt, room_id)
+    live = [msg.to_payload() for msg in history_messages]
+    if len(live) < limit and message_archive and message_archive.has_room(room_id):
+        # 归档中的消息都早于主库最早的一条 (或者主库已经没有更早的消息)
+        oldest = history_messages[0].timestamp if history_messages else before_dt
+        if oldest is None:
+            oldest = datetime.now(timezone.utc)
+        archived = await message_archive.get_recent_messages(limit - len(live), oldest, room_id)
+        live_ids = {msg["id"] for msg in live}
+        live = [msg for msg in archived if msg["id"] not in live_ids] + live
+    return live
+
+
+def get_client_ip(websocket: WebSocket) -> str | None:
+    """客户端 IP (用于按 IP 限流)，部署在反向代理后面时取 X-Forwarded-For 的第一个地址"""
+    if config.RATE_LIMIT_TRUST_FORWARDED:
+        forwarded = websocket.headers.get("x-forwarded-for")
+        if forwarded:
+            return forwarded.split(",", 1)[0].strip()
+    return websocket.client.host if websocket.client else None
+
+
+def notify_rejected(conn: ClientConnection, reason: str, retry_after: float | None = None):
+    """告诉客户端消息被拒绝了 (限流时每轮只通知一次，不会因为刷屏产生更多下行帧)"""
+    message = {"type": "error", "code": reason}
+    if retry_after is not None:
+        message["retryAfter"] = retry_after
+    conn.enqueue(conn.codec.encode(message))
+
+
 # --- WebSocket 端点 --- (修改以使用全局 connection_manager)
 @app.websocket("/ws/{user_id}/{user_name}")
 async def websocket_endpoint(
     websocket: WebSocket,
     user_id: str,
     user_name: str,
-    db: Session = Depends(get_db)
+    room_id: str = Query(config.DEFAULT_ROOM_ID, description="要进入的聊天室"),
+    last_seen_id: Optional[int] = Query(None, description="重连时客户端最后收到的消息 id，服务器会补发之后的消息"),
+    codec: str = Query(DEFAULT_CODEC, description="帧编码: json (文本帧) 或 msgpack (二进制帧)"),
+    presence: str = Query("full", description="在线用户同步方式: full (完整的 user_list_update) 或 delta (带版本号的增量)"),
+    heartbeat: bool = Query(False, description="客户端会用 pong 回应服务器的 ping，长时间无响应的连接会被清理"),
+    batch: bool = Query(False, description="客户端能处理事件数组帧，服务器开启广播批量时同一 tick 内的广播合并为一帧")
 ):
     """
     处理 WebSocket 连接、接收消息、存储消息到数据库和广播消息。
     使用全局的 connection_manager。
     """
-    if not connection_manager:
-        logger.error("ConnectionManager 尚未初始化!")
+    if not connection_manager or not message_writer:
+        logger.error("ConnectionManager 或 MessageWriter 尚未初始化!")
         await websocket.close(code=1011) # 内部服务器错误
         return
+    if connection_manager.draining:
+        await websocket.close(code=1013) # 稍后再试：本实例正在排空，客户端应连接到其他实例
+        return
+    if room_id not in config.ROOMS and not config.ALLOW_UNLISTED_ROOMS:
+        logger.warning(f"用户 {user_id} 尝试进入不存在的房间 {room_id}")
+        await websocket.close(code=1008) # 策略违规
+        return
 
-    await connection_manager.connect(websocket, user_id, user_name)
-    await connection_manager.broadcast_user_list()
+    wire = get_codec(codec)
+    if wire is None:
+        logger.warning(f"用户 {user_id} 请求了不支持的编码 {codec}，可用: {list(CODECS)}")
+        await websocket.close(code=1003, reason=f"unsupported codec: {codec}") # 不支持的数据类型
+        return
+    if presence not in PRESENCE_MODES:
+        logger.warning(f"用户 {user_id} 请求了不支持的在线用户同步方式 {presence}")
+        await websocket.close(code=1003, reason=f"unsupported presence mode: {presence}")
+        return
 
-    # --- 不再在此处发送历史消息，改为通过 API 获取 ---
+    # 连接时会收到在线用户快照，房间内其他人在合并窗口结束时收到变化
+    conn = await connection_manager.connect(websocket, user_id, user_name, room_id, codec=wire,
+                                            presence_mode=presence, heartbeat=heartbeat, batch=batch)
+    if not message_cache.is_warmed(room_id):
+        await message_cache.warm_up(message_repository, room_id)
 
+    # --- 首次连接不发送历史消息 (通过 API 获取)；重连时直接补发错过的消息 ---
+    if last_seen_id is not None:
+        await replay_missed_messages(user_id, room_id, last_seen_id)
+
+    client_ip = get_client_ip(websocket)
+    throttled = False # 本轮限流是否已经通知过客户端
     try:
         while True:
-            data = await websocket.receive_json()
-            logger.info(f"收到来自 {user_id} ({user_name}) 的消息: {data}")
-
+            frame = await receive_frame(websocket)
+            conn.touch()
+            # 控制帧很短：短帧先解码，心跳不占用聊天消息的发送频率预算
+            data = None
+            if len(frame) <= config.WS_CONTROL_FRAME_MAX_SIZE:
+                try:
+                    data = wire.decode(frame)
+                except ValueError:
+                    pass # 交给下面的解码统一记录
+            control = isinstance(data, dict) and data.get("type") in CONTROL_FRAME_TYPES
+            # 先按帧大小和发送频率决定是否处理，超限的帧不解码 (长帧)、不写库、不广播
+            rejected = ingest_limiter.check_frame(user_id, client_ip, len(frame), control=control)
+            if rejected:
+                if rejected == "disconnect":
+                    logger.warning(f"用户 {user_id} ({client_ip}) 持续超出发送频率，断开连接")
+                    conn.close(close_code=1008)
+                elif not throttled:
+                    throttled = True
+                    notify_rejected(conn, rejected, ingest_limiter.retry_after(user_id, client_ip))
+                continue
+            if not control:
+                throttled = False
+            try:
+                if data is None:
+                    data = wire.decode(frame)
+            except ValueError as e:
+                logger.warning(f"收到来自 {user_id} 的无法解码的帧 ({wire.name}): {e}")
+                continue
+            if not isinstance(data, dict):
+                logger.warning(f"收到来自 {user_id} 的无效消息: {data!r}")
+                continue
             message_type = data.get("type")
+            if message_type == "pong":
+                continue
+            if message_type == "presence_sync": # 客户端发现在线用户版本号不连续，请求完整快照
+                connection_manager.send_presence_snapshot(user_id, room_id)
+                continue
+            logger.debug(f"收到来自 {user_id} ({user_name}) 的消息: {data}")
+
             content = data.get("content")
             msg_type_str = data.get("messageType", "TEXT").upper() # 获取并转大写
 
@@ -124,22 +368,22 @@ async def websocket_endpoint(
                 msg_type_enum = MessageTypeEnum.TEXT
 
             if message_type == "message":
+                rejected = ingest_limiter.check_content(content)
+                if rejected:
+                    notify_rejected(conn, rejected)
+                    continue
 
-                # --- 1. 存储消息到数据库 ---
-                db_message = MessageModel(
-                    sender_id=user_id,
-                    sender_name=user_name,
-                    content=content,
-                    message_type=msg_type_enum
-                    # timestamp 由数据库自动生成
-                )
+                # --- 1. 提交消息到写入管道 (write_behind 模式下立即返回，后台批量落盘) ---
                 try:
-                    db.add(db_message)
-                    db.commit()
-                    db.refresh(db_message) # 获取数据库生成的数据，如 id 和 timestamp
-                    logger.info(f"消息已存入数据库: ID={db_message.id}")
+                    db_message = await message_writer.submit(
+                        sender_id=user_id,
+                        sender_name=user_name,
+                        content=content,
+                        message_type=msg_type_enum,
+                        room_id=room_id
+                    )
+                    logger.debug(f"消息已提交写入: ID={db_message.id}")
                 except Exception as e:
-                    db.rollback() # 如果存储失败，回滚事务
                     logger.error(f"存储消息到数据库失败 for {user_id}: {e}", exc_info=True)
                     # 可以考虑通知发送者存储失败
                     # await websocket.send_json({"type": "error", "message": "消息存储失败"})
@@ -147,19 +391,14 @@ async def websocket_endpoint(
 
 
                 # --- 2. 构建要广播的消息体 (包含数据库生成的时间戳) ---
-                message_to_broadcast = {
-                    "type": "message",
-                    "content": db_message.content,
-                    "messageType": db_message.message_type.name,
-                    "sender": {"id": db_message.sender_id, "name": db_message.sender_name},
-                    "timestamp": db_message.timestamp.isoformat() + "Z" # 添加 ISO 格式的时间戳
-                }
+                message_to_broadcast = db_message.to_payload()
 
                 # --- 3. 广播消息给所有连接的客户端 --- (使用全局 manager)
-                await connection_manager.broadcast(message_to_broadcast)
+                await connection_manager.broadcast(message_to_broadcast, room_id)
 
-                # --- 4. AI Agent 触发点 --- (这里的 TODO 可以移除了，因为 Agent 是后台任务)
-                # (不再需要在这里显式触发 AI)
+                # --- 4. AI Agent 触发点：防抖后安排一个 Agent 回复 ---
+                if agent_scheduler:
+                    agent_scheduler.notify_message(room_id, user_id)
 
             else:
                 logger.warning(f"收到非 'message' 类型的消息: {data}")
@@ -167,68 +406,173 @@ async def websocket_endpoint(
     except WebSocketDisconnect:
         logger.info(f"用户 {user_id} ({user_name}) 断开连接")
         if connection_manager:
-            connection_manager.disconnect(websocket, user_id)
-            await connection_manager.broadcast_user_list()
+            connection_manager.disconnect(websocket, user_id, room_id)
         # user_name_disconnected = connection_manager.get_user_name(user_id) or "未知用户"
         # await connection_manager.broadcast_system_message(f"{user_name_disconnected} 离开了聊天")
     except Exception as e:
         logger.error(f"WebSocket 处理出错 for {user_id}: {e}", exc_info=True)
         if connection_manager:
-            connection_manager.disconnect(websocket, user_id)
-            await connection_manager.broadcast_user_list()
-    finally:
-        # 确保数据库会话在端点结束时关闭 (get_db 依赖项会自动处理)
-        pass
+            connection_manager.disconnect(websocket, user_id, room_id)
 
 
 # --- HTTP 端点 ---
 @app.post("/api/upload")
-async def upload_image(file: UploadFile = File(...), user_id: str = Form(...)):
+async def upload_image(request: Request):
     """
-    处理图片上传请求。
-    接收图片文件和用户 ID (来自表单)，保存到服务器，并返回图片的访问 URL。
-    使用 UUID 生成唯一文件名。
+    处理图片上传请求 (multipart 表单：file 为图片，user_id 为用户 ID)。
+    请求体边接收边校验，超过大小上限或文件头不是图片时立即拒绝；
+    文件按内容哈希保存，相同的图片只存一份，返回图片 (和缩略图) 的访问 URL。
     """
+    if not upload_store:
+        return JSONResponse({"success": False, "error": "服务尚未就绪"}, status_code=503)
     try:
-        # 从原始文件名中获取扩展名
-        original_filename = file.filename or ""
-        file_extension = os.path.splitext(original_filename)[1]
-        # 基本的文件类型验证 (可选，但推荐)
-        allowed_extensions = {".jpg", ".jpeg", ".png", ".gif"}
-        if file_extension.lower() not in allowed_extensions:
-            logger.warning(f"用户 {user_id} 上传了不支持的文件类型: {original_filename}")
-            return {"success": False, "error": f"不支持的文件类型: {file_extension}"}
-
-        # 生成唯一的 UUID 文件名，保留原始扩展名
-        unique_filename = f"{uuid.uuid4()}{file_extension}"
-        file_path = os.path.join(UPLOAD_DIR, unique_filename)
-
-        # 保存上传的文件
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
-
-        # 构建图片的访问 URL (相对路径)
-        file_url = f"/uploads/{unique_filename}"
-        logger.info(f"用户 {user_id} 成功上传图片: {original_filename} -> {unique_filename}, URL: {file_url}")
-
-        return {"success": True, "url": file_url}
+        result = await upload_store.receive(request)
+    except UploadError as e:
+        logger.warning(f"图片上传被拒绝: {e}")
+        return JSONResponse({"success": False, "error": str(e)}, status_code=e.status)
     except Exception as e:
-        logger.error(f"用户 {user_id} 图片上传失败: {e}", exc_info=True)
-        return {"success": False, "error": f"服务器内部错误: {str(e)}"}
-    finally:
-        # 确保文件对象被关闭
-        if hasattr(file, 'file') and not file.file.closed:
-            await file.close() # 对于 UploadFile，使用 await file.close()
+        logger.error(f"图片上传失败: {e}", exc_info=True)
+        return JSONResponse({"success": False, "error": "服务器内部错误"}, status_code=500)
+
+    logger.info(f"用户 {result['user_id']} 上传图片 {result['url']} ({result['size']} 字节"
+                f"{'，已存在' if result['deduplicated'] else ''})")
+    return {"success": True, **result}
 
 
 @app.get("/api/users")
-async def get_active_users():
+async def get_active_users(room_id: str = Query(config.DEFAULT_ROOM_ID, description="聊天室")):
     """
-    获取当前在线用户列表。
+    获取聊天室当前在线用户列表。
     """
     if not connection_manager:
         return [] # 或者返回错误
-    return connection_manager.get_active_users_list()
+    return connection_manager.get_active_users_list(room_id)
+
+
+@app.get("/api/rooms")
+async def get_rooms():
+    """
+    获取配置的聊天室和当前有人的聊天室，以及各自的在线人数和 Agent。
+    """
+    active_rooms = connection_manager.get_active_rooms() if connection_manager else {}
+    room_ids = list(config.ROOMS) + [room_id for room_id in active_rooms if room_id not in config.ROOMS]
+    return [{
+        "id": room_id,
+        "name": config.ROOMS.get(room_id, {}).get("name", room_id),
+        "online": active_rooms.get(room_id, 0),
+        "agents": agent_scheduler.get_room_agents(room_id) if agent_scheduler else [],
+    } for room_id in room_ids]
+
+
+@app.get("/api/connections")
+async def get_connection_stats(room_id: Optional[str] = Query(None, description="只查看指定聊天室")):
+    """
+    获取每个连接的发送队列深度和丢帧计数 (用于排查慢客户端)。
+    """
+    if not connection_manager:
+        return []
+    return connection_manager.get_connection_stats(room_id)
+
+
+@app.get("/api/models")
+async def get_model_stats():
+    """
+    获取每个模型的调用次数、重试/对冲次数、延迟分位数和断路器状态。
+    """
+    if not agent_manager:
+        return {}
+    return agent_manager.model_client.get_stats()
+
+
+def collect_app_metrics() -> list:
+    """抓取时才读取的指标：写入管道积压、模型客户端的重试/对冲/断路器状态"""
+    collected = []
+    if ingest_limiter:
+        buckets = Gauge("chat_rate_limit_buckets", "限流器中保留的令牌桶数", ["scope"])
+        buckets.labels("user").set(len(ingest_limiter.users))
+        buckets.labels("ip").set(len(ingest_limiter.ips))
+        collected.append(buckets)
+    if message_writer:
+        pending = Gauge("chat_db_pending_messages", "写入管道中还没有落盘的消息数")
+        pending.set(message_writer.pending_count)
+        collected.append(pending)
+    if agent_manager:
+        collected.extend(agent_manager.model_client.collect_metrics())
+    if agent_scheduler:
+        wasted = Gauge("chat_agent_speculative_wasted_last_hour",
+                       f"最近一小时浪费的提前生成调用数 (达到 {config.AGENT_SPECULATIVE_MAX_WASTED_PER_HOUR} 时暂停提前生成)")
+        wasted.set(len(agent_scheduler.speculative_waste))
+        collected.append(wasted)
+    if agent_manager and config.AGENT_DIRECTOR:
+        saved = Gauge("chat_agent_director_saved_last_hour", "最近一小时导演模式节省的模型调用数和输入 token 数", ["kind"])
+        saved_calls, saved_tokens = agent_manager.director_savings_last_hour()
+        saved.labels("calls").set(saved_calls)
+        saved.labels("prompt_tokens").set(saved_tokens)
+        collected.append(saved)
+    return collected
+
+REGISTRY.add_collector(collect_app_metrics)
+
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    Prometheus 文本格式的指标 (本 worker 的连接数、广播耗时、写入延迟、接口延迟、模型调用等)。
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/api/health")
+async def health_check():
+    """
+    健康检查：排空中返回 503，负载均衡器据此不再把新连接分配到本实例。
+    """
+    if connection_manager is None or connection_manager.draining:
+        return JSONResponse({"status": "draining" if connection_manager else "starting"}, status_code=503)
+    return {"status": "ok"}
+
+
+def require_admin(request: Request):
+    """管理接口的鉴权：配置了 ADMIN_TOKEN 时校验 Bearer 令牌，否则只允许本机访问"""
+    if config.ADMIN_TOKEN:
+        if request.headers.get("authorization") != f"Bearer {config.ADMIN_TOKEN}":
+            raise HTTPException(status_code=401, detail="无效的管理令牌")
+    elif not request.client or request.client.host not in ("127.0.0.1", "::1", "localhost", "testclient"):
+        raise HTTPException(status_code=403, detail="未配置 CHAT_ADMIN_TOKEN 时只允许本机访问")
+
+
+@app.post("/api/admin/drain", dependencies=[Depends(require_admin)])
+async def drain(spread: float = Query(config.DRAIN_RECONNECT_SPREAD, ge=0, description="重连错开的时间范围 (秒)"),
+                all_workers: bool = Query(True, description="多 worker 部署时同时排空其他 worker")):
+    """
+    发布新版本前调用：不再接受新连接，把写入管道中的消息落盘，
+    然后通知所有客户端在 spread 秒内错开重连。
+    (进程收到 SIGTERM 后 uvicorn 会先关闭所有 WebSocket 再执行 shutdown，来不及错开重连，所以排空要在停止进程之前触发)
+    """
+    if not connection_manager or not message_writer:
+        raise HTTPException(status_code=503, detail="服务尚未启动")
+    notified, flushed = await drain_worker(spread)
+    if all_workers and backplane:
+        backplane.publish({"kind": "drain", "spread": spread})
+    result = {"draining": True, "connections": notified, "flushed": flushed, "pending": message_writer.pending_count}
+    if not flushed:
+        # 排空照常进行，但这时重启会丢失已确认的消息：返回错误让发布脚本停下来
+        return JSONResponse({**result, "error": "待写入的消息未能全部落盘，请确认数据库可写后再重启"}, status_code=500)
+    return result
+
+
+async def drain_worker(spread: float) -> tuple[int, bool]:
+    """
+    排空本 worker：先拒绝新连接，把写入管道中的消息落盘，再通知客户端错开重连。
+    管理接口和其他 worker 发起的排空 (backplane 的 drain 事件) 都走这里。返回 (收到提示的连接数, 是否全部落盘)。
+    """
+    connection_manager.draining = True
+    flushed = await message_writer.flush_all()
+    if not flushed:
+        logger.error(f"排空时仍有 {message_writer.pending_count} 条消息未能落盘，重启前请确认数据库可写")
+    notified = connection_manager.drain(spread)
+    logger.warning(f"已进入排空模式：{notified} 个连接将在 {spread} 秒内重连，待写入消息{'已' if flushed else '未能全部'}落盘")
+    return notified, flushed
 
 
 # --- 应用关闭事件 ---
@@ -236,58 +580,181 @@ async def get_active_users():
 async def on_shutdown():
     global agent_scheduler
     logger.info("应用程序关闭...")
+    if leader_elector:
+        await leader_elector.stop() # 释放 leader 租约，其他 worker 可以立即接管
     if agent_scheduler:
         await agent_scheduler.stop_all_agents()
         logger.info("Agent 任务已停止。")
-    # 清理 HTTP 客户端 (如果 AgentManager 中有)
-    if agent_manager and hasattr(agent_manager, 'http_client'):
-        await agent_manager.http_client.aclose()
+    if presence_heartbeat_task:
+        presence_heartbeat_task.cancel()
+    if reaper_task:
+        reaper_task.cancel()
+    if maintenance_task:
+        maintenance_task.cancel()
+    if agent_config_task:
+        agent_config_task.cancel()
+    if connection_manager:
+        connection_manager.close_all()
+    if backplane:
+        await backplane.stop()
+    # 清理模型客户端的连接池
+    if agent_manager:
+        await agent_manager.prompt_builder.stop()
+        await agent_manager.model_client.aclose()
         logger.info("HTTP 客户端已关闭。")
+    # 先把写入管道中剩余的消息落盘，再等待排队中的数据库操作完成
+    if message_writer and not await message_writer.stop():
+        logger.critical("关闭时有消息未能写入数据库，已经广播的这些消息丢失")
+    if message_repository:
+        message_repository.close()
+    if upload_store:
+        upload_store.close()
 
 
-# --- 新增：获取历史消息 API --- (时间戳分页)
+# --- 新增：获取历史消息 API --- (id 游标分页，兼容旧的时间戳分页)
 @app.get("/api/messages", response_model=List[dict]) # 定义响应模型
 async def get_history_messages(
-    before_timestamp: Optional[str] = Query(None, description="ISO 格式的时间戳，用于获取此时间之前的消息"),
-    limit: int = Query(30, gt=0, le=100, description="每次加载的消息数量"), # 限制每次最多100条
-    db: Session = Depends(get_db)
+    before_id: Optional[int] = Query(None, description="获取 id 小于此值的最近消息 (向前翻页)"),
+    after_id: Optional[int] = Query(None, description="获取 id 大于此值的最早消息 (向后翻页)"),
+    before_timestamp: Optional[str] = Query(None, description="ISO 格式的时间戳，用于获取此时间之前的消息 (旧参数，建议改用 before_id)"),
+    room_id: str = Query(config.DEFAULT_ROOM_ID, description="聊天室"),
+    limit: int = Query(30, gt=0, le=100, description="每次加载的消息数量") # 限制每次最多100条
 ):
     """
-    获取历史聊天记录，支持基于时间戳的分页。
-    返回按时间升序排列的消息列表。
+    获取历史聊天记录，支持基于消息 id 的游标分页 (before_id / after_id)。
+    时间戳只有秒级精度，同一秒内的消息会在翻页时被跳过或重复，before_timestamp 仅为兼容保留。
+    返回按 id (时间) 升序排列的消息列表。
     """
-    query = db.query(MessageModel)
+    if not message_repository or not message_cache or not message_writer:
+        return []
 
+    if before_id is not None or after_id is not None:
+        results = message_cache.get_by_id(limit, room_id, before_id=before_id, after_id=after_id)
+        if results is None or cache_misses_archive(results, limit, after_id):
+            results = await load_messages_by_id(limit, before_id, after_id, room_id)
+        logger.debug(f"返回房间 {room_id} 的 {len(results)} 条历史消息 (limit={limit}, before_id={before_id}, after_id={after_id})")
+        return results
+
+    before_dt = None
     if before_timestamp:
         try:
             # 将 ISO 格式字符串解析为带时区的 datetime 对象
             before_dt = datetime.fromisoformat(before_timestamp.replace('Z', '+00:00'))
-            # 查询时间戳早于指定时间的消息
-            query = query.filter(MessageModel.timestamp < before_dt)
         except ValueError:
             logger.warning(f"无效的时间戳格式: {before_timestamp}")
             # 可以选择返回错误或忽略此参数
             return [] # 返回空列表
 
-    # 按时间戳降序排序，获取最近的 N 条
-    history_messages_desc = query.order_by(desc(MessageModel.timestamp)).limit(limit).all()
-
-    # 将结果转换为字典列表，并按时间升序返回给前端
-    results = []
-    for msg in reversed(history_messages_desc): # 反转列表以获得升序
-        results.append({
-            "type": "message", # 保持和 WebSocket 消息一致的结构
-            "content": msg.content,
-            "messageType": msg.message_type.name,
-            "sender": {"id": msg.sender_id, "name": msg.sender_name},
-            "timestamp": msg.timestamp.isoformat() + "Z" # 使用 ISO 格式
-        })
-    logger.info(f"返回 {len(results)} 条历史消息 (limit={limit}, before={before_timestamp})")
+    # 获取最近的 N 条 (已按时间升序排列)，和 WebSocket 消息结构一致
+    # 前几页直接由最近消息缓存提供，翻到缓存之外时才查询数据库
+    results = message_cache.get_recent(limit, room_id, before_dt=before_dt)
+    if results is None:
+        results = await load_recent_messages(limit, before_dt, room_id)
+    logger.debug(f"返回 {len(results)} 条历史消息 (limit={limit}, before={before_timestamp})")
     return results
 
 
+@app.get("/api/search")
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=config.SEARCH_MAX_QUERY_LENGTH, description="检索词，多个词用空格分隔 (需要同时包含)"),
+    room_id: str = Query(config.DEFAULT_ROOM_ID, description="聊天室"),
+    sender_id: Optional[str] = Query(None, description="只检索该用户发送的消息"),
+    message_type: Optional[str] = Query(None, description="只检索该类型的消息 (TEXT / IMAGE / SYSTEM)"),
+    after: Optional[str] = Query(None, description="ISO 格式的时间戳，只检索此时间及之后的消息"),
+    before: Optional[str] = Query(None, description="ISO 格式的时间戳，只检索此时间之前的消息"),
+    sort: str = Query("relevance", pattern="^(relevance|recent)$", description="relevance: 按相关度排序；recent: 按时间倒序"),
+    limit: int = Query(20, gt=0, le=100, description="每页结果数"),
+    offset: int = Query(0, ge=0, le=config.SEARCH_MAX_OFFSET, description="跳过的结果数 (翻页)")
+):
+    """
+    全文检索聊天记录 (SQLite FTS5 trigram 索引，支持中文子串匹配)。
+    返回 {"results": [消息...], "nextOffset": 下一页的 offset 或 null}。
+    """
+    if not message_repository or not message_writer:
+        return JSONResponse({"error": "服务尚未就绪"}, status_code=503)
+    if not search_available:
+        return JSONResponse({"error": "全文检索未启用"}, status_code=503)
+    if search_index_task and not (search_index_task.done() and search_index_task.result()):
+        # 索引还没有覆盖已有的消息，返回空结果会被当成 "没有匹配"
+        return JSONResponse({"error": "全文索引正在建立，暂时无法检索" if not search_index_task.done()
+                             else "全文索引建立失败，暂时无法检索"}, status_code=503)
+
+    msg_type_enum = None
+    if message_type:
+        try:
+            msg_type_enum = MessageTypeEnum[message_type.upper()]
+        except KeyError:
+            return JSONResponse({"error": f"无效的消息类型: {message_type}"}, status_code=400)
+    try:
+        after_dt = datetime.fromisoformat(after.replace('Z', '+00:00')) if after else None
+        before_dt = datetime.fromisoformat(before.replace('Z', '+00:00')) if before else None
+    except ValueError:
+        return JSONResponse({"error": "无效的时间戳格式"}, status_code=400)
+
+    await message_writer.flush_all() # 排队中的消息落盘后才会进入索引
+    # 多取一条用来判断是否还有下一页
+    found = await message_repository.search_messages(q, room_id, sender_id, msg_type_enum, after_dt, before_dt,
+                                                     sort, limit + 1, offset)
+    has_more = len(found) > limit and offset + limit <= config.SEARCH_MAX_OFFSET
+    logger.debug(f"房间 {room_id} 检索 {q!r} 返回 {min(len(found), limit)} 条结果 (offset={offset})")
+    return {
+        "results": [msg.to_payload() for msg in found[:limit]],
+        "nextOffset": offset + limit if has_more else None,
+    }
+
+
+@app.get("/api/export", dependencies=[Depends(require_admin)])
+async def export_messages(
+    format: str = Query("ndjson", pattern="^(ndjson|csv)$", description="ndjson: 每行一个 JSON 对象；csv: 带表头 (续传时不重复表头)"),
+    compression: str = Query("none", pattern="^(none|gzip|zstd)$", description="压缩方式 (zstd 需要安装 zstandard)"),
+    room_id: Optional[str] = Query(None, description="只导出该聊天室的消息 (默认全部聊天室)"),
+    sender_id: Optional[List[str]] = Query(None, description="只导出这些用户发送的消息 (可重复)"),
+    message_type: Optional[List[str]] = Query(None, description="只导出这些类型的消息 (TEXT / IMAGE / SYSTEM，可重复)"),
+    after: Optional[str] = Query(None, description="ISO 格式的时间戳，只导出此时间及之后的消息"),
+    before: Optional[str] = Query(None, description="ISO 格式的时间戳，只导出此时间之前的消息"),
+    after_id: int = Query(0, ge=0, description="只导出 id 大于此值的消息 (续传时传入已收到的最后一条的 id)"),
+    until_id: Optional[int] = Query(None, ge=0, description="只导出 id 不大于此值的消息 (续传时传入首次响应的 X-Export-Until-Id)")
+):
+    """
+    按 id 升序流式导出聊天记录 (包括已归档的消息)，内存占用与导出的行数无关。
+    导出范围在开始时固定，响应头 X-Export-Until-Id 是本次导出的 id 上界。
+    压缩时每 EXPORT_BATCH_SIZE 行是一个完整的 gzip member / zstd frame，连接中断后已收到的完整部分可以直接解压。
+    导出全部聊天室的历史记录，所以和其他管理接口一样需要鉴权。
+    """
+    if not message_writer:
+        return JSONResponse({"error": "服务尚未就绪"}, status_code=503)
+    try:
+        types = [MessageTypeEnum[value.upper()].name for value in message_type or []]
+    except KeyError as e:
+        return JSONResponse({"error": f"无效的消息类型: {e.args[0]}"}, status_code=400)
+    try:
+        after_dt = datetime.fromisoformat(after.replace('Z', '+00:00')) if after else None
+        before_dt = datetime.fromisoformat(before.replace('Z', '+00:00')) if before else None
+    except ValueError:
+        return JSONResponse({"error": "无效的时间戳格式"}, status_code=400)
+    try:
+        export = MessageExport(DATABASE_FILE, message_archive, fmt=format, compression=compression, room_id=room_id,
+                               sender_ids=sender_id, message_types=types, after_dt=after_dt, before_dt=before_dt,
+                               after_id=after_id, until_id=until_id)
+    except ExportError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+
+    await message_writer.flush_all() # 排队中的消息先落盘，导出范围才完整
+    await asyncio.to_thread(export.prepare)
+    filename = f"messages-{after_id}-{export.until_id}.{export.extension}"
+    logger.info(f"开始导出 {filename} (room_id={room_id}, sender_id={sender_id}, message_type={types}, "
+                f"after={after}, before={before})")
+    return StreamingResponse(export.stream(), media_type=export.media_type, headers={
+        "Content-Disposition": f'attachment; filename="{filename}"',
+        "X-Export-Until-Id": str(export.until_id),
+    })
+
+
 # --- 用于本地开发运行 ---
 if __name__ == "__main__":
     # 注意：生产环境应使用 Gunicorn + Uvicorn worker
-    # 例如: gunicorn main:app --workers 4 --worker-class uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000
-    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True) # 添加 reload=True 以便开发时自动重启
+    # 例如: CHAT_BACKPLANE=sqlite gunicorn main:app --workers 4 --worker-class uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000
+    # 多 worker 时必须设置 CHAT_BACKPLANE=sqlite，否则各 worker 之间的用户互相看不到消息
+    uvicorn.run("main:app", host="0.0.0.0", port=8000, reload=True, # 添加 reload=True 以便开发时自动重启
+                ws=DEFLATE_PROTOCOL, ws_per_message_deflate=config.WS_PER_MESSAGE_DEFLATE,
+                ws_max_size=config.WS_MAX_SIZE)
@@ -0,0 +1,272 @@
+# backend/message_archive.py
+"""
+消息保留与归档。
+
+超过保留期的消息按月份移动到 archive/messages-YYYY-MM.db (表结构与 messages 相同的独立 SQLite 文件)，
+主库只保留最近的消息，查询、备份和全文索引都随之变小。归档文件按 (room_id, id) 和 (room_id, timestamp) 建了索引，
+/api/messages 翻页 (id 游标和旧的时间戳参数) 翻过主库最早的消息时直接从归档中继续读取，客户端无感知。
+已归档的消息不再出现在全文检索 (/api/search) 的结果中。
+
+每批只移动 ARCHIVE_BATCH_SIZE 条，在数据库线程中执行，批次之间暂停，不会长时间占用主库的写锁。
+先写归档再删除主库，中途崩溃时下次会重新归档同一批 (INSERT OR IGNORE)，读取时按 id 去重。
+"""
+import asyncio
+import glob
+import logging
+import os
+import sqlite3
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Dict
+from sqlalchemy import func, text
+from database import SessionLocal
+from models import Message as MessageModel, MessageTypeEnum
+from repository import MessageRepository
+import config
+
+logger = logging.getLogger(__name__)
+
+_SHARD_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS messages (
+        id INTEGER PRIMARY KEY,
+        room_id VARCHAR NOT NULL,
+        sender_id VARCHAR NOT NULL,
+        sender_name VARCHAR NOT NULL,
+        content VARCHAR NOT NULL,
+        message_type VARCHAR NOT NULL,
+        timestamp DATETIME NOT NULL)""",
+    "CREATE INDEX IF NOT EXISTS ix_messages_room_id_id ON messages (room_id, id)",
+    "CREATE INDEX IF NOT EXISTS ix_messages_room_id_timestamp ON messages (room_id, timestamp)", # 按时间戳翻页
+]
+_COLUMNS = "id, room_id, sender_id, sender_name, content, message_type, timestamp"
+
+
+class MessageArchive:
+    """按月分片的归档文件：负责把过期消息从主库移走，以及按 id 游标读取归档中的消息"""
+    def __init__(self, root: str = config.ARCHIVE_DIR):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self._lock = threading.Lock() # 保护 _ranges (归档在数据库线程中写，读取在其他线程中)
+        self._ranges: Dict[str, tuple[int, int]] = {} # 分片路径 -> (最小 id, 最大 id)
+        self._room_ids: set[str] = set() # 有归档消息的房间 (归档只增不减)
+        for path in glob.glob(os.path.join(root, "messages-*.db")):
+            self._refresh_range(path)
+        self._warned_auto_vacuum = False
+
+    # --- 分片 ---
+    def _shard_path(self, timestamp: datetime) -> str:
+        return os.path.join(self.root, f"messages-{timestamp:%Y-%m}.db")
+
+    def _connect(self, path: str) -> sqlite3.Connection:
+        conn = sqlite3.connect(path, timeout=5.0)
+        for ddl in _SHARD_SCHEMA:
+            conn.execute(ddl)
+        return conn
+
+    def _refresh_range(self, path: str):
+        conn = self._connect(path)
+        try:
+            low, high = conn.execute("SELECT min(id), max(id) FROM messages").fetchone()
+            room_ids = {row[0] for row in conn.execute("SELECT DISTINCT room_id FROM messages")}
+        finally:
+            conn.close()
+        with self._lock:
+            self._room_ids |= room_ids
+            if low is None:
+                self._ranges.pop(path, None)
+            else:
+                self._ranges[path] = (low, high)
+
+    @property
+    def max_id(self) -> int:
+        """归档中最大的消息 id，没有归档时为 0"""
+        with self._lock:
+            return max((high for _, high in self._ranges.values()), default=0)
+
+    def has_room(self, room_id: str) -> bool:
+        """该房间是否有消息已经被归档 (主库中的消息不是它的全部历史)"""
+        with self._lock:
+            return room_id in self._room_ids
+
+    def shard_ranges(self, after_dt: datetime | None = None, before_dt: datetime | None = None) -> list[tuple[str, int, int]]:
+        """
+        归档分片的 (路径, 最小 id, 最大 id)，按 id 升序。
+        给出时间范围 [after_dt, before_dt) (UTC，不带时区) 时跳过整个月份都不在范围内的分片。
+        """
+        with self._lock:
+            ranges = sorted(((path, low, high) for path, (low, high) in self._ranges.items()), key=lambda item: item[1])
+        if after_dt is None and before_dt is None:
+            return ranges
+        selected = []
+        for path, low, high in ranges:
+            month = datetime.strptime(os.path.basename(path), "messages-%Y-%m.db")
+            next_month = month.replace(year=month.year + month.month // 12, month=month.month % 12 + 1)
+            if (after_dt is not None and next_month <= after_dt) or (before_dt is not None and month >= before_dt):
+                continue
+            selected.append((path, low, high))
+        return selected
+
+    # --- 归档 (在数据库线程中执行) ---
+    def archive_batch_sync(self, cutoff: datetime, batch_size: int) -> int:
+        """把最早的一批早于 cutoff 的消息移到归档文件，返回移动的条数"""
+        db = SessionLocal()
+        try:
+            # 永远保留最新的一条：SQLite 按 max(id)+1 分配 id，主库清空后 id 会从头开始，和归档冲突
+            max_id = db.query(func.max(MessageModel.id)).scalar() or 0
+            rows = db.query(MessageModel).filter(MessageModel.timestamp < cutoff, MessageModel.id < max_id) \
+                .order_by(MessageModel.id).limit(batch_size).all()
+            if not rows:
+                return 0
+
+            by_shard: Dict[str, list[tuple]] = defaultdict(list)
+            for msg in rows:
+                by_shard[self._shard_path(msg.timestamp)].append((
+                    msg.id, msg.room_id, msg.sender_id, msg.sender_name, msg.content,
+                    msg.message_type.name, msg.timestamp.isoformat(" ")))
+            for path, shard_rows in by_shard.items():
+                conn = self._connect(path)
+                try:
+                    conn.executemany(f"INSERT OR IGNORE INTO messages ({_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     shard_rows)
+                    conn.commit()
+                finally:
+                    conn.close()
+                self._refresh_range(path)
+
+            # 归档已经落盘，再从主库删除 (全文索引由触发器同步删除)
+            ids = [msg.id for msg in rows]
+            db.query(MessageModel).filter(MessageModel.id.in_(ids)).delete(synchronize_session=False)
+            db.commit()
+            return len(rows)
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def compact_sync(self) -> int:
+        """
+        归还一部分空闲页 (incremental_vacuum) 并更新查询规划器的统计信息，返回剩余的空闲页数。
+        每次只归还 VACUUM_PAGES_PER_STEP 页，避免长时间占用写锁。
+        """
+        db = SessionLocal()
+        try:
+            if db.execute(text("PRAGMA auto_vacuum")).scalar() != 2: # 2 = INCREMENTAL
+                if not self._warned_auto_vacuum:
+                    self._warned_auto_vacuum = True
+                    logger.warning("chat.db 未启用 auto_vacuum=INCREMENTAL，归档后的空间不会归还给文件系统，"
+                                   "请在停服时运行一次 python tools/archive_messages.py --vacuum。")
+                remaining = 0
+            else:
+                # incremental_vacuum 每执行一步归还一页，sqlite3 的 execute 只执行一步，executescript 才会执行完
+                db.connection().connection.executescript(f"PRAGMA incremental_vacuum({config.VACUUM_PAGES_PER_STEP});")
+                remaining = db.execute(text("PRAGMA freelist_count")).scalar()
+            db.execute(text("PRAGMA optimize")) # 只对统计信息过时的表和索引执行 ANALYZE
+            db.commit()
+            return remaining
+        finally:
+            db.close()
+
+    async def run_once(self, repository: MessageRepository, retention_days: int = config.MESSAGE_RETENTION_DAYS) -> int:
+        """执行一轮归档和压缩，返回归档的消息数"""
+        # 和 server_default=func.now() 一致，时间戳按 UTC 存储，不带时区
+        cutoff = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=retention_days)
+        total = 0
+        while True:
+            moved = await repository.run(self.archive_batch_sync, cutoff, config.ARCHIVE_BATCH_SIZE)
+            total += moved
+            if moved < config.ARCHIVE_BATCH_SIZE:
+                break
+            await asyncio.sleep(config.ARCHIVE_BATCH_PAUSE) # 让出写锁给正常的消息写入
+        while await repository.run(self.compact_sync):
+            await asyncio.sleep(config.ARCHIVE_BATCH_PAUSE)
+        if total:
+            logger.info(f"已归档 {total} 条早于 {cutoff:%Y-%m-%d %H:%M} 的消息")
+        return total
+
+    async def run_maintenance(self, repository: MessageRepository, should_run: Callable[[], bool] = lambda: True):
+        """后台维护任务：定期归档过期消息 (多 worker 部署时只由 leader 执行)"""
+        while True:
+            await asyncio.sleep(config.ARCHIVE_INTERVAL)
+            if not should_run():
+                continue
+            try:
+                await self.run_once(repository)
+            except Exception as e:
+                logger.error(f"归档消息出错: {e}", exc_info=True)
+
+    # --- 读取 ---
+    def _get_messages_by_id_sync(self, limit: int, before_id: int | None, after_id: int | None,
+                                 room_id: str) -> list[Dict[str, Any]]:
+        ascending = after_id is not None
+        with self._lock:
+            # 向后翻页从最早的分片往后读，向前翻页从最新的分片往前读
+            ranges = sorted(self._ranges.items(), key=lambda item: item[1][0] if ascending else -item[1][1])
+        # 分片按月份 (消息时间戳) 划分，时间戳和 id 不严格同序时 (进程内分配的时间戳、补写的旧消息) 分片的 id 区间会重叠：
+        # 每个和游标区间重叠的分片都要查询，合并后再截取 limit 条，不能凑够 limit 条就停
+        found: Dict[int, tuple] = {}
+        for path, (low, high) in ranges:
+            if (before_id is not None and low >= before_id) or (after_id is not None and high <= after_id):
+                continue
+            if len(found) >= limit:
+                ids = sorted(found, reverse=not ascending)
+                if (low > ids[limit - 1]) if ascending else (high < ids[limit - 1]):
+                    break # 剩下的分片都在已找到的 limit 条之外
+            conditions, params = ["room_id = ?"], [room_id]
+            if before_id is not None:
+                conditions.append("id < ?")
+                params.append(before_id)
+            if after_id is not None:
+                conditions.append("id > ?")
+                params.append(after_id)
+            order = "ASC" if after_id is not None else "DESC"
+            conn = sqlite3.connect(path, timeout=5.0)
+            try:
+                for row in conn.execute(
+                        f"SELECT {_COLUMNS} FROM messages WHERE {' AND '.join(conditions)} ORDER BY id {order} LIMIT ?",
+                        (*params, limit)).fetchall():
+                    found[row[0]] = row # 崩溃后重新归档的同一条消息只保留一份
+            finally:
+                conn.close()
+        ids = sorted(found)
+        ids = ids[:limit] if ascending else ids[-limit:]
+        return [MessageModel(id=row[0], room_id=row[1], sender_id=row[2], sender_name=row[3], content=row[4],
+                             message_type=MessageTypeEnum[row[5]], timestamp=datetime.fromisoformat(row[6])
+                             ).to_payload() for row in (found[message_id] for message_id in ids)]
+
+    async def get_messages_by_id(self, limit: int, before_id: int | None = None, after_id: int | None = None,
+                                 room_id: str = config.DEFAULT_ROOM_ID) -> list[Dict[str, Any]]:
+        """归档中基于 id 的游标分页，语义同 MessageRepository.get_messages_by_id，返回前端消息结构"""
+        if not self._ranges:
+            return []
+        return await asyncio.to_thread(self._get_messages_by_id_sync, limit, before_id, after_id, room_id)
+
+    def _get_recent_messages_sync(self, count: int, before_dt: datetime, room_id: str) -> list[Dict[str, Any]]:
+        # 和写入时一样用 isoformat(" ") 比较：微秒为 0 时两边都省略小数部分，按字符串比较的结果和按时间比较一致
+        before = before_dt.isoformat(" ")
+        # 分片按月份划分，时间上互不重叠：从最新的月份往前读，凑够 count 条后更早的分片不会有更新的消息
+        shards = sorted((path for path, _, _ in self.shard_ranges(before_dt=before_dt)), reverse=True)
+        found: list[tuple] = []
+        for path in shards:
+            if len(found) >= count:
+                break
+            conn = sqlite3.connect(path, timeout=5.0)
+            try:
+                found.extend(conn.execute(
+                    f"SELECT {_COLUMNS} FROM messages WHERE room_id = ? AND timestamp < ? "
+                    f"ORDER BY timestamp DESC, id DESC LIMIT ?", (room_id, before, count - len(found))).fetchall())
+            finally:
+                conn.close()
+        return [MessageModel(id=row[0], room_id=row[1], sender_id=row[2], sender_name=row[3], content=row[4],
+                             message_type=MessageTypeEnum[row[5]], timestamp=datetime.fromisoformat(row[6])
+                             ).to_payload() for row in reversed(found)]
+
+    async def get_recent_messages(self, count: int, before_dt: datetime,
+                                  room_id: str = config.DEFAULT_ROOM_ID) -> list[Dict[str, Any]]:
+        """归档中早于 before_dt 的最近 count 条消息 (旧的时间戳分页)，按时间正序返回前端消息结构"""
+        if before_dt.tzinfo is not None:
+            before_dt = before_dt.astimezone(timezone.utc).replace(tzinfo=None) # 归档中是不带时区的 UTC 时间
+        if not self.has_room(room_id):
+            return []
+        return await asyncio.to_thread(self._get_recent_messages_sync, count, before_dt, room_id)
@@ -0,0 +1,157 @@
+# backend/message_cache.py
+import logging
+from collections import deque
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict
+from models import Message as MessageModel
+from repository import MessageRepository
+import config
+
+logger = logging.getLogger(__name__)
+
+class RecentMessageCache:
+    """
+    每个房间最近消息的环形缓冲区。
+    缓存的是已经转换好的前端消息结构，Agent 上下文和历史消息的前几页直接从这里读取，
+    只有翻到缓冲区之外的历史时才查询数据库。
+    只有有人在线 (或配置了 Agent) 的房间才有缓冲区：读取不会为没见过的房间分配缓冲区，
+    未配置的房间所有人离开后释放 (房间名由客户端决定，不释放的话内存没有上限)。
+    """
+    def __init__(self, capacity: int = config.RECENT_MESSAGE_CACHE_SIZE,
+                 has_archive: Callable[[str], bool] = lambda room_id: False):
+        self.capacity = capacity
+        self.has_archive = has_archive # 房间是否有已归档的消息：有的话主库里的消息不是全部历史
+        # room_id -> deque[(消息 id, 时间戳, 消息结构)]，按时间正序
+        self._rooms: Dict[str, deque[tuple[int, datetime, Dict[str, Any]]]] = {}
+        # room_id -> 缓冲区是否包含该房间的全部历史 (消息总数不足容量时)
+        self._complete: Dict[str, bool] = {}
+        self._warmed: set[str] = set() # 已经从数据库加载过的房间
+
+    def _get_room(self, room_id: str) -> deque:
+        room = self._rooms.get(room_id)
+        if room is None:
+            room = self._rooms[room_id] = deque(maxlen=self.capacity)
+            # 还没从数据库加载过，不知道更早的历史，只能作为最新消息的连续后缀使用
+            self._complete[room_id] = False
+        return room
+
+    def is_warmed(self, room_id: str) -> bool:
+        return room_id in self._warmed
+
+    def on_room_activity(self, room_id: str, active: bool):
+        """房间活跃状态变化的回调：未配置的房间 (所有 worker 上) 都没人时释放它的缓冲区"""
+        if active or room_id in config.ROOMS:
+            return
+        self._rooms.pop(room_id, None)
+        self._complete.pop(room_id, None)
+        self._warmed.discard(room_id)
+
+    async def warm_up(self, repository: MessageRepository, room_id: str = config.DEFAULT_ROOM_ID):
+        """从数据库加载房间最近的消息 (启动时加载配置中的房间，其他房间在首次有人进入时加载)"""
+        self._warmed.add(room_id) # 先标记，避免并发重复加载
+        room = self._get_room(room_id) # 先分配缓冲区，加载期间写入的消息记录在这里
+        messages = await repository.get_recent_messages(self.capacity, room_id=room_id)
+        if self._rooms.get(room_id) is not room:
+            return # 加载期间房间里的人都走了，缓冲区已经释放
+        # 加载期间新写入的消息已经在缓冲区里，数据库结果只补充更早的部分
+        newer = [entry for entry in room if not messages or entry[0] > messages[-1].id]
+        room.clear()
+        for msg in messages:
+            room.append((msg.id, msg.timestamp, msg.to_payload()))
+        room.extend(newer)
+        self._complete[room_id] = (len(messages) < self.capacity and len(messages) + len(newer) <= self.capacity
+                                   and not self.has_archive(room_id))
+        logger.info(f"房间 {room_id} 的最近消息缓存已加载 {len(messages)} 条")
+
+    def add(self, message: MessageModel, room_id: str = config.DEFAULT_ROOM_ID) -> Dict[str, Any]:
+        """记录一条新消息，返回它的前端消息结构"""
+        payload = message.to_payload()
+        self._insert(room_id, message.id, message.timestamp, payload)
+        return payload
+
+    def add_remote(self, payload: Dict[str, Any], room_id: str):
+        """记录其他 worker 广播的消息 (只处理聊天消息)"""
+        if payload.get("type") != "message" or payload.get("id") is None:
+            return
+        timestamp = datetime.fromisoformat(payload["timestamp"].rstrip("Z"))
+        self._insert(room_id, payload["id"], timestamp, payload)
+
+    def _insert(self, room_id: str, message_id: int, timestamp: datetime, payload: Dict[str, Any]):
+        room = self._rooms.get(room_id)
+        if room is None:
+            return # 没有缓存的房间 (还没人进入过，或者已经释放) 不需要记录，有人进入时会从数据库加载
+        if not room or message_id > room[-1][0]:
+            if len(room) == room.maxlen:
+                self._complete[room_id] = False # 最旧的消息被挤出，缓冲区不再包含全部历史
+            room.append((message_id, timestamp, payload))
+            return
+        # 其他 worker 的消息经广播总线到达，可能晚于本 worker 的更新的消息，按 id 插入到正确位置
+        if any(entry[0] == message_id for entry in room):
+            return
+        if len(room) == room.maxlen:
+            if message_id < room[0][0]:
+                return # 比缓冲区里的消息都旧，不需要缓存
+            room.popleft()
+            self._complete[room_id] = False
+        index = len(room)
+        while index > 0 and room[index - 1][0] > message_id:
+            index -= 1
+        room.insert(index, (message_id, timestamp, payload))
+
+    def get_recent(self, count: int, room_id: str = config.DEFAULT_ROOM_ID,
+                   before_dt: datetime | None = None) -> list[Dict[str, Any]] | None:
+        """
+        返回最近的 count 条消息 (可选：早于 before_dt 的)，按时间正序排列。
+        缓冲区无法给出完整结果时返回 None，调用方应回退到数据库查询。
+        """
+        room = self._rooms.get(room_id)
+        if room is None:
+            return None # 没有缓存的房间 (不分配缓冲区)
+        if before_dt is not None and before_dt.tzinfo is not None:
+            before_dt = before_dt.astimezone(timezone.utc).replace(tzinfo=None) # 缓存中是不带时区的 UTC 时间
+
+        results = []
+        for _, timestamp, payload in reversed(room):
+            if before_dt is not None and timestamp >= before_dt:
+                continue
+            results.append(payload)
+            if len(results) == count:
+                break
+
+        # 缓冲区是连续的最新消息，取满 count 条或者缓冲区包含全部历史时结果才是完整的
+        if len(results) < count and not self._complete[room_id]:
+            return None
+        return results[::-1]
+
+    def get_by_id(self, limit: int, room_id: str = config.DEFAULT_ROOM_ID, before_id: int | None = None,
+                  after_id: int | None = None) -> list[Dict[str, Any]] | None:
+        """
+        基于 id 游标读取缓存 (语义同 MessageRepository.get_messages_by_id)。
+        缓冲区无法给出完整结果时返回 None。
+        """
+        room = self._rooms.get(room_id)
+        if room is None:
+            return None
+        if after_id is not None:
+            # 缓冲区必须包含游标本身或更早的消息 (或者包含全部历史)，才能保证中间没有缺口
+            if not self._complete[room_id] and (not room or room[0][0] > after_id):
+                return None
+            results = []
+            for message_id, _, payload in room:
+                if message_id <= after_id:
+                    continue
+                if (before_id is not None and message_id >= before_id) or len(results) == limit:
+                    break
+                results.append(payload)
+            return results
+
+        results = []
+        for message_id, _, payload in reversed(room):
+            if before_id is not None and message_id >= before_id:
+                continue
+            results.append(payload)
+            if len(results) == limit:
+                break
+        if len(results) < limit and not self._complete[room_id]:
+            return None
+        return results[::-1]
@@ -0,0 +1,235 @@
+# backend/message_export.py
+"""
+聊天记录的流式批量导出：NDJSON 或 CSV，可选 gzip / zstd 压缩 (zstd 需要安装 zstandard)。
+
+按 id 升序分批读取 (WHERE id > 上一批最后的 id ORDER BY id LIMIT n)，每批是一个独立的短查询：
+内存占用只和批大小有关，也不会在导出期间一直持有读事务、让 WAL 无法 checkpoint。
+主库和归档分片 (message_archive) 按 id 归并，导出开始时固定 id 上界 (until_id)，之后写入的消息不会导出。
+
+每批编码后作为一个完整的 gzip member / zstd frame 输出 (多个首尾相接仍是合法的压缩文件)。
+中断时已收到的完整批次都可以解压，用最后一行的 id 作为 after_id、同一个 until_id 重新导出即可续传。
+"""
+import asyncio
+import csv
+import gzip
+import io
+import json
+import logging
+import sqlite3
+from datetime import datetime, timezone
+from typing import Any, AsyncIterator, Iterator
+from message_archive import MessageArchive
+from metrics import EXPORT_ROWS
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+FIELDS = ("id", "room_id", "sender_id", "sender_name", "message_type", "timestamp", "content")
+FORMATS = {"ndjson": ("application/x-ndjson", "ndjson"), "csv": ("text/csv; charset=utf-8", "csv")}
+COMPRESSIONS = {"none": None, "gzip": ("application/gzip", "gz"), "zstd": ("application/zstd", "zst")}
+_COLUMNS = ", ".join(FIELDS)
+
+
+class ExportError(ValueError):
+    """导出参数无效"""
+
+
+def to_utc_naive(dt: datetime) -> datetime:
+    """数据库中的时间戳按 UTC 存储、不带时区；带时区的参数先换算到 UTC"""
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc).replace(tzinfo=None)
+    return dt
+
+
+def _format_timestamp(value: str) -> str:
+    """和 to_payload 一致的 ISO 格式 (isoformat() + "Z")：主库按 SQLAlchemy 的格式存储，总是带 6 位微秒"""
+    value = value.replace(" ", "T")
+    return (value[:-7] if value.endswith(".000000") else value) + "Z"
+
+
+def _connect(path: str) -> sqlite3.Connection:
+    # 只读打开：导出不会意外写库，也不会在分片不存在时创建空文件
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True, timeout=5.0, check_same_thread=False)
+
+
+class MessageExport:
+    """
+    一次导出。prepare() 确定 id 范围，之后 iter_chunks() (同步) 或 stream() (异步) 逐批产出编码好的字节块。
+    last_id 是已产出的最后一行的 id，中断后作为 after_id 续传。
+    """
+    def __init__(self, db_path: str, archive: MessageArchive | None = None, *, fmt: str = "ndjson",
+                 compression: str = "none", room_id: str | None = None, sender_ids: list[str] | None = None,
+                 message_types: list[str] | None = None, after_dt: datetime | None = None,
+                 before_dt: datetime | None = None, after_id: int = 0, until_id: int | None = None,
+                 header: bool | None = None, batch_size: int = config.EXPORT_BATCH_SIZE):
+        if fmt not in FORMATS:
+            raise ExportError(f"不支持的导出格式: {fmt}")
+        if compression not in COMPRESSIONS:
+            raise ExportError(f"不支持的压缩方式: {compression}")
+        if compression == "zstd" and zstandard is None:
+            raise ExportError("zstd 压缩需要安装 zstandard (pip install zstandard)")
+        self.db_path = db_path
+        self.archive = archive
+        self.fmt = fmt
+        self.compression = compression
+        self.room_id = room_id
+        self.sender_ids = sender_ids or []
+        self.message_types = message_types or []
+        self.after_dt = to_utc_naive(after_dt) if after_dt else None
+        self.before_dt = to_utc_naive(before_dt) if before_dt else None
+        self.last_id = after_id
+        self.until_id = until_id
+        self.header = fmt == "csv" and (after_id == 0 if header is None else header) # 续传时默认不重复表头
+        self.batch_size = batch_size
+        self.rows = 0
+        self._main_bounds: tuple[int, int] | None = None # 主库中满足时间范围的 id 区间 (由时间戳索引确定)
+        self._exhausted: dict[str, tuple[int, int]] = {} # 来源 -> (当时的最大 id, 最后一条匹配的 id)
+        self._compressor = zstandard.ZstdCompressor(level=config.EXPORT_ZSTD_LEVEL) if compression == "zstd" else None
+
+    @property
+    def media_type(self) -> str:
+        compressed = COMPRESSIONS[self.compression]
+        return compressed[0] if compressed else FORMATS[self.fmt][0]
+
+    @property
+    def extension(self) -> str:
+        compressed = COMPRESSIONS[self.compression]
+        return FORMATS[self.fmt][1] + (f".{compressed[1]}" if compressed else "")
+
+    # --- 读取 ---
+    def prepare(self):
+        """确定导出范围：until_id 默认为当前最大 id；有时间范围时用时间戳索引把主库的扫描收窄到对应的 id 区间"""
+        conn = _connect(self.db_path)
+        try:
+            max_id = conn.execute("SELECT max(id) FROM messages").fetchone()[0] or 0
+            if self.archive:
+                max_id = max(max_id, self.archive.max_id)
+            self.until_id = max_id if self.until_id is None else min(self.until_id, max_id)
+            low, high = 0, self.until_id
+            if self.after_dt is not None:
+                first = conn.execute("SELECT min(id) FROM messages WHERE timestamp >= ?",
+                                     (self.after_dt.isoformat(" "),)).fetchone()[0]
+                low = first - 1 if first is not None else high
+            if self.before_dt is not None:
+                last = conn.execute("SELECT max(id) FROM messages WHERE timestamp < ?",
+                                    (self.before_dt.isoformat(" "),)).fetchone()[0]
+                high = min(high, last or 0)
+            self._main_bounds = (low, high)
+        finally:
+            conn.close()
+
+    def _query(self, path: str, low: int, high: int) -> list[tuple]:
+        conditions, params = ["id > ?", "id <= ?"], [max(self.last_id, low), high]
+        if self.room_id is not None:
+            conditions.append("room_id = ?")
+            params.append(self.room_id)
+        if self.sender_ids:
+            conditions.append(f"sender_id IN ({', '.join('?' * len(self.sender_ids))})")
+            params += self.sender_ids
+        if self.message_types:
+            conditions.append(f"message_type IN ({', '.join('?' * len(self.message_types))})")
+            params += self.message_types
+        # +timestamp：时间条件只做过滤，不让 SQLite 改走时间戳索引 (那样每批都要先取出全部命中再按 id 排序)
+        if self.after_dt is not None:
+            conditions.append("+timestamp >= ?")
+            params.append(self.after_dt.isoformat(" "))
+        if self.before_dt is not None:
+            conditions.append("+timestamp < ?")
+            params.append(self.before_dt.isoformat(" "))
+        conn = _connect(path)
+        try:
+            return conn.execute(f"SELECT {_COLUMNS} FROM messages WHERE {' AND '.join(conditions)} "
+                                f"ORDER BY id LIMIT ?", (*params, self.batch_size)).fetchall()
+        finally:
+            conn.close()
+
+    def _sources(self) -> list[tuple[str, int, int]]:
+        """(路径, 最小 id, 最大 id)：主库在前，归档分片按 id 升序在后"""
+        sources = [(self.db_path, *self._main_bounds)]
+        if self.archive:
+            # 每批重新读取分片列表：导出期间归档任务可能把消息从主库移到分片
+            # (先写分片再删主库，所以先查主库、再查分片，移动中的消息至少能在一边读到)
+            sources += [(path, low - 1, min(high, self.until_id)) for path, low, high
+                        in self.archive.shard_ranges(self.after_dt, self.before_dt)]
+        return sources
+
+    def read_batch(self) -> list[tuple]:
+        """读取下一批 (最多 batch_size 条，按 id 升序)，没有更多时返回空列表"""
+        if self._main_bounds is None:
+            self.prepare()
+        found: dict[int, tuple] = {} # 崩溃后重新归档的消息可能同时在主库和分片中，按 id 去重
+        for path, low, high in self._sources():
+            if high <= self.last_id:
+                continue
+            exhausted = self._exhausted.get(path)
+            if exhausted and exhausted[0] == high and exhausted[1] <= self.last_id:
+                continue # 上次已经读到这个来源的最后一条匹配，且之后没有新的消息移入
+            if len(found) >= self.batch_size and low >= sorted(found)[self.batch_size - 1]:
+                continue # 这个来源的消息都在本批之后
+            rows = self._query(path, low, high)
+            if len(rows) < self.batch_size:
+                self._exhausted[path] = (high, rows[-1][0] if rows else self.last_id)
+            for row in rows:
+                found[row[0]] = row
+        batch = [found[message_id] for message_id in sorted(found)[:self.batch_size]]
+        if batch:
+            self.last_id = batch[-1][0]
+        return batch
+
+    # --- 编码 ---
+    def _encode(self, rows: list[tuple]) -> bytes:
+        records = [(*row[:5], _format_timestamp(row[5]), row[6]) for row in rows]
+        if self.fmt == "csv":
+            buffer = io.StringIO()
+            writer = csv.writer(buffer, lineterminator="\n")
+            if self.header:
+                writer.writerow(FIELDS)
+                self.header = False
+            writer.writerows(records)
+            return buffer.getvalue().encode()
+        if orjson is not None:
+            return b"".join(orjson.dumps(dict(zip(FIELDS, record))) + b"\n" for record in records)
+        return "".join(json.dumps(dict(zip(FIELDS, record)), ensure_ascii=False, separators=(",", ":")) + "\n"
+                       for record in records).encode()
+
+    def _compress(self, data: bytes) -> bytes:
+        if self.compression == "gzip":
+            return gzip.compress(data, compresslevel=config.EXPORT_GZIP_LEVEL, mtime=0)
+        if self.compression == "zstd":
+            return self._compressor.compress(data)
+        return data
+
+    def next_chunk(self) -> bytes | None:
+        """读取并编码下一批，导出完成时返回 None"""
+        rows = self.read_batch()
+        if not rows:
+            if self.header: # 没有任何匹配时也输出表头
+                return self._compress(self._encode([]))
+            return None
+        self.rows += len(rows)
+        EXPORT_ROWS.labels(self.fmt).inc(len(rows))
+        return self._compress(self._encode(rows))
+
+    def iter_chunks(self) -> Iterator[bytes]:
+        while (chunk := self.next_chunk()) is not None:
+            yield chunk
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        """在线程中读取和编码 (不占用数据库线程，也不阻塞事件循环)，逐批产出"""
+        while (chunk := await asyncio.to_thread(self.next_chunk)) is not None:
+            yield chunk
+        logger.info(f"导出完成: {self.describe()}")
+
+    def describe(self) -> dict[str, Any]:
+        return {"format": self.fmt, "compression": self.compression, "last_id": self.last_id,
+                "until_id": self.until_id, "rows": self.rows}
@@ -0,0 +1,174 @@
+# backend/message_writer.py
+import asyncio
+import logging
+from datetime import datetime, timezone
+from models import Message as MessageModel, MessageTypeEnum
+from repository import MessageRepository
+from message_cache import RecentMessageCache
+from metrics import DB_COMMIT_ROWS, DB_COMMIT_SECONDS
+import config
+
+logger = logging.getLogger(__name__)
+
+DURABILITY_MODES = ("write_behind", "group_commit", "sync")
+STOP_FLUSH_ATTEMPTS = 3 # 关闭时写入失败的重试次数 (每次间隔加倍)
+
+class MessageWriter:
+    """
+    消息写入管道。
+    - write_behind: 进程内分配 id 和时间戳，调用方立即拿到消息去广播，
+      排队的消息按数量或时间间隔批量写入 SQLite (一个事务一次 fsync)。
+    - group_commit: 同样批量写入，但调用方等待所在批次提交完成后才返回。
+    - sync: 每条消息单独提交 (旧行为，用于对比)。
+    """
+    def __init__(self, repository: MessageRepository, message_cache: RecentMessageCache | None = None,
+                 mode: str = config.MESSAGE_DURABILITY,
+                 batch_size: int = config.MESSAGE_BATCH_SIZE,
+                 flush_interval: float = config.MESSAGE_FLUSH_INTERVAL,
+                 max_pending: int = config.MESSAGE_MAX_PENDING):
+        if mode not in DURABILITY_MODES:
+            raise ValueError(f"未知的持久化模式: {mode}")
+        self.repository = repository
+        self.message_cache = message_cache # 每条写入的消息同时进入最近消息缓存
+        self.mode = mode
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending: list[tuple[dict, asyncio.Future | None]] = [] # (消息行, 等待提交结果的 future)
+        self._next_id = 0
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+        self._stopping = False
+
+    async def start(self):
+        """读取当前最大 id 并启动后台写入任务"""
+        if self.mode == "sync":
+            logger.info("MessageWriter 使用逐条提交模式。")
+            return
+        self._next_id = await self.repository.get_max_id() + 1
+        self._task = asyncio.create_task(self._flush_loop())
+        logger.info(f"MessageWriter 已启动: 模式={self.mode}, 批量={self.batch_size}, 间隔={self.flush_interval}s, 下一个 id={self._next_id}")
+
+    async def stop(self) -> bool:
+        """停止后台任务，并把剩余的消息全部写入数据库 (失败时重试几次)，返回是否全部落盘"""
+        if self._task:
+            # 不直接 cancel，避免中断进行中的批量写入
+            self._stopping = True
+            self._wakeup.set()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for attempt in range(STOP_FLUSH_ATTEMPTS):
+            if await self.flush_all():
+                logger.info("MessageWriter 已停止，待写入消息已全部落盘。")
+                return True
+            await asyncio.sleep(self.flush_interval * 2 ** attempt)
+        logger.error(f"关闭时仍有 {len(self._pending)} 条消息写入失败，已丢弃。")
+        for _, future in self._pending:
+            if future and not future.done():
+                future.set_exception(RuntimeError("MessageWriter 已停止"))
+        self._pending.clear()
+        return False
+
+    async def flush_all(self) -> bool:
+        """把所有排队的消息写入数据库。直接查询数据库前调用，保证能读到刚提交的消息"""
+        while self._pending:
+            if not await self.flush():
+                return False
+        return True
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def submit(self, sender_id: str, sender_name: str, content: str,
+                     message_type: MessageTypeEnum = MessageTypeEnum.TEXT,
+                     room_id: str = config.DEFAULT_ROOM_ID) -> MessageModel:
+        """提交一条消息，返回带 id 和时间戳的消息对象 (不绑定任何数据库会话)"""
+        message = await self._submit(sender_id, sender_name, content, message_type, room_id)
+        if self.message_cache is not None:
+            self.message_cache.add(message, room_id)
+        return message
+
+    async def _submit(self, sender_id: str, sender_name: str, content: str,
+                      message_type: MessageTypeEnum, room_id: str) -> MessageModel:
+        if self.mode == "sync":
+            with DB_COMMIT_SECONDS.labels(self.mode).time():
+                message = await self.repository.add_message(sender_id, sender_name, content, message_type, room_id)
+            DB_COMMIT_ROWS.labels(self.mode).inc()
+            return message
+
+        if len(self._pending) >= self.max_pending:
+            # 写入跟不上时让发送方等待，而不是无限堆积内存
+            await self.flush()
+
+        row = {
+            "room_id": room_id,
+            "sender_id": sender_id,
+            "sender_name": sender_name,
+            "content": content,
+            "message_type": message_type,
+            # 与数据库的 CURRENT_TIMESTAMP 一致：不带时区的 UTC 时间
+            "timestamp": datetime.now(timezone.utc).replace(tzinfo=None),
+        }
+
+        if self.mode == "write_behind":
+            row["id"] = self._next_id
+            self._next_id += 1
+            self._pending.append((row, None))
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.set()
+            return MessageModel(**row)
+
+        # group_commit：立即唤醒写入任务，提交进行中到达的消息会自然合并到下一批
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+        self._wakeup.set()
+        row["id"] = await future
+        return MessageModel(**row)
+
+    async def flush(self) -> bool:
+        """把当前排队的消息写入数据库，成功 (或无消息) 返回 True"""
+        async with self._flush_lock:
+            if not self._pending:
+                return True
+            batch = self._pending[:self.batch_size]
+            del self._pending[:len(batch)]
+            rows = [row for row, _ in batch]
+            try:
+                with DB_COMMIT_SECONDS.labels(self.mode).time():
+                    ids = await self.repository.insert_batch(rows)
+            except Exception as e:
+                logger.error(f"批量写入 {len(rows)} 条消息失败: {e}", exc_info=True)
+                if self.mode == "write_behind":
+                    # id 已经广播出去，放回队首等待下次重试
+                    self._pending[:0] = batch
+                else:
+                    for _, future in batch:
+                        if future and not future.done():
+                            future.set_exception(e)
+                return False
+            DB_COMMIT_ROWS.labels(self.mode).inc(len(rows))
+            for (_, future), message_id in zip(batch, ids):
+                if future and not future.done():
+                    future.set_result(message_id)
+            logger.debug(f"已批量写入 {len(rows)} 条消息")
+            return True
+
+    async def _flush_loop(self):
+        """后台写入循环：数量达到阈值时被唤醒，否则按时间间隔写入"""
+        while not self._stopping:
+            try:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+                self._wakeup.clear()
+                while self._pending:
+                    if not await self.flush():
+                        await asyncio.sleep(self.flush_interval) # 写入失败，稍后重试
+                        break
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error(f"消息写入循环出错: {e}", exc_info=True)
@@ -0,0 +1,309 @@
+# backend/metrics.py
+"""
+进程内的指标注册表，以 Prometheus 文本格式暴露在 /metrics。
+
+不依赖 prometheus_client：计数器、仪表和直方图都只是内存里的数字，
+更新只在事件循环中进行，开销是一次字典查找加一次加法，可以放在热路径上。
+多 worker 部署时每个 worker 各自暴露自己的指标，由 Prometheus 按实例聚合。
+"""
+import logging
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator
+import config
+
+logger = logging.getLogger(__name__)
+
+# 默认的耗时分桶 (秒)：覆盖从入队 (微秒级) 到模型调用 (数十秒)
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(names: tuple[str, ...], values: tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) and not value.is_integer() else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[tuple[str, ...], "_Metric"] = {}
+
+    def labels(self, *values: str):
+        """按标签值取子指标 (第一次使用时创建)"""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"指标 {self.name} 需要标签 {self.labelnames}")
+            child = self._children[key] = self._new_child()
+        return child
+
+    def remove(self, *values: str):
+        """删除一组标签的时间序列 (标签值来自客户端时，避免序列无限增长)"""
+        self._children.pop(tuple(str(value) for value in values), None)
+
+    def _new_child(self) -> "_Metric":
+        return type(self)(self.name, self.documentation)
+
+    def _series(self) -> Iterator[tuple[tuple[str, ...], "_Metric"]]:
+        if self.labelnames:
+            yield from self._children.items()
+        else:
+            yield (), self
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for values, child in self._series():
+            lines.extend(child._render_samples(self.labelnames, values))
+        return lines
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def _render_samples(self, names, values) -> list[str]:
+        return [f"{self.name}{_format_labels(names, values)} {_format_value(self.value)}"]
+
+
+class Gauge(_Metric):
+    """可增可减的当前值"""
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()):
+        super().__init__(name, documentation, labelnames)
+        self.value = 0.0
+
+    def set(self, value: float):
+        self.value = value
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+    def dec(self, amount: float = 1):
+        self.value -= amount
+
+    def _render_samples(self, names, values) -> list[str]:
+        return [f"{self.name}{_format_labels(names, values)} {_format_value(self.value)}"]
+
+
+class Histogram(_Metric):
+    """分桶统计的耗时分布 (Prometheus 直方图，可以用 histogram_quantile 计算百分位)"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = (),
+                 buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1) # 最后一个是 +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def _new_child(self) -> "Histogram":
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float):
+        self.sum += value
+        self.count += 1
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[index] += 1
+                return
+        self.counts[-1] += 1
+
+    @contextmanager
+    def time(self):
+        """with histogram.time(): ... 记录代码块的耗时"""
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0)
+
+    def _render_samples(self, names, values) -> list[str]:
+        lines, cumulative = [], 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            cumulative += count
+            le = f'le="{_format_value(bound)}"'
+            lines.append(f"{self.name}_bucket{_format_labels(names, values, le)} {cumulative}")
+        lines.append(f"{self.name}_sum{_format_labels(names, values)} {_format_value(self.sum)}")
+        lines.append(f"{self.name}_count{_format_labels(names, values)} {self.count}")
+        return lines
+
+
+class Registry:
+    """所有指标的集合；collector 在每次抓取时调用，用来导出其他组件内部已有的统计"""
+    def __init__(self):
+        self.metrics: list[_Metric] = []
+        self.collectors: list[Callable[[], Iterable[_Metric]]] = []
+
+    def register(self, metric: _Metric) -> _Metric:
+        self.metrics.append(metric)
+        return metric
+
+    def add_collector(self, collector: Callable[[], Iterable[_Metric]]):
+        self.collectors.append(collector)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        for collector in self.collectors:
+            try:
+                for metric in collector():
+                    lines.extend(metric.render())
+            except Exception as e:
+                logger.error(f"导出指标出错: {e}", exc_info=True)
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+
+def counter(name: str, documentation: str, labelnames: Iterable[str] = ()) -> Counter:
+    return REGISTRY.register(Counter(name, documentation, labelnames))
+
+
+def gauge(name: str, documentation: str, labelnames: Iterable[str] = ()) -> Gauge:
+    return REGISTRY.register(Gauge(name, documentation, labelnames))
+
+
+def histogram(name: str, documentation: str, labelnames: Iterable[str] = (),
+              buckets: tuple[float, ...] = DEFAULT_BUCKETS) -> Histogram:
+    return REGISTRY.register(Histogram(name, documentation, labelnames, buckets))
+
+
+# --- WebSocket ---
+WS_CONNECTIONS = gauge("chat_ws_connections", "本 worker 上的 WebSocket 连接数", ["room"])
+WS_SEND_FAILURES = counter("chat_ws_send_failures_total", "发送失败而断开的连接数", ["reason"])
+WS_DROPPED_FRAMES = counter("chat_ws_dropped_frames_total", "慢客户端发送队列已满而被丢弃的帧数")
+WS_COALESCED_FRAMES = counter("chat_ws_coalesced_frames_total", "发送队列中被同类的新帧替换掉的过时帧数 (coalesce 策略)")
+WS_SEND_DELAY = histogram("chat_ws_send_delay_seconds", "帧从入队到写入 socket 的耗时")
+BROADCAST_SECONDS = histogram("chat_broadcast_seconds", "一次广播编码并放入房间内所有发送队列的耗时")
+BROADCAST_FANOUT = histogram("chat_broadcast_fanout", "每次广播的接收连接数",
+                             buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000))
+BROADCAST_BATCH_EVENTS = histogram("chat_broadcast_batch_events", "开启广播批量时每个批次合并的事件数",
+                                   buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+BROADCAST_BATCH_SUPERSEDED = counter("chat_broadcast_batch_superseded_total", "批次中被后来的事件取代而没有发出的事件数")
+
+# --- 数据库 ---
+DB_COMMIT_SECONDS = histogram("chat_db_commit_seconds", "写入管道一次提交的耗时", ["mode"])
+DB_COMMIT_ROWS = counter("chat_db_committed_messages_total", "写入管道已落盘的消息数", ["mode"])
+EXPORT_ROWS = counter("chat_export_rows_total", "批量导出的消息行数", ["format"])
+
+# --- HTTP ---
+HTTP_REQUEST_SECONDS = histogram("chat_http_request_seconds", "HTTP 接口的处理耗时", ["method", "route", "status"])
+
+# --- Agent 和模型调用 ---
+MODEL_CALL_SECONDS = histogram("chat_model_call_seconds", "Agent 一次模型调用的耗时 (包括重试)",
+                               ["agent", "model", "outcome"])
+MODEL_TOKENS = counter("chat_model_tokens_total", "模型调用消耗的 token 数 (响应里没有 usage 时为本地估算)",
+                       ["agent", "model", "kind"])
+MODEL_ERRORS = counter("chat_model_errors_total", "模型调用失败次数", ["agent", "model"])
+MODEL_COST = counter("chat_model_cost_usd_total", "模型调用费用 (美元，来自响应的 usage.cost 或 MODEL_PRICES)",
+                     ["agent", "model"])
+AGENT_STAGE_SECONDS = histogram("chat_agent_speak_stage_seconds", "agent_speak 各阶段的耗时", ["agent", "stage"])
+AGENT_SPEAK_TOTAL = counter("chat_agent_speak_total", "agent_speak 的调用次数", ["agent", "outcome"])
+AGENT_DIRECTOR_REPLIES = counter("chat_agent_director_replies_total",
+                                 "导演模式为每个 Agent 写的发言 (posted 发出, invalid 校验失败, missing 没有返回, "
+                                 "stale 发出前已过时, fallback 回退到单独调用)", ["agent", "outcome"])
+AGENT_DIRECTOR_SAVED_CALLS = counter("chat_agent_director_saved_calls_total", "导演模式比每个 Agent 单独调用少发的模型调用数")
+AGENT_DIRECTOR_SAVED_TOKENS = counter("chat_agent_director_saved_prompt_tokens_total",
+                                      "导演模式比每个 Agent 单独调用少用的输入 token 数 (本地估算)")
+AGENT_SPECULATIVE = counter("chat_agent_speculative_total",
+                            "提前生成的回复的去向 (used 发出, stale 过时丢弃, cancelled 被取消, failed 生成失败, skipped 未提前生成)",
+                            ["agent", "outcome"])
+
+
+class HTTPMetricsMiddleware:
+    """
+    记录每个 HTTP 请求的处理耗时 (纯 ASGI 中间件，不包装响应体，对流式响应和 WebSocket 无影响)。
+    route 标签使用路由模板 (/api/messages) 而不是实际路径，未匹配路由的请求记为 other。
+    """
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        t0 = time.perf_counter()
+        status = 500
+
+        async def send_with_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            route = getattr(scope.get("route"), "path", "other")
+            HTTP_REQUEST_SECONDS.labels(scope["method"], route, status).observe(time.perf_counter() - t0)
+
+
+def record_model_usage(agent_id: str, model: str, prompt_tokens: int, completion_tokens: int,
+                       cost: float | None = None):
+    """记录一次模型调用的 token 数和费用"""
+    MODEL_TOKENS.labels(agent_id, model, "prompt").inc(prompt_tokens)
+    MODEL_TOKENS.labels(agent_id, model, "completion").inc(completion_tokens)
+    if cost is None and model in config.MODEL_PRICES:
+        prompt_price, completion_price = config.MODEL_PRICES[model]
+        cost = (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1_000_000
+    if cost:
+        MODEL_COST.labels(agent_id, model).inc(cost)
+
+
+class Trace:
+    """
+    一次 agent_speak 的分阶段计时 (轻量的 span)：
+        trace = Trace(agent_id)
+        with trace.stage("history"): ...
+        trace.finish("spoke")
+    结束时把各阶段耗时记入 AGENT_STAGE_SECONDS，并输出一行 DEBUG 日志。
+    """
+    def __init__(self, agent_id: str):
+        self.agent_id = agent_id
+        self.started = time.perf_counter()
+        self.stages: list[tuple[str, float]] = []
+
+    @contextmanager
+    def stage(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - t0
+            self.stages.append((name, elapsed))
+            AGENT_STAGE_SECONDS.labels(self.agent_id, name).observe(elapsed)
+
+    def finish(self, outcome: str):
+        AGENT_SPEAK_TOTAL.labels(self.agent_id, outcome).inc()
+        if logger.isEnabledFor(logging.DEBUG):
+            stages = " ".join(f"{name}={elapsed * 1000:.1f}ms" for name, elapsed in self.stages)
+            total = (time.perf_counter() - self.started) * 1000
+            logger.debug(f"agent_speak {self.agent_id} {outcome} 总计={total:.1f}ms {stages}")
@@ -0,0 +1,383 @@
+# backend/model_client.py
+import asyncio
+import email.utils
+import importlib.util
+import json
+import logging
+import random
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Dict
+import httpx
+from metrics import Counter, Gauge
+import config
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class ModelAPIError(Exception):
+    """模型调用失败 (已经过重试)"""
+    def __init__(self, message: str, status: int | None = None, retryable: bool = False,
+                 retry_after: float | None = None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+
+
+class CircuitOpenError(ModelAPIError):
+    """模型的断路器处于打开状态，请求未发出"""
+
+
+class CircuitBreaker:
+    """
+    单个模型的断路器：连续失败 failure_threshold 次后打开，reset_timeout 秒内直接拒绝请求；
+    之后进入半开状态放行一个探测请求，成功则关闭，失败则重新打开。
+    """
+    def __init__(self, failure_threshold: int = config.MODEL_BREAKER_FAILURES,
+                 reset_timeout: float = config.MODEL_BREAKER_RESET_TIMEOUT):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probing = False
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self._probing = False
+        if self.state == "half_open" and not self._probing:
+            self._probing = True
+            return True
+        return False
+
+    def is_open(self) -> bool:
+        """断路器打开且还没到探测时间 (不改变状态)"""
+        return self.state == "open" and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def release_probe(self):
+        """探测请求被取消 (没有结果)，允许下一个请求继续探测"""
+        self._probing = False
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+        self._probing = False
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.warning(f"模型断路器打开 (连续失败 {self.failures} 次)，{self.reset_timeout} 秒后重试")
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+
+class ModelStats:
+    """单个模型的调用统计"""
+    def __init__(self, window: int = 200):
+        self.latencies: deque[float] = deque(maxlen=window) # 非流式请求的成功耗时 (秒)
+        self.ttfts: deque[float] = deque(maxlen=window) # 流式请求的首 token 耗时 (秒)
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.rejected = 0 # 被断路器拒绝
+        self.hedges = 0 # 发出的对冲请求
+        self.hedge_wins = 0 # 对冲请求先返回
+
+    @staticmethod
+    def _percentile(samples: deque[float], p: float) -> float | None:
+        if not samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def latency_percentile(self, p: float) -> float | None:
+        return self._percentile(self.latencies, p)
+
+    def snapshot(self) -> Dict[str, Any]:
+        def ms(value):
+            return round(value * 1000, 1) if value is not None else None
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "rejected": self.rejected,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "latency_p50_ms": ms(self._percentile(self.latencies, 50)),
+            "latency_p95_ms": ms(self._percentile(self.latencies, 95)),
+            "ttft_p50_ms": ms(self._percentile(self.ttfts, 50)),
+            "ttft_p95_ms": ms(self._percentile(self.ttfts, 95)),
+        }
+
+
+class ModelClient:
+    """
+    OpenRouter 兼容接口的客户端：连接池 + keep-alive (可用时启用 HTTP/2)，
+    可重试错误按指数退避重试 (429/503 遵守 Retry-After)，每个模型独立的断路器，
+    主模型超过延迟分位数时向备用模型发出对冲请求，并记录每个模型的延迟和错误统计。
+    """
+    def __init__(self, base_url: str = config.BASE_URL, api_key: str = config.API_KEY,
+                 fallbacks: Dict[str, str] = config.MODEL_FALLBACKS):
+        self.base_url = base_url
+        self.api_key = api_key
+        self.fallbacks = fallbacks
+        http2 = config.MODEL_HTTP2 and importlib.util.find_spec("h2") is not None
+        self.http_client = httpx.AsyncClient(
+            http2=http2,
+            timeout=httpx.Timeout(config.MODEL_TIMEOUT, connect=config.MODEL_CONNECT_TIMEOUT),
+            limits=httpx.Limits(max_connections=config.MODEL_MAX_CONNECTIONS,
+                                max_keepalive_connections=config.MODEL_MAX_KEEPALIVE,
+                                keepalive_expiry=config.MODEL_KEEPALIVE_EXPIRY),
+        )
+        self.breakers: Dict[str, CircuitBreaker] = {}
+        self.stats: Dict[str, ModelStats] = {}
+        logger.info(f"模型客户端已创建: {base_url} (HTTP/2: {'开启' if http2 else '关闭'})")
+
+    def _breaker(self, model: str) -> CircuitBreaker:
+        if model not in self.breakers:
+            self.breakers[model] = CircuitBreaker()
+        return self.breakers[model]
+
+    def _stats(self, model: str) -> ModelStats:
+        if model not in self.stats:
+            self.stats[model] = ModelStats()
+        return self.stats[model]
+
+    def _headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.api_key}",
+            "Content-Type": "application/json"
+        }
+
+    @staticmethod
+    def _parse_retry_after(value: str | None) -> float | None:
+        """Retry-After 可以是秒数或 HTTP 日期"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def _error_from_response(self, response: httpx.Response) -> ModelAPIError:
+        retry_after = self._parse_retry_after(response.headers.get("Retry-After"))
+        return ModelAPIError(f"HTTP {response.status_code}: {response.text[:200]}", status=response.status_code,
+                             retryable=response.status_code in RETRYABLE_STATUS, retry_after=retry_after)
+
+    def _backoff(self, attempt: int, error: ModelAPIError) -> float:
+        """指数退避 (带抖动)；服务端给了 Retry-After 时至少等待这么久"""
+        delay = random.uniform(0, min(config.MODEL_RETRY_BACKOFF_MAX, config.MODEL_RETRY_BACKOFF_BASE * 2 ** attempt))
+        if error.retry_after is not None:
+            delay = max(delay, min(error.retry_after, config.MODEL_RETRY_AFTER_MAX))
+        return delay
+
+    @staticmethod
+    def _is_client_error(error: ModelAPIError) -> bool:
+        """不可重试的 4xx：请求本身无效或鉴权失败，换个时间重发也一样"""
+        return isinstance(error.status, int) and 400 <= error.status < 500 and not error.retryable
+
+    async def _with_retries(self, model: str, attempt_once):
+        """执行一次调用，可重试的错误按退避重试；记录断路器状态和统计"""
+        breaker = self._breaker(model)
+        stats = self._stats(model)
+        for attempt in range(config.MODEL_MAX_RETRIES + 1):
+            if not breaker.allow():
+                stats.rejected += 1
+                raise CircuitOpenError(f"模型 {model} 的断路器已打开")
+            stats.requests += 1
+            try:
+                result = await attempt_once()
+            except asyncio.CancelledError:
+                breaker.release_probe() # 被取消 (例如对冲请求先返回) 不算成功也不算失败
+                raise
+            except ModelAPIError as e:
+                error = e
+            except httpx.TransportError as e: # 连接失败、超时等网络错误
+                error = ModelAPIError(f"网络错误: {e!r}", retryable=True)
+            else:
+                breaker.record_success()
+                stats.successes += 1
+                return result
+
+            stats.failures += 1
+            if self._is_client_error(error):
+                breaker.release_probe() # 请求本身有问题 (400/401/404 等)，不代表模型不可用，不计入断路器
+            else:
+                breaker.record_failure()
+            if not error.retryable or attempt == config.MODEL_MAX_RETRIES:
+                raise error
+            delay = self._backoff(attempt, error)
+            stats.retries += 1
+            logger.warning(f"模型 {model} 调用失败 ({error})，{delay:.1f} 秒后第 {attempt + 1} 次重试")
+            await asyncio.sleep(delay)
+
+    async def _post_once(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        started = time.monotonic()
+        response = await self.http_client.post(self.base_url, headers=self._headers(), json=data)
+        if response.is_error:
+            raise self._error_from_response(response)
+        result = response.json()
+        if "error" in result: # OpenRouter 有时以 200 返回上游错误
+            code = result["error"].get("code") if isinstance(result["error"], dict) else None
+            raise ModelAPIError(f"上游错误: {result['error']}", status=code,
+                                retryable=isinstance(code, int) and code in RETRYABLE_STATUS)
+        self._stats(data["model"]).latencies.append(time.monotonic() - started)
+        return result
+
+    async def _complete_model(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        return await self._with_retries(data["model"], lambda: self._post_once(data))
+
+    def _hedge_delay(self, model: str) -> float | None:
+        """主模型的延迟分位数，样本不足时不对冲"""
+        stats = self._stats(model)
+        if len(stats.latencies) < config.MODEL_HEDGE_MIN_SAMPLES:
+            return None
+        return max(config.MODEL_HEDGE_MIN_DELAY, stats.latency_percentile(config.MODEL_HEDGE_PERCENTILE))
+
+    async def complete(self, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        非流式调用，返回接口的 JSON 结果。
+        配置了备用模型时：主模型断路器打开则直接用备用模型；主模型超过延迟分位数还没返回，
+        再向备用模型发一个对冲请求，先成功的结果胜出，另一个请求被取消。
+        """
+        model = data["model"]
+        fallback = self.fallbacks.get(model)
+        if not fallback or fallback == model:
+            return await self._complete_model(data)
+        fallback_data = {**data, "model": fallback}
+        if self._breaker(model).is_open():
+            logger.info(f"模型 {model} 的断路器已打开，改用备用模型 {fallback}")
+            return await self._complete_model(fallback_data)
+
+        # 调用方在任何一步被取消 (停服、丢弃过时的预生成) 时，finally 取消还在进行的请求，不留下计费的上游请求
+        pending: set[asyncio.Task] = set()
+        try:
+            primary = asyncio.create_task(self._complete_model(data))
+            pending = {primary}
+            hedge_delay = self._hedge_delay(model)
+            done, pending = await asyncio.wait(pending, timeout=hedge_delay)
+            if primary in done:
+                try:
+                    return primary.result()
+                except ModelAPIError as e:
+                    logger.warning(f"模型 {model} 调用失败 ({e})，改用备用模型 {fallback}")
+                    return await self._complete_model(fallback_data)
+
+            logger.info(f"模型 {model} 超过 {hedge_delay:.2f} 秒未返回，向备用模型 {fallback} 发出对冲请求")
+            self._stats(model).hedges += 1
+            hedge = asyncio.create_task(self._complete_model(fallback_data))
+            pending = {primary, hedge}
+            error = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            self._stats(model).hedge_wins += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _stream_once(self, data: Dict[str, Any]) -> AsyncIterator[str]:
+        async with self.http_client.stream("POST", self.base_url, headers=self._headers(),
+                                           json={**data, "stream": True}) as response:
+            if response.is_error:
+                await response.aread() # 读取错误响应体，便于记录日志
+                raise self._error_from_response(response)
+            async for line in response.aiter_lines():
+                if not line.startswith("data:"):
+                    continue # 空行和 ": OPENROUTER PROCESSING" 之类的注释行
+                payload = line[5:].strip()
+                if payload == "[DONE]":
+                    break
+                chunk = json.loads(payload)
+                if "error" in chunk: # 流已经开始后出错，错误放在数据行里
+                    raise ModelAPIError(f"流式响应返回错误: {chunk['error']}")
+                if not chunk.get("choices"):
+                    continue
+                delta = chunk["choices"][0].get("delta", {}).get("content")
+                if delta:
+                    yield delta
+
+    async def stream(self, data: Dict[str, Any]) -> AsyncIterator[str]:
+        """
+        流式调用，逐段产出回复文本。收到第一段文本之前的失败会重试 (主模型断路器打开时改用备用模型)；
+        已经开始输出后出错则直接抛出，由调用方丢弃草稿。流式请求不做对冲。
+        """
+        model = data["model"]
+        fallback = self.fallbacks.get(model)
+        if fallback and fallback != model and self._breaker(model).is_open():
+            logger.info(f"模型 {model} 的断路器已打开，改用备用模型 {fallback}")
+            data = {**data, "model": fallback}
+            model = fallback
+
+        started = 0.0
+        stream = None
+
+        async def attempt_once():
+            nonlocal stream, started
+            started = time.monotonic()
+            stream = self._stream_once(data)
+            try:
+                return await stream.__anext__()
+            except StopAsyncIteration:
+                return None
+            except BaseException:
+                await stream.aclose()
+                raise
+
+        first = await self._with_retries(model, attempt_once)
+        if first is None:
+            return
+        self._stats(model).ttfts.append(time.monotonic() - started)
+        try:
+            yield first
+            async for delta in stream:
+                yield delta
+        except (ModelAPIError, httpx.TransportError) as e:
+            self._stats(model).failures += 1
+            if not (isinstance(e, ModelAPIError) and self._is_client_error(e)):
+                self._breaker(model).record_failure()
+            raise
+        finally:
+            await stream.aclose()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """每个模型的调用统计和断路器状态"""
+        return {
+            model: {**stats.snapshot(), "breaker": self._breaker(model).state}
+            for model, stats in self.stats.items()
+        }
+
+    def collect_metrics(self) -> list:
+        """把每个模型的重试、对冲和断路器状态导出为指标 (注册为 metrics.REGISTRY 的 collector)"""
+        requests = Counter("chat_model_requests_total", "模型请求的结果 (按模型统计，包括重试和对冲)", ["model", "result"])
+        hedges = Counter("chat_model_hedges_total", "发出的对冲请求数和其中先返回的次数", ["model", "result"])
+        breaker = Gauge("chat_model_breaker_open", "模型断路器状态 (0 关闭，0.5 半开，1 打开)", ["model"])
+        for model, stats in self.stats.items():
+            for result in ("successes", "failures", "retries", "rejected"):
+                requests.labels(model, result).inc(getattr(stats, result))
+            hedges.labels(model, "sent").inc(stats.hedges)
+            hedges.labels(model, "won").inc(stats.hedge_wins)
+            breaker.labels(model).set({"closed": 0, "half_open": 0.5, "open": 1}[self._breaker(model).state])
+        return [requests, hedges, breaker]
+
+    async def aclose(self):
+        await self.http_client.aclose()
@@ -1,7 +1,8 @@
-from sqlalchemy import Column, Integer, String, DateTime, Enum as SQLAlchemyEnum
+from sqlalchemy import Column, Integer, String, DateTime, Index, Enum as SQLAlchemyEnum
 from sqlalchemy.sql import func
 from database import Base
 import enum
+import config
 
 # 使用 Python 的 enum 定义消息类型
 class MessageTypeEnum(enum.Enum):
@@ -14,11 +15,28 @@ class Message(Base):
     __tablename__ = "messages" # 数据库中的表名
 
     id = Column(Integer, primary_key=True, index=True) # 自动递增的主键
+    room_id = Column(String, nullable=False, default=config.DEFAULT_ROOM_ID, server_default=config.DEFAULT_ROOM_ID) # 所属聊天室
     sender_id = Column(String, index=True, nullable=False) # 发送者 ID
     sender_name = Column(String, nullable=False) # 发送者昵称 (冗余存储，方便查询)
     content = Column(String, nullable=False) # 消息内容 (文本或图片 URL)
     message_type = Column(SQLAlchemyEnum(MessageTypeEnum), default=MessageTypeEnum.TEXT, nullable=False) # 消息类型
-    timestamp = Column(DateTime(timezone=True), server_default=func.now(), nullable=False) # 消息时间戳 (数据库生成)
+    timestamp = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True) # 消息时间戳 (兼容旧的时间戳分页)
+
+    __table_args__ = (
+        Index("ix_messages_room_id_id", "room_id", "id"), # 房间内按 id 游标分页
+    )
+
+    def to_payload(self) -> dict:
+        """转换为发送给前端的消息结构 (WebSocket 广播与历史 API 共用)"""
+        return {
+            "type": "message",
+            "id": self.id, # 单调递增，用作分页和重连补发的游标
+            "roomId": self.room_id,
+            "content": self.content,
+            "messageType": self.message_type.name,
+            "sender": {"id": self.sender_id, "name": self.sender_name},
+            "timestamp": self.timestamp.isoformat() + "Z" # ISO 格式时间戳
+        }
 
     def __repr__(self):
         return f"<Message(id={self.id}, sender='{self.sender_name}', type='{self.message_type.name}')>" 
\ No newline at end of file
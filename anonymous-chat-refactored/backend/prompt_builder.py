@@ -0,0 +1,261 @@
+# backend/prompt_builder.py
+import asyncio
+import contextlib
+import logging
+import re
+import time
+from typing import Any, Awaitable, Callable, Dict
+from model_client import ModelClient, ModelAPIError
+import config
+
+logger = logging.getLogger(__name__)
+
+# 中日韩字符 (含全角标点) 大约每个字 1 个 token，其他文本大约每 4 个字符 1 个 token
+_CJK_RE = re.compile("[\u2e80-\u9fff\uac00-\ud7af\uf900-\ufaff\uff00-\uffef]")
+MESSAGE_OVERHEAD_TOKENS = 4 # 每条消息的角色标记等额外开销
+
+# (room_id, after_id, before_id, limit) -> 这段 id 区间内最新的 limit 条消息 (前端消息结构，按时间正序)
+MessageLoader = Callable[[str, int, int, int], Awaitable[list[Dict[str, Any]]]]
+
+
+def estimate_tokens(text: str) -> int:
+    """本地估算 token 数，不依赖具体模型的分词器，宁多勿少"""
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def truncate_to_tokens(text: str, max_tokens: int) -> str:
+    """把过长的单条消息截断到大约 max_tokens"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    low, high = 0, len(text)
+    while low < high: # 二分查找能放下的最长前缀
+        mid = (low + high + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            low = mid
+        else:
+            high = mid - 1
+    return text[:low] + "…"
+
+
+class RoomSummary:
+    """房间较早聊天内容的滚动摘要"""
+    def __init__(self):
+        self.text = ""
+        self.upto_id = 0 # 摘要覆盖到的最后一条消息 id
+        self.tokens = 0
+        self.refreshed_at = 0.0
+        self.task: asyncio.Task | None = None
+
+
+class PromptBuilder:
+    """
+    组装发给模型的消息列表：
+    - 系统提示按 Agent 缓存，配置 (自己和其他 Agent 的名字、设定) 变化时自动重建
+    - 聊天记录从最新往前取，直到用完该模型的 token 预算，过长的单条消息会被截断
+    - 可选：在后台用一个便宜的模型维护房间较早内容的滚动摘要，放在系统提示之后
+    """
+    def __init__(self, model_client: ModelClient, load_messages: MessageLoader, agents: Dict[str, Dict] = config.AGENTS):
+        self.model_client = model_client
+        self.load_messages = load_messages
+        self.agents = agents
+        self._system_prompts: Dict[str, tuple[tuple, str, int]] = {} # agent_id -> (配置指纹, 提示, token 数)
+        self.summaries: Dict[str, RoomSummary] = {}
+        # 摘要调用和 Agent 发言共用每分钟调用预算和并发上限 (由 AgentScheduler 设置；单独使用时不限制)
+        self.take_budget: Callable[[], bool] = lambda: True
+        self.call_semaphore: asyncio.Semaphore | None = None
+
+    # --- 系统提示 ---
+    def _fingerprint(self) -> tuple:
+        """系统提示依赖的配置 (所有 Agent 的名字和设定)，比重新拼接整段提示便宜得多"""
+        return tuple((agent_id, conf["name"], conf["description"]) for agent_id, conf in self.agents.items())
+
+    def invalidate(self, agent_id: str | None = None):
+        """丢弃缓存的系统提示 (不传 agent_id 时全部丢弃)"""
+        if agent_id is None:
+            self._system_prompts.clear()
+        else:
+            self._system_prompts.pop(agent_id, None)
+
+    def system_prompt(self, agent_id: str) -> tuple[str, int]:
+        """返回 Agent 的系统提示及其 token 数"""
+        fingerprint = self._fingerprint()
+        cached = self._system_prompts.get(agent_id)
+        if cached and cached[0] == fingerprint:
+            return cached[1], cached[2]
+        prompt = self._render_system_prompt(agent_id)
+        tokens = estimate_tokens(prompt)
+        self._system_prompts[agent_id] = (fingerprint, prompt, tokens)
+        return prompt, tokens
+
+    def _render_system_prompt(self, agent_id: str) -> str:
+        """为指定 Agent 生成系统提示"""
+        agent_config = self.agents.get(agent_id)
+        if not agent_config:
+            return "你是一个通用的聊天助手。"
+
+        # 构建其他参与者的描述
+        other_participants_desc = []
+        for other_id, other_conf in self.agents.items():
+            if other_id != agent_id:
+                other_participants_desc.append(f"- {other_conf['name']}: {other_conf['description']}")
+        # 也可以加入对普通用户的描述，如果需要的话
+        # other_participants_desc.append("- 其他真实用户: 身份随机")
+
+        participants_str = "\n".join(other_participants_desc)
+        if not participants_str:
+            participants_str = "(当前只有你一个 AI Agent)"
+
+        return f"""你是一个名叫 {agent_config['name']} 的真实人物，正在一个关于"健康生活与减肥"的群聊中（也可能有其他话题）。
+
+你的人物设定：{agent_config['description']}
+
+请根据上面的人物设定和当前的聊天记录，以自然、真实的方式参与讨论。你的回复应该：
+1. 始终保持角色一致性，不要跳出角色。
+2. 不要过于机械或官方，要像真人聊天一样自然，可以使用表情符号、口头禅或口语化表达。
+3. 回复长度适中，不要太长或太短。
+4. 回应最近几条消息，或者基于整体聊天氛围发表看法。
+5. 偶尔可以提问、表达情绪或适当转换话题，但尽量保持对话的连贯性。
+6. 绝对不要提及或暗示你是AI、语言模型或程序。
+7. 你不是群主或管理员，只是一个普通的参与者。
+
+你正在和以下人物（可能还包括其他真实用户）聊天：
+{participants_str}
+
+请基于当前的聊天历史，给出一个自然、符合你角色的回复。直接输出你的发言内容，不要带任何前缀如 '{agent_config['name']}:'。"""
+
+    def render_director_prompt(self, agent_ids: list[str]) -> str:
+        """导演模式的系统提示：一次为多个 Agent 各写一条发言，以 JSON 返回"""
+        cast = "\n".join(f"- {conf['name']}: {conf['description']}" for conf in self.agents.values())
+        speakers = "\n".join(f"- {agent_id}「{self.agents[agent_id]['name']}」" for agent_id in agent_ids)
+        return f"""你在为一个关于"健康生活与减肥"的群聊（也可能有其他话题）编写群成员接下来的发言。群里的人物设定：
+{cast}
+
+请按顺序为下面这些人物各写一条发言，发言会按这个顺序依次发到群里，后面的人可以回应前面的人：
+{speakers}
+
+每条发言都应该：
+1. 符合该人物的设定和说话风格，像真人聊天一样自然，可以使用表情符号、口头禅或口语化表达。
+2. 长度适中，回应最近的聊天内容或整体氛围，可以提问、表达情绪或适当转换话题。
+3. 绝对不要提及或暗示自己是AI、语言模型或程序，也不要替其他人说话。
+
+只输出一个 JSON 对象，不要输出其他内容，格式为：
+{{"replies": [{{"agent_id": "人物的 id (上面列表中「」前面的部分)", "content": "发言内容，不带名字前缀"}}]}}"""
+
+    # --- 聊天记录 ---
+    def format_message(self, msg: Dict[str, Any], agent_id: str | None) -> Dict[str, str]:
+        """将一条聊天记录格式化为 API 需要的格式 (agent_id 为 None 时所有发言都作为 user 消息，用于导演模式)"""
+        sender_id = msg["sender"]["id"]
+        role = "assistant" if sender_id == agent_id else "user"
+        # 对于 user 角色，我们通常需要显示是谁说的
+        sender_name = msg["sender"]["name"]
+        # 如果消息是来自其他 AI Agent，也明确标出
+        if sender_id.startswith('agent_') and sender_id != agent_id:
+            other_agent_conf = self.agents.get(sender_id)
+            if other_agent_conf:
+                sender_name = other_agent_conf['name'] # 使用配置中的名字
+        content = truncate_to_tokens(msg["content"], config.PROMPT_MAX_MESSAGE_TOKENS)
+        return {
+            "role": role,
+            "content": f"{sender_name}: {content}" if role == 'user' else content
+        }
+
+    def token_budget(self, model: str) -> int:
+        return config.PROMPT_TOKEN_BUDGETS.get(model, config.PROMPT_DEFAULT_TOKEN_BUDGET)
+
+    def build_messages(self, agent_id: str, history: list[Dict[str, Any]], room_id: str) -> list[Dict[str, str]]:
+        """
+        组装系统提示 + (摘要) + 预算内最新的聊天记录。
+        预算 = 模型预算 - 系统提示 - 摘要 - 回复预留的 max_tokens。
+        """
+        agent_config = self.agents[agent_id]
+        system_prompt, used = self.system_prompt(agent_id)
+        budget = self.token_budget(agent_config["model"]) - config.AGENT_REPLY_MAX_TOKENS
+        return self._with_history([{"role": "system", "content": system_prompt}], used, budget, agent_id, history, room_id)
+
+    def build_director_messages(self, agent_ids: list[str], model: str, history: list[Dict[str, Any]],
+                                room_id: str) -> list[Dict[str, str]]:
+        """导演模式：系统提示 + (摘要) + 预算内最新的聊天记录 (所有发言都以 "名字: 内容" 的形式给出)"""
+        system_prompt = self.render_director_prompt(agent_ids)
+        budget = self.token_budget(model) - config.AGENT_DIRECTOR_MAX_TOKENS
+        return self._with_history([{"role": "system", "content": system_prompt}], estimate_tokens(system_prompt),
+                                  budget, None, history, room_id)
+
+    def _with_history(self, messages: list[Dict[str, str]], used: int, budget: int, agent_id: str | None,
+                      history: list[Dict[str, Any]], room_id: str) -> list[Dict[str, str]]:
+        """在系统提示之后加上摘要和预算内最新的聊天记录"""
+        summary = self.summaries.get(room_id)
+        if summary and summary.text:
+            messages.append({"role": "system", "content": f"更早之前的聊天摘要：{summary.text}"})
+            used += summary.tokens + MESSAGE_OVERHEAD_TOKENS
+
+        kept = []
+        for msg in reversed(history):
+            formatted = self.format_message(msg, agent_id)
+            cost = estimate_tokens(formatted["content"]) + MESSAGE_OVERHEAD_TOKENS
+            if used + cost > budget and kept: # 至少保留最新的一条
+                break
+            used += cost
+            kept.append(formatted)
+        messages.extend(reversed(kept))
+
+        if config.PROMPT_SUMMARY_MODEL and history:
+            # 没放进上下文的最早一条之前的内容交给摘要
+            first_kept_id = history[len(history) - len(kept)].get("id")
+            if first_kept_id is not None:
+                self._maybe_refresh_summary(room_id, first_kept_id)
+        return messages
+
+    # --- 滚动摘要 ---
+    def _maybe_refresh_summary(self, room_id: str, first_kept_id: int):
+        """摘要落后于上下文窗口时，在后台刷新 (每个房间同时只有一个刷新任务，且有最小间隔)"""
+        summary = self.summaries.setdefault(room_id, RoomSummary())
+        if summary.upto_id >= first_kept_id - 1:
+            return
+        if summary.task and not summary.task.done():
+            return
+        if time.monotonic() - summary.refreshed_at < config.PROMPT_SUMMARY_MIN_INTERVAL:
+            return
+        summary.refreshed_at = time.monotonic()
+        summary.task = asyncio.create_task(self._refresh_summary(room_id, summary, first_kept_id))
+
+    async def _refresh_summary(self, room_id: str, summary: RoomSummary, first_kept_id: int):
+        try:
+            older = await self.load_messages(room_id, summary.upto_id, first_kept_id, config.PROMPT_SUMMARY_MAX_MESSAGES)
+            if not older:
+                summary.upto_id = first_kept_id - 1 # 上下文窗口之前没有新消息
+                return
+            transcript = "\n".join(
+                f"{msg['sender']['name']}: {truncate_to_tokens(msg['content'], config.PROMPT_MAX_MESSAGE_TOKENS)}"
+                for msg in older)
+            prompt = ("请把下面群聊的内容总结成一段简短的摘要 (不超过 200 字)，保留主要话题、各人的观点和尚未结束的问题。"
+                      "只输出摘要本身。\n\n")
+            if summary.text:
+                prompt += f"之前的摘要：{summary.text}\n\n"
+            prompt += f"新的聊天记录：\n{transcript}"
+            if not self.take_budget():
+                logger.info(f"Agent 每分钟调用预算已用完，推迟更新房间 {room_id} 的聊天摘要")
+                return # PROMPT_SUMMARY_MIN_INTERVAL 之后的下一次组装提示时再尝试
+            async with self.call_semaphore or contextlib.nullcontext():
+                result = await self.model_client.complete({
+                    "model": config.PROMPT_SUMMARY_MODEL,
+                    "messages": [{"role": "user", "content": prompt}],
+                    "temperature": 0.3,
+                    "max_tokens": config.PROMPT_SUMMARY_MAX_TOKENS,
+                })
+            text = result["choices"][0]["message"]["content"].strip()
+            if text:
+                summary.text = text
+                summary.tokens = estimate_tokens(text)
+                summary.upto_id = older[-1]["id"]
+                logger.info(f"房间 {room_id} 的聊天摘要已更新到消息 {summary.upto_id} ({summary.tokens} tokens)")
+        except ModelAPIError as e:
+            logger.warning(f"更新房间 {room_id} 的聊天摘要失败: {e}")
+        except Exception as e:
+            logger.error(f"更新房间 {room_id} 的聊天摘要出错: {e}", exc_info=True)
+
+    async def stop(self):
+        tasks = [summary.task for summary in self.summaries.values() if summary.task and not summary.task.done()]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
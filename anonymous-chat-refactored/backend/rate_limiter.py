@@ -0,0 +1,138 @@
+# backend/rate_limiter.py
+"""
+WebSocket 上行消息的限流和防刷。
+
+每个用户和每个 IP 各有一个令牌桶 (rate 个/秒，最多积攒 burst 个)，一帧消耗一个令牌。
+检查在解码之前进行：超限的帧不解码、不写库、不广播，只做几次加减法。
+控制帧 (pong) 不计入发送频率，服务端只对不超过 WS_CONTROL_FRAME_MAX_SIZE 的短帧先解码识别控制帧。
+presence_sync 虽然也很短，但每帧都要编码整个房间的在线用户列表，照常消耗令牌。
+一帧需要用户和 IP 两个桶都有令牌才放行，被其中一个拒绝时两个桶都不扣除。
+
+令牌桶放在有上限的 LRU 里 (OrderedDict，查找、更新和淘汰都是 O(1))，超过上限时淘汰最久没有活动的桶。
+被淘汰的桶下次出现时从满桶开始，和空闲足够久自然回满的结果相同，所以只有在 key 数量超过上限的
+极端情况下 (例如大量伪造的 user_id) 才会放宽限制，这时仍然有按 IP 的限制兜底。
+"""
+import logging
+import time
+from collections import OrderedDict
+from metrics import counter
+import config
+
+logger = logging.getLogger(__name__)
+
+# drop: 只丢弃超限的帧；penalty: 连续超限 strikes 次后封禁 penalty 秒 (期间所有帧都丢弃)；
+# disconnect: 连续超限 strikes 次后断开连接
+RATE_LIMIT_POLICIES = ("drop", "penalty", "disconnect")
+# 控制帧 (心跳回应) 不消耗聊天消息的令牌，只检查帧大小。
+# presence_sync 不在其中：服务端要为它编码并发送整个房间的在线用户快照，不限流时几个字节的帧就能换来 O(房间人数) 的开销
+CONTROL_FRAME_TYPES = ("pong",)
+
+THROTTLED = counter("chat_ws_throttled_total", "被限流或拒绝的上行帧数", ["reason"])
+EVICTED = counter("chat_rate_limit_evicted_total", "因超过上限被淘汰的令牌桶数", ["scope"])
+
+
+class TokenBucketLimiter:
+    """一组按 key 区分的令牌桶，每个桶的状态是 [令牌数, 上次更新时间, 连续超限次数, 封禁截止时间]"""
+    def __init__(self, scope: str, rate: float, burst: float, max_keys: int = config.RATE_LIMIT_MAX_BUCKETS):
+        self.scope = scope
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets: OrderedDict[str, list[float]] = OrderedDict()
+
+    def _bucket(self, key: str, now: float) -> list[float]:
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now, 0, 0.0]
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+                EVICTED.labels(self.scope).inc()
+        else:
+            self.buckets.move_to_end(key)
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+        return bucket
+
+    def peek(self, key: str, now: float) -> list[float]:
+        """按经过的时间补充令牌后返回桶的状态 (不消耗令牌)"""
+        return self._bucket(key, now)
+
+    @staticmethod
+    def allows(bucket: list[float], now: float, cost: float = 1) -> bool:
+        return bucket[3] <= now and bucket[0] >= cost
+
+    @staticmethod
+    def take(bucket: list[float], cost: float = 1):
+        bucket[0] -= cost
+        bucket[2] = 0
+
+    def retry_after(self, bucket: list[float], now: float) -> float:
+        """还要等多久才能再发一帧 (秒)"""
+        return max(bucket[3] - now, (1 - bucket[0]) / self.rate, 0.0)
+
+    def __len__(self) -> int:
+        return len(self.buckets)
+
+
+class IngestLimiter:
+    """
+    WebSocket 上行帧的准入检查：帧大小、按用户和按 IP 的令牌桶。
+    check_frame 返回 None 表示放行，否则返回拒绝原因 (用于指标和通知客户端)。
+    """
+    def __init__(self, policy: str = config.RATE_LIMIT_POLICY):
+        if policy not in RATE_LIMIT_POLICIES:
+            raise ValueError(f"未知的限流策略: {policy}")
+        self.policy = policy
+        self.users = TokenBucketLimiter("user", config.RATE_LIMIT_USER_RATE, config.RATE_LIMIT_USER_BURST)
+        self.ips = TokenBucketLimiter("ip", config.RATE_LIMIT_IP_RATE, config.RATE_LIMIT_IP_BURST)
+
+    def check_frame(self, user_id: str, ip: str | None, size: int, control: bool = False) -> str | None:
+        if size > config.WS_MAX_FRAME_SIZE:
+            THROTTLED.labels("frame_too_large").inc()
+            return "frame_too_large"
+        if not config.RATE_LIMIT_ENABLED or control:
+            return None
+        now = time.monotonic()
+        # 两个桶都有令牌才同时扣除：被 IP 限流 (或封禁) 的帧不消耗用户的令牌，反之亦然
+        user_bucket = self.users.peek(user_id, now)
+        ip_bucket = self.ips.peek(ip, now) if ip else None
+        if not self.users.allows(user_bucket, now):
+            bucket, reason = user_bucket, "user_rate"
+        elif ip_bucket is not None and not self.ips.allows(ip_bucket, now):
+            bucket, reason = ip_bucket, "ip_rate"
+        else:
+            self.users.take(user_bucket)
+            if ip_bucket is not None:
+                self.ips.take(ip_bucket)
+            return None
+        if bucket[3] > now:
+            reason = "penalty"
+        else:
+            bucket[2] += 1
+            if self.policy != "drop" and bucket[2] >= config.RATE_LIMIT_STRIKES:
+                if self.policy == "disconnect":
+                    reason = "disconnect"
+                else:
+                    bucket[3] = now + config.RATE_LIMIT_PENALTY_SECONDS
+                    bucket[2] = 0
+                    logger.warning(f"{'用户 ' + user_id if reason == 'user_rate' else 'IP ' + ip} "
+                                   f"持续超出发送频率，封禁 {config.RATE_LIMIT_PENALTY_SECONDS} 秒")
+        THROTTLED.labels(reason).inc()
+        return reason
+
+    def check_content(self, content) -> str | None:
+        """解码后检查消息内容 (必须是不超过 MESSAGE_MAX_LENGTH 个字符的字符串)"""
+        if not isinstance(content, str):
+            THROTTLED.labels("invalid_content").inc()
+            return "invalid_content"
+        if len(content) > config.MESSAGE_MAX_LENGTH:
+            THROTTLED.labels("content_too_long").inc()
+            return "content_too_long"
+        return None
+
+    def retry_after(self, user_id: str, ip: str | None) -> float:
+        """被限流的客户端多久后可以再发言 (秒，用于通知客户端)"""
+        now = time.monotonic()
+        waits = [limiter.retry_after(limiter.buckets[key], now)
+                 for limiter, key in ((self.users, user_id), (self.ips, ip)) if key in limiter.buckets]
+        return round(max(waits, default=0.0), 1)
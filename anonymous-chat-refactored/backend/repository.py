@@ -0,0 +1,201 @@
+# backend/repository.py
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Any, Callable
+from sqlalchemy import column, desc, func, insert, table, text
+from database import SessionLocal
+from models import Message as MessageModel, MessageTypeEnum
+from search_index import FTS_TABLE, like_pattern, parse_query
+import config
+
+logger = logging.getLogger(__name__)
+
+class MessageRepository:
+    """
+    消息持久化层。
+    同步的 SQLAlchemy 会话操作统一放到一个专用的数据库线程中执行，
+    async 处理函数只 await 结果，不会因为 commit / fsync 阻塞事件循环。
+    单线程执行同时保证了 SQLite 的写操作是串行的。
+    """
+    def __init__(self, use_executor: bool = config.DB_EXECUTOR_ENABLED,
+                 max_pending: int = config.DB_EXECUTOR_MAX_PENDING):
+        self.use_executor = use_executor
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db") if use_executor else None
+        self._pending_slots = asyncio.Semaphore(max_pending) # 限制排队中的操作数量
+        logger.info(f"MessageRepository 使用{'数据库线程' if use_executor else '同步'}模式")
+
+    async def run(self, func: Callable[..., Any], *args) -> Any:
+        """在数据库线程中执行同步函数；关闭线程模式时直接在当前线程执行 (旧路径)"""
+        if self._executor is None:
+            return func(*args)
+        async with self._pending_slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, func, *args)
+
+    # --- 同步实现 (只在数据库线程中调用) ---
+    def _add_message_sync(self, sender_id: str, sender_name: str, content: str,
+                          message_type: MessageTypeEnum, room_id: str) -> MessageModel:
+        db = SessionLocal()
+        try:
+            db_message = MessageModel(
+                room_id=room_id,
+                sender_id=sender_id,
+                sender_name=sender_name,
+                content=content,
+                message_type=message_type
+                # timestamp 由数据库自动生成
+            )
+            db.add(db_message)
+            db.commit()
+            db.refresh(db_message) # 获取数据库生成的数据，如 id 和 timestamp
+            return db_message
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _insert_batch_sync(self, rows: list[dict]) -> list[int]:
+        """在一个事务中写入一批消息 (group commit)，返回每行的 id"""
+        db = SessionLocal()
+        try:
+            if all(row.get("id") is not None for row in rows):
+                # id 已在进程内分配，一条 executemany 即可
+                db.execute(insert(MessageModel), rows)
+                ids = [row["id"] for row in rows]
+            else:
+                # 由数据库分配 id：同一事务内逐行插入，只 fsync 一次
+                ids = [db.execute(insert(MessageModel).values(**row)).inserted_primary_key[0] for row in rows]
+            db.commit()
+            return ids
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    def _get_max_id_sync(self) -> int:
+        db = SessionLocal()
+        try:
+            return db.query(func.max(MessageModel.id)).scalar() or 0
+        finally:
+            db.close()
+
+    def _get_recent_messages_sync(self, count: int, before_dt: datetime | None, room_id: str) -> list[MessageModel]:
+        db = SessionLocal()
+        try:
+            query = db.query(MessageModel).filter(MessageModel.room_id == room_id)
+            if before_dt is not None:
+                query = query.filter(MessageModel.timestamp < before_dt)
+                history_desc = query.order_by(desc(MessageModel.timestamp)).limit(count).all()
+            else:
+                # 最新的消息：按 id 倒序，可以直接走 (room_id, id) 索引
+                history_desc = query.order_by(desc(MessageModel.id)).limit(count).all()
+            return history_desc[::-1] # 按时间正序返回
+        finally:
+            db.close()
+
+    def _get_messages_by_id_sync(self, limit: int, before_id: int | None, after_id: int | None,
+                                 room_id: str) -> list[MessageModel]:
+        db = SessionLocal()
+        try:
+            query = db.query(MessageModel).filter(MessageModel.room_id == room_id)
+            if after_id is not None:
+                # 向后翻页：id 大于游标的最早 limit 条
+                query = query.filter(MessageModel.id > after_id)
+                if before_id is not None:
+                    query = query.filter(MessageModel.id < before_id)
+                return query.order_by(MessageModel.id).limit(limit).all()
+            if before_id is not None:
+                query = query.filter(MessageModel.id < before_id)
+            history_desc = query.order_by(desc(MessageModel.id)).limit(limit).all()
+            return history_desc[::-1]
+        finally:
+            db.close()
+
+    def _search_messages_sync(self, query: str, room_id: str, sender_id: str | None,
+                              message_type: MessageTypeEnum | None, after_dt: datetime | None,
+                              before_dt: datetime | None, sort: str, limit: int, offset: int) -> list[MessageModel]:
+        db = SessionLocal()
+        try:
+            match, short_terms = parse_query(query)
+            fts = table(FTS_TABLE, column("rowid"), column("rank"))
+            results = db.query(MessageModel).filter(MessageModel.room_id == room_id)
+            if match is not None:
+                results = results.join(fts, fts.c.rowid == MessageModel.id).filter(
+                    text(f"{FTS_TABLE} MATCH :match").bindparams(match=match))
+            else:
+                # 只有短词，无法走全文索引：只扫描最近的一段消息，保证最坏情况下的延迟有上限
+                max_id = db.query(func.max(MessageModel.id)).scalar() or 0
+                results = results.filter(MessageModel.id > max_id - config.SEARCH_LIKE_SCAN_LIMIT)
+            for term in short_terms:
+                results = results.filter(MessageModel.content.like(like_pattern(term), escape="\\"))
+            if sender_id is not None:
+                results = results.filter(MessageModel.sender_id == sender_id)
+            if message_type is not None:
+                results = results.filter(MessageModel.message_type == message_type)
+            if after_dt is not None:
+                results = results.filter(MessageModel.timestamp >= after_dt)
+            if before_dt is not None:
+                results = results.filter(MessageModel.timestamp < before_dt)
+            if match is None:
+                return results.order_by(desc(MessageModel.id)).offset(offset).limit(limit).all()
+            # 按索引的 rowid 倒序可以直接沿 FTS 索引顺序读取，按 messages.id 排序则要先取出全部命中再排序
+            results = results.order_by(desc(fts.c.rowid))
+            if sort == "recent":
+                return results.offset(offset).limit(limit).all()
+            # 常见词可能命中几十万条，对全部命中计算 bm25 太慢：只在最近的若干条命中里按相关度排序
+            candidates = results.with_entities(MessageModel.id.label("id"), fts.c.rank.label("rank")) \
+                .limit(config.SEARCH_RANK_CANDIDATES).subquery()
+            ranked = db.query(MessageModel).join(candidates, candidates.c.id == MessageModel.id) \
+                .order_by(candidates.c.rank, desc(MessageModel.id)) # rank 即 bm25，越小越相关
+            return ranked.offset(offset).limit(limit).all()
+        finally:
+            db.close()
+
+    # --- 异步接口 ---
+    async def add_message(self, sender_id: str, sender_name: str, content: str,
+                          message_type: MessageTypeEnum = MessageTypeEnum.TEXT,
+                          room_id: str = config.DEFAULT_ROOM_ID) -> MessageModel:
+        """存储一条消息，返回带 id 和时间戳的消息对象"""
+        return await self.run(self._add_message_sync, sender_id, sender_name, content, message_type, room_id)
+
+    async def insert_batch(self, rows: list[dict]) -> list[int]:
+        """批量写入消息行 (字段同 MessageModel)，返回 id 列表"""
+        return await self.run(self._insert_batch_sync, rows)
+
+    async def get_max_id(self) -> int:
+        """当前最大的消息 id，表为空时返回 0"""
+        return await self.run(self._get_max_id_sync)
+
+    async def get_recent_messages(self, count: int, before_dt: datetime | None = None,
+                                  room_id: str = config.DEFAULT_ROOM_ID) -> list[MessageModel]:
+        """获取房间内最近的 count 条消息 (可选：早于 before_dt 的)，按时间正序排列"""
+        return await self.run(self._get_recent_messages_sync, count, before_dt, room_id)
+
+    async def get_messages_by_id(self, limit: int, before_id: int | None = None, after_id: int | None = None,
+                                 room_id: str = config.DEFAULT_ROOM_ID) -> list[MessageModel]:
+        """
+        房间内基于 id 的游标分页 (按 id 正序返回)。
+        before_id: id 小于它的最近 limit 条；after_id: id 大于它的最早 limit 条。
+        """
+        return await self.run(self._get_messages_by_id_sync, limit, before_id, after_id, room_id)
+
+    async def search_messages(self, query: str, room_id: str = config.DEFAULT_ROOM_ID, sender_id: str | None = None,
+                              message_type: MessageTypeEnum | None = None, after_dt: datetime | None = None,
+                              before_dt: datetime | None = None, sort: str = "relevance",
+                              limit: int = 20, offset: int = 0) -> list[MessageModel]:
+        """
+        房间内全文检索，sort 为 relevance (在最近的 SEARCH_RANK_CANDIDATES 条命中中按 bm25 排序) 或 recent (按时间倒序)。
+        可选按发送者、消息类型和时间范围 [after_dt, before_dt) 过滤。
+        """
+        return await self.run(self._search_messages_sync, query, room_id, sender_id, message_type,
+                              after_dt, before_dt, sort, limit, offset)
+
+    def close(self):
+        """等待排队中的数据库操作完成并关闭数据库线程"""
+        if self._executor:
+            self._executor.shutdown(wait=True)
+            logger.info("数据库线程已关闭。")
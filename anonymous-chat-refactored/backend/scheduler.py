@@ -1,7 +1,10 @@
 import asyncio
 import random
 import logging
-from agent_manager import AgentManager
+import time
+from collections import deque
+from agent_manager import DIRECTOR_ID, AgentManager, SpeculativeReply
+from metrics import AGENT_DIRECTOR_REPLIES, AGENT_SPECULATIVE
 import config
 
 logger = logging.getLogger(__name__)
@@ -9,65 +12,394 @@ logger = logging.getLogger(__name__)
 class AgentScheduler:
     def __init__(self, agent_manager: AgentManager):
         self.agent_manager = agent_manager
-        self.tasks = {} # 用于存储每个 agent 的后台任务
+        self.tasks = {} # 用于存储每个 (room_id, agent_id) 的后台任务
+        # 多 worker 部署时只有 leader worker 运行 Agent，避免同一条发言出现多次
+        self.is_leader = True
+        # 人类发言后的回复任务：每个房间最多一个，防抖期间有新消息只推迟回复时间
+        self.reply_tasks: dict[str, asyncio.Task] = {}
+        self.reply_due: dict[str, float] = {} # room_id -> 计划回复的时间 (monotonic)
+        self.reply_deadline: dict[str, float] = {} # room_id -> 最迟回复时间
+        self.last_speaker: dict[str, str] = {} # room_id -> 最近发言的 Agent
+        self.speaking: set[tuple[str, str]] = set() # 正在生成回复的 (room_id, agent_id)
+        # 全局限制：同时进行的模型调用数和每分钟调用预算
+        self.call_semaphore = asyncio.Semaphore(config.AGENT_MAX_CONCURRENT_CALLS)
+        self.call_times: deque[float] = deque()
+        self.speculative_waste: deque[float] = deque() # 最近一小时被浪费 (过时或取消) 的提前生成调用
+        # 滚动摘要的模型调用也计入预算和并发上限
+        agent_manager.prompt_builder.take_budget = self._take_budget
+        agent_manager.prompt_builder.call_semaphore = self.call_semaphore
 
-    async def _agent_loop(self, agent_id: str):
-        """单个 Agent 的后台循环任务"""
+    def get_room_agents(self, room_id: str) -> list[str]:
+        """房间分配的 Agent 列表 (未配置的房间没有 Agent)"""
+        room_config = config.ROOMS.get(room_id, {})
+        return [agent_id for agent_id in room_config.get("agents", []) if agent_id in config.AGENTS]
+
+    def _room_loops(self, room_id: str) -> list[str]:
+        """房间应该运行的发言循环：每个 Agent 一个，导演模式下有多个 Agent 的房间只有一个导演循环"""
+        agents = self.get_room_agents(room_id)
+        if config.AGENT_DIRECTOR and len(agents) > 1:
+            return [DIRECTOR_ID]
+        return agents
+
+    async def _agent_loop(self, agent_id: str, room_id: str):
+        """单个 Agent 在单个房间的后台循环任务"""
         agent_config = config.AGENTS.get(agent_id)
         if not agent_config:
             logger.error(f"无法启动 Agent 循环：未找到配置 {agent_id}")
             return
 
         min_interval, max_interval = agent_config['talk_interval_range']
-        logger.info(f"启动 Agent {agent_id} ({agent_config['name']}) 的发言循环，间隔 {min_interval}-{max_interval} 秒")
+        logger.info(f"启动 Agent {agent_id} ({agent_config['name']}) 在房间 {room_id} 的发言循环，间隔 {min_interval}-{max_interval} 秒")
 
+        failures = 0 # 连续失败次数
         while True:
+            pending = None # 提前生成回复的任务
             try:
                 # 随机等待时间
                 wait_time = random.uniform(min_interval, max_interval)
                 logger.debug(f"Agent {agent_id} 下次发言将在 {wait_time:.1f} 秒后")
+                if self._speculation_allowed(agent_id):
+                    # 提前一个模型延迟开始生成，时间到达时回复已经准备好
+                    lead = min(wait_time, self.agent_manager.speculative_lead(agent_id))
+                    await asyncio.sleep(wait_time - lead)
+                    pending = asyncio.create_task(self._pregenerate(agent_id, room_id))
+                    wait_time = lead
                 await asyncio.sleep(wait_time)
 
-                # 执行发言逻辑
-                await self.agent_manager.agent_speak(agent_id)
+                # 执行发言逻辑 (模型客户端内部已经重试过，这里失败说明上游持续不可用)
+                spoke = await self._speak(agent_id, room_id, pending)
+                if spoke is False:
+                    failures += 1
+                    await asyncio.sleep(self._error_backoff(failures))
+                elif spoke:
+                    failures = 0
 
             except asyncio.CancelledError:
-                logger.info(f"Agent {agent_id} 的发言循环被取消。")
+                logger.info(f"Agent {agent_id} 在房间 {room_id} 的发言循环被取消。")
                 break # 退出循环
             except Exception as e:
                 # 记录错误并继续循环，防止一个 Agent 错误导致所有任务停止
                 logger.error(f"Agent {agent_id} 循环出错: {e}", exc_info=True)
-                # 可以增加错误后的等待时间，避免频繁出错
-                await asyncio.sleep(60) # 例如，出错后等待 60 秒
+                failures += 1
+                await asyncio.sleep(self._error_backoff(failures))
+            finally:
+                if pending and not pending.done(): # 房间空了或配置变了，还没用上的提前生成作废
+                    pending.cancel()
+                    self._record_waste(agent_id, "cancelled")
 
-    def start_all_agents(self):
-        """为所有配置的 Agent 启动后台任务"""
-        logger.info("正在启动所有 AI Agent 的后台发言任务...")
-        for agent_id in config.AGENTS.keys():
-            if agent_id not in self.tasks or self.tasks[agent_id].done():
-                logger.info(f"为 Agent {agent_id} 创建新的发言任务。")
+    def _error_backoff(self, failures: int) -> float:
+        """连续失败时的额外等待：按指数增长并加抖动，避免所有 Agent 同时重试"""
+        base, cap = config.AGENT_ERROR_BACKOFF
+        delay = min(cap, base * 2 ** (failures - 1))
+        logger.info(f"Agent 发言连续失败 {failures} 次，额外等待约 {delay:.0f} 秒")
+        return random.uniform(delay / 2, delay)
+
+    def _take_budget(self) -> bool:
+        """占用一次每分钟调用预算，预算已用完时返回 False"""
+        now = time.monotonic()
+        while self.call_times and now - self.call_times[0] >= 60:
+            self.call_times.popleft()
+        if len(self.call_times) >= config.AGENT_CALLS_PER_MINUTE:
+            return False
+        self.call_times.append(now)
+        return True
+
+    # --- 提前生成 ---
+    def _speculation_allowed(self, agent_id: str) -> bool:
+        """提前生成已开启，且最近一小时浪费的调用没有超过上限"""
+        if not config.AGENT_SPECULATIVE:
+            return False
+        now = time.monotonic()
+        while self.speculative_waste and now - self.speculative_waste[0] >= 3600:
+            self.speculative_waste.popleft()
+        if len(self.speculative_waste) >= config.AGENT_SPECULATIVE_MAX_WASTED_PER_HOUR:
+            AGENT_SPECULATIVE.labels(agent_id, "skipped").inc()
+            return False
+        return True
+
+    def _record_waste(self, agent_id: str, outcome: str):
+        self.speculative_waste.append(time.monotonic())
+        AGENT_SPECULATIVE.labels(agent_id, outcome).inc()
+        if len(self.speculative_waste) == config.AGENT_SPECULATIVE_MAX_WASTED_PER_HOUR:
+            logger.warning(f"最近一小时浪费了 {len(self.speculative_waste)} 次提前生成的调用，暂停提前生成。")
+
+    async def _pregenerate(self, agent_id: str, room_id: str) -> SpeculativeReply | None:
+        """后台提前生成回复 (和正常发言一样占用调用预算和并发上限)"""
+        if not self._take_budget():
+            AGENT_SPECULATIVE.labels(agent_id, "skipped").inc()
+            return None
+        async with self.call_semaphore:
+            reply = await self.agent_manager.pregenerate(agent_id, room_id)
+        if reply is None:
+            AGENT_SPECULATIVE.labels(agent_id, "failed").inc()
+        return reply
+
+    async def _take_speculative(self, agent_id: str, room_id: str, pending: asyncio.Task) -> SpeculativeReply | None:
+        """等待提前生成的回复 (还没生成完时等它，仍然比现在才开始快)，过时或失败时返回 None"""
+        try:
+            reply = await pending
+        except Exception as e:
+            logger.error(f"Agent {agent_id} 提前生成回复出错: {e}", exc_info=True)
+            AGENT_SPECULATIVE.labels(agent_id, "failed").inc()
+            return None
+        if reply is None: # 预算用完或生成失败 (已在 _pregenerate 中计数)
+            return None
+        if not self.agent_manager.is_fresh(reply, room_id):
+            logger.debug(f"Agent {agent_id} 提前生成的回复已过时，重新生成")
+            self._record_waste(agent_id, "stale")
+            return None
+        AGENT_SPECULATIVE.labels(agent_id, "used").inc()
+        return reply
+
+    async def _speak(self, agent_id: str, room_id: str, pending: asyncio.Task | None = None) -> bool | None:
+        """
+        在全局并发上限和调用预算内让 Agent 发言，返回是否发言成功；被跳过时返回 None。
+        pending 是提前生成回复的任务，回复可用时直接发出，过时或失败时重新生成。
+        """
+        if self.agent_manager.connection_manager.get_room_size(room_id) == 0:
+            return None # 房间已经没人了 (提前生成的任务由调用方取消)
+        reply = await self._take_speculative(agent_id, room_id, pending) if pending else None
+        if reply is None and not self._take_budget():
+            logger.warning(f"Agent 每分钟调用预算 ({config.AGENT_CALLS_PER_MINUTE}) 已用完，跳过 {agent_id} 在房间 {room_id} 的发言。")
+            return None
+        return await self._run_speak(agent_id, room_id, reply)
+
+    async def _run_speak(self, agent_id: str, room_id: str, reply: SpeculativeReply | None) -> bool:
+        """发出已经生成好的回复，或者在并发上限内调用模型生成 (调用预算由调用方占用)"""
+        key = (room_id, agent_id)
+        self.speaking.add(key)
+        try:
+            if reply is not None:
+                spoke = await self.agent_manager.agent_speak(agent_id, room_id, reply)
+            else:
+                async with self.call_semaphore:
+                    spoke = await self.agent_manager.agent_speak(agent_id, room_id)
+        finally:
+            self.speaking.discard(key)
+        if spoke:
+            self.last_speaker[room_id] = agent_id
+        return spoke
+
+    # --- 导演模式 ---
+    async def _director_loop(self, room_id: str):
+        """导演模式下房间所有 Agent 共用的发言循环：每轮一次模型调用为几个 Agent 写发言"""
+        logger.info(f"启动房间 {room_id} 的导演模式发言循环")
+        failures = 0
+        while True:
+            try:
+                await asyncio.sleep(self._director_interval(room_id))
+                spoke = await self._direct(room_id)
+                if spoke is False:
+                    failures += 1
+                    await asyncio.sleep(self._error_backoff(failures))
+                elif spoke:
+                    failures = 0
+            except asyncio.CancelledError:
+                logger.info(f"房间 {room_id} 的导演模式发言循环被取消。")
+                break
+            except Exception as e:
+                logger.error(f"房间 {room_id} 的导演模式循环出错: {e}", exc_info=True)
+                failures += 1
+                await asyncio.sleep(self._error_backoff(failures))
+
+    def _director_interval(self, room_id: str) -> float:
+        """两轮之间的等待：让每个 Agent 的平均发言频率和各自的 talk_interval_range 一致"""
+        agents = self.get_room_agents(room_id)
+        rate = sum(2 / sum(config.AGENTS[agent_id]["talk_interval_range"]) for agent_id in agents) # 每秒发言数
+        mean = min(len(agents), config.AGENT_DIRECTOR_MAX_AGENTS) / rate
+        return random.uniform(mean / 2, mean * 1.5)
+
+    def _pick_director_agents(self, room_id: str) -> list[str]:
+        """随机挑本轮发言的 Agent，刚发过言和正在生成回复的 Agent 排在后面"""
+        agents = [agent_id for agent_id in self.get_room_agents(room_id) if (room_id, agent_id) not in self.speaking]
+        random.shuffle(agents)
+        agents.sort(key=lambda agent_id: agent_id == self.last_speaker.get(room_id))
+        return agents[:config.AGENT_DIRECTOR_MAX_AGENTS]
+
+    async def _direct(self, room_id: str) -> bool | None:
+        """
+        一轮导演模式发言：一次调用生成，再按 AGENT_DIRECTOR_SPACING 的间隔依次发出。
+        校验失败或缺失的 Agent 单独调用；整次调用失败时只让第一个 Agent 单独发言，
+        避免上游故障时调用数翻倍。房间出现太多新消息后，剩下的发言作废。
+        """
+        if self.agent_manager.connection_manager.get_room_size(room_id) == 0:
+            return None
+        agents = self._pick_director_agents(room_id)
+        if not agents:
+            return None
+        if not self._take_budget():
+            logger.warning(f"Agent 每分钟调用预算 ({config.AGENT_CALLS_PER_MINUTE}) 已用完，跳过房间 {room_id} 的导演模式发言。")
+            return None
+        async with self.call_semaphore:
+            replies = await self.agent_manager.director_turn(agents, room_id)
+        if replies is None:
+            agents = agents[:1]
+            replies = {}
+
+        spoke = None
+        posted = 0
+        shared: list[SpeculativeReply] = [] # 已发出的导演模式发言
+        for index, agent_id in enumerate(agents):
+            if index:
+                await asyncio.sleep(random.uniform(*config.AGENT_DIRECTOR_SPACING))
+            if self.agent_manager.connection_manager.get_room_size(room_id) == 0:
+                break
+            reply = replies.get(agent_id)
+            if reply is None:
+                AGENT_DIRECTOR_REPLIES.labels(agent_id, "fallback").inc()
+                result = await self._speak(agent_id, room_id)
+            elif index and not self.agent_manager.is_fresh(reply, room_id, allowance=posted):
+                # 第一条和单独调用一样直接发出，后面的发言要确认话题还没有被新消息带走
+                for stale_id in agents[index:]:
+                    if stale_id in replies:
+                        AGENT_DIRECTOR_REPLIES.labels(stale_id, "stale").inc()
+                logger.debug(f"房间 {room_id} 在导演模式发言期间出现了太多新消息，本轮剩下的发言作废")
+                break
+            else:
+                result = await self._run_speak(agent_id, room_id, reply)
+                if result:
+                    AGENT_DIRECTOR_REPLIES.labels(agent_id, "posted").inc()
+                    shared.append(reply)
+            if result:
+                posted += 1
+            elif spoke is None:
+                spoke = result
+        self.agent_manager.record_director_savings(shared)
+        return True if posted else spoke
+
+    def notify_message(self, room_id: str, sender_id: str):
+        """房间里有人发言：防抖后安排一个 Agent 回复 (Agent 自己的消息不触发)"""
+        if not config.AGENT_REPLY_ENABLED or not self.is_leader or sender_id in config.AGENTS:
+            return
+        if not self.get_room_agents(room_id):
+            return
+        now = time.monotonic()
+        deadline = self.reply_deadline.setdefault(room_id, now + config.AGENT_REPLY_MAX_DELAY)
+        self.reply_due[room_id] = min(now + random.uniform(*config.AGENT_REPLY_DEBOUNCE), deadline)
+        task = self.reply_tasks.get(room_id)
+        if task is None or task.done():
+            self.reply_tasks[room_id] = asyncio.create_task(self._reply_loop(room_id))
+
+    def _pick_reply_agent(self, room_id: str) -> str | None:
+        """随机挑一个 Agent 回复，尽量避开刚发过言和正在生成回复的 Agent"""
+        agents = [agent_id for agent_id in self.get_room_agents(room_id) if (room_id, agent_id) not in self.speaking]
+        candidates = [agent_id for agent_id in agents if agent_id != self.last_speaker.get(room_id)]
+        candidates = candidates or agents
+        return random.choice(candidates) if candidates else None
+
+    async def _reply_loop(self, room_id: str):
+        """等到计划的回复时间再发言；生成回复期间又有人发言时继续安排下一次回复"""
+        try:
+            while room_id in self.reply_due:
+                delay = self.reply_due[room_id] - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay) # 期间回复时间可能被推迟，醒来后重新检查
+                    continue
+                self.reply_due.pop(room_id)
+                self.reply_deadline.pop(room_id, None)
+                agent_id = self._pick_reply_agent(room_id)
+                if agent_id is None:
+                    continue
+                try:
+                    await self._speak(agent_id, room_id)
+                except Exception as e:
+                    logger.error(f"Agent {agent_id} 回复房间 {room_id} 的消息出错: {e}", exc_info=True)
+        except asyncio.CancelledError:
+            pass
+        finally:
+            if self.reply_tasks.get(room_id) is asyncio.current_task():
+                del self.reply_tasks[room_id]
+
+    def _cancel_replies(self, room_ids: list[str]) -> list[asyncio.Task]:
+        cancelled = []
+        for room_id in room_ids:
+            self.reply_due.pop(room_id, None)
+            self.reply_deadline.pop(room_id, None)
+            task = self.reply_tasks.pop(room_id, None)
+            if task and not task.done():
+                task.cancel()
+                cancelled.append(task)
+        return cancelled
+
+    def on_room_activity(self, room_id: str, active: bool):
+        """ConnectionManager 回调：房间有人时启动其 Agent，房间空了就停止"""
+        if active and self.is_leader:
+            self.start_room_agents(room_id)
+        else:
+            # 同步取消，保证房间马上又有人进入时会重新启动任务
+            self._cancel_tasks([key for key in self.tasks if key[0] == room_id])
+            self._cancel_replies([room_id])
+
+    def start_room_agents(self, room_id: str):
+        """为房间分配的所有 Agent 启动后台任务 (导演模式下为房间启动一个导演任务)"""
+        for agent_id in self._room_loops(room_id):
+            key = (room_id, agent_id)
+            if key not in self.tasks or self.tasks[key].done():
+                logger.info(f"为 Agent {agent_id} 创建房间 {room_id} 的发言任务。")
                 # 创建并存储任务
-                task = asyncio.create_task(self._agent_loop(agent_id))
-                self.tasks[agent_id] = task
+                loop = self._director_loop(room_id) if agent_id == DIRECTOR_ID else self._agent_loop(agent_id, room_id)
+                self.tasks[key] = asyncio.create_task(loop)
             else:
-                 logger.info(f"Agent {agent_id} 的任务已在运行。")
+                 logger.info(f"Agent {agent_id} 在房间 {room_id} 的任务已在运行。")
 
+    async def stop_room_agents(self, room_id: str):
+        """停止房间内所有 Agent 的后台任务"""
+        await self._stop_tasks([key for key in self.tasks if key[0] == room_id])
+
+    def set_leader(self, is_leader: bool):
+        """LeaderElector 回调：成为 leader 时接管所有有人房间的 Agent，失去 leader 身份时全部停止"""
+        self.is_leader = is_leader
+        if is_leader:
+            self.start_all_agents()
+        else:
+            self._cancel_tasks(list(self.tasks))
+            self._cancel_replies(list(self.reply_tasks))
+
+    def reload_agents(self, changed: set[str]):
+        """
+        Agent 配置重新加载后调用：只重启定义有变化的 Agent 的发言循环，
+        并停止已被删除或移出房间的循环，其他 Agent 的循环 (包括正在等待的发言间隔) 不受影响。
+        """
+        stale = [key for key in self.tasks
+                 if key[1] in changed or key[1] not in self._room_loops(key[0])]
+        self._cancel_tasks(stale)
+        for room_id, agent_id in list(self.last_speaker.items()):
+            if agent_id not in config.AGENTS:
+                del self.last_speaker[room_id]
+        if self.is_leader:
+            for room_id in self.agent_manager.connection_manager.get_active_rooms():
+                self.start_room_agents(room_id)
+
+    def start_all_agents(self):
+        """为所有当前有人的房间启动 Agent 任务 (之后由房间活跃状态驱动)"""
+        logger.info("正在启动所有有人在线房间的 AI Agent 后台发言任务...")
+        for room_id in self.agent_manager.connection_manager.get_active_rooms():
+            self.start_room_agents(room_id)
         logger.info(f"已启动 {len(self.tasks)} 个 Agent 任务。")
 
     async def stop_all_agents(self):
         """优雅地停止所有 Agent 任务"""
         logger.info("正在停止所有 AI Agent 的后台任务...")
-        tasks_to_wait = []
-        for agent_id, task in self.tasks.items():
+        replies = self._cancel_replies(list(self.reply_tasks))
+        if replies:
+            await asyncio.gather(*replies, return_exceptions=True)
+        await self._stop_tasks(list(self.tasks))
+
+    def _cancel_tasks(self, keys: list[tuple[str, str]]) -> list[asyncio.Task]:
+        cancelled = []
+        for key in keys:
+            task = self.tasks.pop(key, None)
             if task and not task.done():
                 task.cancel() # 发送取消请求
-                tasks_to_wait.append(task)
-                logger.info(f"已发送取消请求给 Agent {agent_id} 的任务。")
+                cancelled.append(task)
+                logger.info(f"已发送取消请求给 Agent {key[1]} 在房间 {key[0]} 的任务。")
+        return cancelled
 
+    async def _stop_tasks(self, keys: list[tuple[str, str]]):
+        tasks_to_wait = self._cancel_tasks(keys)
         if tasks_to_wait:
             # 等待任务实际完成 (或抛出 CancelledError)
             await asyncio.gather(*tasks_to_wait, return_exceptions=True)
-            logger.info("所有 Agent 任务已停止。")
+            logger.info(f"已停止 {len(tasks_to_wait)} 个 Agent 任务。")
         else:
             logger.info("没有正在运行的 Agent 任务需要停止。")
-        self.tasks.clear() # 清空任务字典 
\ No newline at end of file
@@ -0,0 +1,92 @@
+# backend/search_index.py
+"""
+聊天记录全文检索 (SQLite FTS5)。
+
+messages_fts 是 messages.content 的外部内容索引 (不重复存储正文)，由触发器在插入、删除和修改时同步，
+写入管道不需要任何改动。使用 trigram 分词器：按连续 3 个字符建索引，不需要中文分词，任意子串都能匹配。
+少于 3 个字的检索词无法走索引：有其他足够长的词时只在索引结果中用 LIKE 过滤，否则退化为有上限的 LIKE 扫描。
+
+已有消息的 chat.db 第一次启用检索时，服务启动后在数据库线程中建立索引 (建表、触发器和 rebuild 在同一个事务中，
+中途崩溃时下次启动会重新建立)，完成之前 /api/search 返回 503，而不是返回看起来正常的空结果。
+"""
+import logging
+import sqlite3
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLE = "messages_fts"
+MIN_TERM_LENGTH = 3 # trigram 分词器能走索引的最短检索词
+
+_SCHEMA = [
+    f"""CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5(
+        content, content='messages', content_rowid='id', tokenize='trigram')""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+    END""",
+    f"""CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF content ON messages BEGIN
+        INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, content) VALUES ('delete', old.id, old.content);
+        INSERT INTO {FTS_TABLE}(rowid, content) VALUES (new.id, new.content);
+    END""",
+]
+
+
+def fts5_trigram_supported() -> bool:
+    """当前 SQLite 是否支持 FTS5 和 trigram 分词器 (需要 3.34+)"""
+    conn = sqlite3.connect(":memory:")
+    try:
+        conn.execute("CREATE VIRTUAL TABLE t USING fts5(x, tokenize='trigram')")
+        return True
+    except sqlite3.OperationalError:
+        return False
+    finally:
+        conn.close()
+
+
+def ensure_search_index(engine: Engine) -> tuple[bool, bool]:
+    """
+    创建全文索引和同步触发器 (已存在时不做任何事)，返回 (检索是否可用, 是否需要建立索引)。
+    索引不存在而 messages 已经有消息时不在这里建表 (耗时和消息数成正比)，由调用方在数据库线程中执行 rebuild_search_index。
+    """
+    if not fts5_trigram_supported():
+        logger.warning(f"SQLite {sqlite3.sqlite_version} 不支持 FTS5 trigram 分词器，全文检索不可用。")
+        return False, False
+    with engine.begin() as conn:
+        existed = conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = :name"), {"name": FTS_TABLE}).first()
+        if not existed and conn.execute(text("SELECT 1 FROM messages LIMIT 1")).first():
+            logger.warning("已有的消息尚未建立全文索引，将在后台建立，完成前全文检索不可用。")
+            return True, True
+        for ddl in _SCHEMA:
+            conn.execute(text(ddl))
+    return True, False
+
+
+def rebuild_search_index(engine: Engine):
+    """根据 messages 表重建整个全文索引，并合并索引段 (建表、建触发器和重建在同一个事务中)"""
+    with engine.begin() as conn:
+        for ddl in _SCHEMA:
+            conn.execute(text(ddl))
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')"))
+        conn.execute(text(f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('optimize')"))
+
+
+def parse_query(query: str) -> tuple[str | None, list[str]]:
+    """
+    把用户输入拆成 FTS5 MATCH 表达式和需要用 LIKE 匹配的短词。
+    按空白分词，每个词作为短语精确匹配 (FTS5 的运算符和特殊字符不生效)，多个词之间是 AND。
+    """
+    long_terms, short_terms = [], []
+    for term in query.split():
+        (long_terms if len(term) >= MIN_TERM_LENGTH else short_terms).append(term)
+    match = " AND ".join('"' + term.replace('"', '""') + '"' for term in long_terms)
+    return match or None, short_terms
+
+
+def like_pattern(term: str) -> str:
+    """LIKE 子串匹配的模式，转义 % 和 _ (以反斜杠作为 ESCAPE 字符)"""
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
@@ -0,0 +1,66 @@
+# backend/tools/archive_messages.py
+"""
+手动执行一轮消息归档 (服务运行时后台任务每 ARCHIVE_INTERVAL 秒自动执行一次)。
+
+用法:
+    python tools/archive_messages.py                       # 按 CHAT_RETENTION_DAYS 归档
+    python tools/archive_messages.py --retention-days 30
+    python tools/archive_messages.py --vacuum              # 停服时执行：把旧数据库切换为 auto_vacuum=INCREMENTAL
+                                                           # 并整理整个文件 (耗时与数据库大小成正比，期间锁库)
+"""
+import argparse
+import asyncio
+import os
+import sqlite3
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine
+from database import DATABASE_FILE, SessionLocal
+from message_archive import MessageArchive
+from repository import MessageRepository
+import config
+
+
+def vacuum(path: str):
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+        conn.execute("VACUUM")
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="归档过期的聊天消息")
+    parser.add_argument("--db", default=DATABASE_FILE, help="SQLite 数据库文件路径")
+    parser.add_argument("--archive-dir", default=config.ARCHIVE_DIR, help="归档文件目录")
+    parser.add_argument("--retention-days", type=int, default=config.MESSAGE_RETENTION_DAYS, help="保留最近多少天的消息")
+    parser.add_argument("--vacuum", action="store_true", help="归档后执行一次完整的 VACUUM")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        sys.exit(f"数据库文件不存在: {args.db}")
+    if args.retention_days <= 0:
+        sys.exit("--retention-days 必须大于 0")
+
+    engine = create_engine(f"sqlite:///{args.db}")
+    SessionLocal.configure(bind=engine)
+    archive = MessageArchive(args.archive_dir)
+    t0 = time.perf_counter()
+    moved = asyncio.run(archive.run_once(MessageRepository(use_executor=False), args.retention_days))
+    print(f"已归档 {moved:,} 条消息，耗时 {time.perf_counter() - t0:.1f}s")
+    engine.dispose()
+
+    if args.vacuum:
+        size_before = os.path.getsize(args.db)
+        t0 = time.perf_counter()
+        vacuum(args.db)
+        print(f"VACUUM 完成，{size_before / 2**20:.1f} MB -> {os.path.getsize(args.db) / 2**20:.1f} MB，"
+              f"耗时 {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
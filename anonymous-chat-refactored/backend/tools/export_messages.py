@@ -0,0 +1,146 @@
+# backend/tools/export_messages.py
+"""
+把聊天记录流式导出为 NDJSON 或 CSV (可选 gzip / zstd 压缩)，直接读取 SQLite 文件和归档分片，服务运行时也可以执行。
+格式和压缩方式默认按输出文件的扩展名推断 (.csv / .gz / .zst)。
+
+每写完一批 (EXPORT_BATCH_SIZE 行，压缩时是一个完整的 gzip member / zstd frame) 就更新检查点文件 <输出文件>.export.json，
+中断后用 --resume 把输出文件截断到最后一个完整的批次，从检查点的 id 继续 (筛选条件和 id 上界沿用检查点中的)。
+导出完成后删除检查点文件。
+
+用法:
+    python tools/export_messages.py -o messages.ndjson.gz
+    python tools/export_messages.py -o lobby-2026-01.csv --room-id lobby --after 2026-01-01 --before 2026-02-01
+    python tools/export_messages.py -o agents.ndjson.zst --sender-id agent_fatty_li --sender-id agent_sporty_wang
+    python tools/export_messages.py -o messages.ndjson.gz --resume          # 从上次中断处继续
+    python tools/export_messages.py -o - --after-id 120000 | wc -l          # 写到标准输出 (没有检查点)
+"""
+import argparse
+import json
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from database import DATABASE_FILE
+from message_archive import MessageArchive
+from message_export import ExportError, MessageExport
+from models import MessageTypeEnum
+import config
+
+
+def parse_time(value: str) -> datetime:
+    try:
+        return datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"无效的时间戳: {value}")
+
+
+def infer_options(output: str, fmt: str | None, compression: str | None) -> tuple[str, str]:
+    name = output.lower()
+    if compression is None:
+        compression = "gzip" if name.endswith(".gz") else "zstd" if name.endswith(".zst") else "none"
+    if fmt is None:
+        fmt = "csv" if ".csv" in name else "ndjson"
+    return fmt, compression
+
+
+def save_checkpoint(path: str, state: dict):
+    # 先写临时文件再替换，中断时不会留下写了一半的检查点
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False)
+    os.replace(path + ".tmp", path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="流式导出聊天记录")
+    parser.add_argument("-o", "--output", required=True, help="输出文件，- 表示标准输出")
+    parser.add_argument("--format", choices=["ndjson", "csv"], help="输出格式 (默认按扩展名推断)")
+    parser.add_argument("--compression", choices=["none", "gzip", "zstd"], help="压缩方式 (默认按扩展名推断)")
+    parser.add_argument("--db", default=DATABASE_FILE, help="SQLite 数据库文件路径")
+    parser.add_argument("--archive-dir", default=config.ARCHIVE_DIR, help="归档文件目录 (不存在时只导出主库)")
+    parser.add_argument("--room-id", help="只导出该聊天室 (默认全部)")
+    parser.add_argument("--sender-id", action="append", help="只导出这些用户发送的消息 (可重复)")
+    parser.add_argument("--message-type", action="append", type=str.upper,
+                        choices=[t.name for t in MessageTypeEnum], help="只导出这些类型的消息 (可重复)")
+    parser.add_argument("--after", type=parse_time, help="只导出此时间及之后的消息 (ISO 格式，不带时区时按 UTC)")
+    parser.add_argument("--before", type=parse_time, help="只导出此时间之前的消息")
+    parser.add_argument("--after-id", type=int, default=0, help="只导出 id 大于此值的消息")
+    parser.add_argument("--until-id", type=int, help="只导出 id 不大于此值的消息 (默认为开始导出时的最大 id)")
+    parser.add_argument("--resume", action="store_true", help="按检查点文件继续上次中断的导出")
+    parser.add_argument("--batch-size", type=int, default=config.EXPORT_BATCH_SIZE, help="每批读取的行数")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        sys.exit(f"数据库文件不存在: {args.db}")
+    to_stdout = args.output == "-"
+    checkpoint_path = None if to_stdout else args.output + ".export.json"
+    fmt, compression = infer_options("" if to_stdout else args.output, args.format, args.compression)
+    options = {
+        "format": fmt, "compression": compression, "room_id": args.room_id,
+        "sender_ids": args.sender_id, "message_types": args.message_type,
+        "after": args.after.isoformat() if args.after else None,
+        "before": args.before.isoformat() if args.before else None,
+    }
+    after_id, until_id, written, rows = args.after_id, args.until_id, 0, 0
+    if args.resume:
+        if to_stdout or not os.path.exists(checkpoint_path):
+            sys.exit(f"没有可以继续的导出 (找不到检查点文件 {checkpoint_path})")
+        with open(checkpoint_path, encoding="utf-8") as f:
+            state = json.load(f)
+        options = state["options"] # 续传必须使用和首次导出相同的条件
+        after_id, until_id, written, rows = state["last_id"], state["until_id"], state["bytes"], state["rows"]
+        print(f"从 id {after_id} 继续导出 (已导出 {rows:,} 行，{written / 2**20:.1f} MB)", file=sys.stderr)
+    elif checkpoint_path and os.path.exists(checkpoint_path):
+        sys.exit(f"{args.output} 有未完成的导出，用 --resume 继续，或删除 {checkpoint_path} 后重新导出")
+
+    archive = MessageArchive(args.archive_dir) if os.path.isdir(args.archive_dir) else None
+    try:
+        export = MessageExport(
+            args.db, archive, fmt=options["format"], compression=options["compression"], room_id=options["room_id"],
+            sender_ids=options["sender_ids"], message_types=options["message_types"],
+            after_dt=datetime.fromisoformat(options["after"]) if options["after"] else None,
+            before_dt=datetime.fromisoformat(options["before"]) if options["before"] else None,
+            after_id=after_id, until_id=until_id, header=written == 0, batch_size=args.batch_size)
+    except ExportError as e:
+        sys.exit(str(e))
+    export.prepare()
+
+    if to_stdout:
+        out = sys.stdout.buffer
+    else:
+        out = open(args.output, "r+b" if args.resume else "wb")
+        out.truncate(written) # 丢掉最后一个没写完的批次
+        out.seek(written)
+    t0 = last_report = time.perf_counter()
+    try:
+        for chunk in export.iter_chunks():
+            out.write(chunk)
+            written += len(chunk)
+            if checkpoint_path:
+                out.flush()
+                os.fsync(out.fileno()) # 检查点记录的字节数必须已经落盘
+                save_checkpoint(checkpoint_path, {"options": options, "last_id": export.last_id,
+                                                  "until_id": export.until_id, "bytes": written,
+                                                  "rows": rows + export.rows})
+            if time.perf_counter() - last_report >= 5:
+                last_report = time.perf_counter()
+                print(f"已导出 {rows + export.rows:,} 行 (id {export.last_id} / {export.until_id})", file=sys.stderr)
+    except KeyboardInterrupt:
+        hint = "用 --resume 继续" if checkpoint_path else f"用 --after-id {export.last_id} --until-id {export.until_id} 继续"
+        sys.exit(f"已中断：导出到 id {export.last_id}，{hint}")
+    finally:
+        out.flush()
+        if not to_stdout:
+            out.close()
+
+    if checkpoint_path and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+    elapsed = time.perf_counter() - t0
+    print(f"导出完成：本次 {export.rows:,} 行 (共 {rows + export.rows:,} 行)，{written / 2**20:.1f} MB，"
+          f"耗时 {elapsed:.1f}s ({export.rows / max(elapsed, 1e-9):,.0f} 行/秒)", file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
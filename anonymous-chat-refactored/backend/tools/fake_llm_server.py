@@ -0,0 +1,181 @@
+# backend/tools/fake_llm_server.py
+"""
+兼容 OpenRouter /chat/completions 接口的本地测试桩，用于离线测试 Agent 发言 (包括流式模式)。
+
+用法:
+    python tools/fake_llm_server.py --port 8001 --token-delay 0.05
+    # 另一个终端
+    OPENROUTER_BASE_URL=http://127.0.0.1:8001/v1/chat/completions AGENT_STREAMING=1 python main.py
+
+请求体中 "stream": true 时以 SSE 返回 (data: {...} 行，最后是 data: [DONE])，否则返回完整的 JSON。
+
+故障注入 (测试模型客户端的重试、断路器和对冲):
+    python tools/fake_llm_server.py --error-rate 0.2 --rate-limit-rate 0.1 --slow-rate 0.05 --slow-delay 5
+    python tools/fake_llm_server.py --fail-models openai/gpt-4o-2024-11-20   # 该模型一直返回 503
+请求带 response_format={"type": "json_object"} 时 (导演模式)，按系统提示中 "- agent_id「名字」" 的列表
+返回 {"replies": [...]}；--invalid-json-rate 控制返回非 JSON 内容的概率，用来测试回退到单独调用。
+运行中也可以通过 POST /_control (JSON，字段同 settings) 修改配置，GET /_stats 查看每个模型收到的请求数。
+"""
+import argparse
+import asyncio
+import json
+import random
+import re
+import time
+import uuid
+from collections import Counter
+from typing import Any, Dict
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI()
+
+settings = {
+    "first_token_delay": 0.3, # 首个 token 前的延迟 (秒)，模拟排队和 prefill
+    "token_delay": 0.05, # 每个 token 之间的延迟 (秒)
+    "error_rate": 0.0, # 返回 500 的概率
+    "rate_limit_rate": 0.0, # 返回 429 (带 Retry-After) 的概率
+    "retry_after": 1, # 429 响应的 Retry-After (秒)
+    "slow_rate": 0.0, # 额外延迟 slow_delay 秒的概率 (制造长尾延迟)
+    "slow_delay": 5.0,
+    "stream_error_rate": 0.0, # 流式响应输出一半后返回错误的概率
+    "fail_models": [], # 这些模型一直返回 503
+    "invalid_json_rate": 0.0, # JSON 模式下返回非 JSON 内容的概率
+}
+request_counts: Counter = Counter()
+
+SENTENCES = [
+    "今天中午只吃了一碗蔬菜沙拉，感觉还挺饱的。",
+    "其实控制体重最重要的是长期坚持，而不是短期节食。",
+    "晚饭后散步半小时，对血糖控制很有帮助。",
+    "大家有没有试过把含糖饮料换成无糖茶？",
+    "睡眠不足的时候特别容易想吃高热量的东西。",
+    "我觉得健康比体重秤上的数字更重要，你们说呢？",
+]
+
+
+def make_reply(body: Dict[str, Any]) -> str:
+    """根据请求拼一段随机回复，偶尔带上名字前缀以测试前缀清理"""
+    reply = "".join(random.sample(SENTENCES, k=random.randint(1, 3)))
+    messages = body.get("messages") or []
+    if (body.get("response_format") or {}).get("type") == "json_object":
+        if random.random() < settings["invalid_json_rate"]:
+            return reply
+        agent_ids = re.findall(r"^- (\S+)「", messages[0].get("content", "") if messages else "", re.M)
+        return json.dumps({"replies": [{"agent_id": agent_id, "content": "".join(random.sample(SENTENCES, k=random.randint(1, 2)))}
+                                       for agent_id in agent_ids]}, ensure_ascii=False)
+    if messages and random.random() < 0.2:
+        system = messages[0].get("content", "")
+        if "名叫 " in system:
+            name = system.split("名叫 ", 1)[1].split(" 的", 1)[0]
+            reply = f"{name}: {reply}"
+    return reply
+
+
+def tokenize(text: str) -> list[str]:
+    """按 1~3 个字符切分，近似中文模型的 token 粒度"""
+    tokens, index = [], 0
+    while index < len(text):
+        size = random.randint(1, 3)
+        tokens.append(text[index:index + size])
+        index += size
+    return tokens
+
+
+def completion_chunk(completion_id: str, model: str, delta: Dict[str, Any], finish_reason: str | None = None):
+    return {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+
+
+async def stream_reply(completion_id: str, model: str, reply: str, extra_delay: float):
+    yield ": OPENROUTER PROCESSING\n\n" # 和 OpenRouter 一样先发注释行保持连接
+    await asyncio.sleep(settings["first_token_delay"] + extra_delay)
+    yield f"data: {json.dumps(completion_chunk(completion_id, model, {'role': 'assistant'}))}\n\n"
+    tokens = tokenize(reply)
+    fail_at = len(tokens) // 2 if random.random() < settings["stream_error_rate"] else None
+    for index, token in enumerate(tokens):
+        if index == fail_at: # 和 OpenRouter 一样，流开始后的错误放在数据行里
+            yield f"data: {json.dumps({'error': {'code': 502, 'message': 'upstream disconnected'}})}\n\n"
+            return
+        yield f"data: {json.dumps(completion_chunk(completion_id, model, {'content': token}), ensure_ascii=False)}\n\n"
+        await asyncio.sleep(settings["token_delay"])
+    yield f"data: {json.dumps(completion_chunk(completion_id, model, {}, 'stop'))}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/chat/completions")
+@app.post("/api/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    model = body.get("model", "fake/model")
+    request_counts[model] += 1
+    if model in settings["fail_models"]:
+        return JSONResponse({"error": {"code": 503, "message": f"{model} is unavailable"}}, status_code=503)
+    if random.random() < settings["rate_limit_rate"]:
+        return JSONResponse({"error": {"code": 429, "message": "rate limited"}}, status_code=429,
+                            headers={"Retry-After": str(settings["retry_after"])})
+    if random.random() < settings["error_rate"]:
+        return JSONResponse({"error": {"code": 500, "message": "internal error"}}, status_code=500)
+    extra_delay = settings["slow_delay"] if random.random() < settings["slow_rate"] else 0.0
+
+    completion_id = f"gen-{uuid.uuid4().hex[:12]}"
+    reply = make_reply(body)
+
+    if body.get("stream"):
+        return StreamingResponse(stream_reply(completion_id, model, reply, extra_delay), media_type="text/event-stream")
+
+    # 非流式：等待整段回复 "生成" 完再返回
+    await asyncio.sleep(settings["first_token_delay"] + extra_delay + settings["token_delay"] * len(tokenize(reply)))
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": reply}, "finish_reason": "stop"}],
+    }
+
+
+@app.post("/_control")
+async def control(request: Request):
+    """运行中修改故障注入配置"""
+    updates = await request.json()
+    unknown = set(updates) - set(settings)
+    if unknown:
+        return JSONResponse({"error": f"unknown settings: {sorted(unknown)}"}, status_code=400)
+    settings.update(updates)
+    return settings
+
+
+@app.get("/_stats")
+async def stats():
+    return dict(request_counts)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="OpenRouter 兼容的本地模型测试桩")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--first-token-delay", type=float, default=settings["first_token_delay"])
+    parser.add_argument("--token-delay", type=float, default=settings["token_delay"])
+    parser.add_argument("--error-rate", type=float, default=settings["error_rate"])
+    parser.add_argument("--rate-limit-rate", type=float, default=settings["rate_limit_rate"])
+    parser.add_argument("--retry-after", type=int, default=settings["retry_after"])
+    parser.add_argument("--slow-rate", type=float, default=settings["slow_rate"])
+    parser.add_argument("--slow-delay", type=float, default=settings["slow_delay"])
+    parser.add_argument("--stream-error-rate", type=float, default=settings["stream_error_rate"])
+    parser.add_argument("--invalid-json-rate", type=float, default=settings["invalid_json_rate"])
+    parser.add_argument("--fail-models", nargs="*", default=[])
+    args = parser.parse_args()
+    settings.update({key: value for key, value in vars(args).items() if key in settings})
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
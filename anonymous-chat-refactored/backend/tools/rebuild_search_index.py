@@ -0,0 +1,46 @@
+# backend/tools/rebuild_search_index.py
+"""
+为已有的 chat.db 建立 (或重建) 全文检索索引。
+
+新的数据库启动时会自动创建索引，之后的消息由触发器同步；
+升级前就存在的消息需要运行一次本工具，索引损坏或手动改过 messages 表时也可以重新运行。
+可以在服务运行时执行 (WAL 模式下不阻塞读)，重建期间的写入会等待。
+
+用法:
+    python tools/rebuild_search_index.py
+    python tools/rebuild_search_index.py --db /path/to/chat.db
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from sqlalchemy import create_engine, text
+from search_index import FTS_TABLE, fts5_trigram_supported, rebuild_search_index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="重建聊天记录的全文检索索引")
+    parser.add_argument("--db", default="chat.db", help="SQLite 数据库文件路径")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        sys.exit(f"数据库文件不存在: {args.db}")
+    if not fts5_trigram_supported():
+        sys.exit("当前 SQLite 不支持 FTS5 trigram 分词器 (需要 3.34+)")
+
+    engine = create_engine(f"sqlite:///{args.db}")
+    t0 = time.perf_counter()
+    rebuild_search_index(engine)
+    with engine.connect() as conn:
+        rows = conn.execute(text("SELECT count(*) FROM messages")).scalar()
+        # docsize 表每个已索引的行一条记录
+        indexed = conn.execute(text(f"SELECT count(*) FROM {FTS_TABLE}_docsize")).scalar()
+    engine.dispose()
+    print(f"已索引 {indexed:,} / {rows:,} 条消息，耗时 {time.perf_counter() - t0:.1f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+# backend/upload_store.py
+import asyncio
+import hashlib
+import importlib.util
+import logging
+import os
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict
+from fastapi import Request
+from fastapi.staticfiles import StaticFiles
+import config
+
+try:
+    import python_multipart as multipart
+    from python_multipart.exceptions import FormParserError
+    from python_multipart.multipart import parse_options_header
+except ImportError: # 旧版本 python-multipart 的包名
+    import multipart
+    from multipart.exceptions import FormParserError
+    from multipart.multipart import parse_options_header
+
+logger = logging.getLogger(__name__)
+
+# 文件头魔数 -> (扩展名, MIME 类型)，不信任客户端给的文件名和 Content-Type
+IMAGE_SIGNATURES = [
+    (b"\xff\xd8\xff", "jpg", "image/jpeg"),
+    (b"\x89PNG\r\n\x1a\n", "png", "image/png"),
+    (b"GIF87a", "gif", "image/gif"),
+    (b"GIF89a", "gif", "image/gif"),
+]
+SNIFF_BYTES = 12
+MAX_FIELD_SIZE = 1024 # 普通表单字段 (user_id) 的最大长度
+
+
+class UploadError(Exception):
+    """上传被拒绝，status 为返回给客户端的 HTTP 状态码"""
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def sniff_image_type(head: bytes) -> tuple[str, str] | None:
+    """根据文件头判断图片类型，返回 (扩展名, MIME 类型)"""
+    for signature, extension, mime in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return extension, mime
+    if head[:4] == b"RIFF" and head[8:12] == b"WEBP":
+        return "webp", "image/webp"
+    return None
+
+
+def render_thumbnails(source: str, targets: Dict[int, str]) -> list[int]:
+    """
+    在进程池中运行：为原图生成各尺寸的缩略图 (最长边不超过 size，不放大)，返回生成成功的尺寸。
+    Pillow 只在工作进程里导入。
+    """
+    from PIL import Image
+    Image.MAX_IMAGE_PIXELS = config.UPLOAD_MAX_IMAGE_PIXELS # 防止解压炸弹
+    done = []
+    with Image.open(source) as image:
+        image.seek(0) # 动图只取第一帧
+        for size, target in sorted(targets.items(), reverse=True):
+            variant = image.copy()
+            variant.thumbnail((size, size))
+            if target.endswith(".jpg"):
+                variant = variant.convert("RGB")
+            tmp = f"{target}.{uuid.uuid4().hex}.tmp"
+            variant.save(tmp, format="JPEG" if target.endswith(".jpg") else "PNG", optimize=True)
+            os.replace(tmp, target)
+            done.append(size)
+    return done
+
+
+class _IncomingFile:
+    """正在接收的文件：边写临时文件边计算 sha256"""
+    def __init__(self, tmp_dir: str):
+        self.path = os.path.join(tmp_dir, f"{uuid.uuid4().hex}.part")
+        self.handle = open(self.path, "wb")
+        self.hasher = hashlib.sha256()
+        self.size = 0
+        self.head = b""
+        self.image_type: tuple[str, str] | None = None
+
+    def discard(self):
+        self.handle.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class UploadStore:
+    """
+    图片上传管道：直接从请求体流式解析 multipart，边接收边校验大小、嗅探文件头、计算 sha256，
+    按内容哈希存储 (相同的图片只存一份)，缩略图在进程池中生成 (安装了 Pillow 时)。
+    文件名由内容决定、永不覆盖，所以 /uploads 可以使用长期的 immutable 缓存。
+    """
+    def __init__(self, root: str = config.UPLOAD_DIR, max_size: int = config.UPLOAD_MAX_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.tmp_dir = os.path.join(root, ".tmp")
+        os.makedirs(self.tmp_dir, exist_ok=True)
+        self.thumbnail_sizes = config.UPLOAD_THUMBNAIL_SIZES if importlib.util.find_spec("PIL") else []
+        self.process_pool: ProcessPoolExecutor | None = None
+        if config.UPLOAD_THUMBNAIL_SIZES and not self.thumbnail_sizes:
+            logger.info("未安装 Pillow，上传图片不生成缩略图。")
+
+    async def receive(self, request: Request) -> Dict[str, Any]:
+        """接收一次上传请求，返回保存结果 (见 _store)"""
+        content_type, params = parse_options_header(request.headers.get("content-type", ""))
+        if content_type != b"multipart/form-data" or b"boundary" not in params:
+            raise UploadError("请求必须是 multipart/form-data")
+        content_length = request.headers.get("content-length")
+        if content_length and content_length.isdigit() and int(content_length) > self.max_size + 64 * 1024:
+            raise UploadError(f"文件过大，最大 {self.max_size // (1024 * 1024)} MB", status=413)
+
+        # python-multipart 的回调是同步的：先收集事件，每喂完一块数据再异步处理 (写文件不阻塞事件循环)
+        events: list[tuple[str, bytes]] = []
+        header_field = b""
+        headers: Dict[bytes, bytes] = {}
+
+        def on_header_field(data, start, end):
+            nonlocal header_field
+            header_field += data[start:end]
+
+        def on_header_value(data, start, end):
+            nonlocal header_field
+            headers[header_field.lower()] = headers.get(header_field.lower(), b"") + data[start:end]
+
+        def on_header_end():
+            nonlocal header_field
+            header_field = b""
+
+        def on_headers_finished():
+            events.append(("part", headers.get(b"content-disposition", b"")))
+            headers.clear()
+
+        parser = multipart.MultipartParser(params[b"boundary"], callbacks={
+            "on_header_field": on_header_field,
+            "on_header_value": on_header_value,
+            "on_header_end": on_header_end,
+            "on_headers_finished": on_headers_finished,
+            "on_part_data": lambda data, start, end: events.append(("data", data[start:end])),
+            "on_part_end": lambda: events.append(("end", b"")),
+        })
+
+        fields: Dict[str, str] = {}
+        incoming: _IncomingFile | None = None
+        current: str | None = None # 当前 part 的字段名
+        current_is_file = False
+        field_value = b""
+        try:
+            async for chunk in request.stream():
+                parser.write(chunk)
+                for kind, data in events:
+                    if kind == "part":
+                        _, disposition = parse_options_header(data)
+                        current = disposition.get(b"name", b"").decode("utf-8", "replace")
+                        current_is_file = b"filename" in disposition
+                        field_value = b""
+                        if current_is_file:
+                            if incoming is not None or current != "file":
+                                raise UploadError("每次只能上传一个文件 (字段名 file)")
+                            incoming = await asyncio.to_thread(_IncomingFile, self.tmp_dir)
+                    elif kind == "data" and current_is_file:
+                        await self._write(incoming, data)
+                    elif kind == "data":
+                        field_value += data
+                        if len(field_value) > MAX_FIELD_SIZE:
+                            raise UploadError(f"表单字段 {current} 过长")
+                    elif kind == "end" and not current_is_file and current:
+                        fields[current] = field_value.decode("utf-8", "replace")
+                events.clear()
+            parser.finalize()
+
+            if incoming is None or incoming.size == 0:
+                raise UploadError("没有收到文件")
+            if incoming.image_type is None:
+                raise UploadError("不支持的文件类型，只能上传 JPEG、PNG、GIF 或 WebP 图片")
+            await asyncio.to_thread(incoming.handle.close)
+            result = await self._store(incoming)
+        except BaseException as e: # 包括客户端中途断开 (取消)，都要删掉临时文件
+            if incoming is not None:
+                await asyncio.to_thread(incoming.discard)
+            if isinstance(e, FormParserError):
+                raise UploadError(f"multipart 格式错误: {e}") from e
+            raise
+        result["user_id"] = fields.get("user_id") or fields.get("userId") # 前端发送的是 userId
+        return result
+
+    async def _write(self, incoming: _IncomingFile, data: bytes):
+        incoming.size += len(data)
+        if incoming.size > self.max_size:
+            raise UploadError(f"文件过大，最大 {self.max_size // (1024 * 1024)} MB", status=413)
+        if incoming.image_type is None:
+            incoming.head += data[:SNIFF_BYTES]
+            if len(incoming.head) >= SNIFF_BYTES:
+                # 收到文件头就判断类型，不是图片就不再接收剩下的数据
+                incoming.image_type = sniff_image_type(incoming.head)
+                if incoming.image_type is None:
+                    raise UploadError("不支持的文件类型，只能上传 JPEG、PNG、GIF 或 WebP 图片")
+        incoming.hasher.update(data)
+        await asyncio.to_thread(incoming.handle.write, data)
+
+    def _relative_path(self, digest: str, suffix: str) -> str:
+        # 按哈希前两位分目录，避免单个目录下文件过多
+        return f"{digest[:2]}/{digest}{suffix}"
+
+    async def _store(self, incoming: _IncomingFile) -> Dict[str, Any]:
+        """
+        按内容哈希落盘 (已存在则直接复用)，生成缺少的缩略图。
+        返回 url、sha256、size、contentType、deduplicated 和 thumbnails (尺寸 -> url)。
+        """
+        extension, mime = incoming.image_type
+        digest = incoming.hasher.hexdigest()
+        relative = self._relative_path(digest, f".{extension}")
+        final_path = os.path.join(self.root, relative)
+        deduplicated = os.path.exists(final_path)
+        if deduplicated:
+            await asyncio.to_thread(incoming.discard)
+        else:
+            os.makedirs(os.path.dirname(final_path), exist_ok=True)
+            await asyncio.to_thread(os.replace, incoming.path, final_path) # 原子改名，不会出现写了一半的文件
+
+        thumbnails = await self._ensure_thumbnails(final_path, digest, extension)
+        return {
+            "url": f"/uploads/{relative}",
+            "sha256": digest,
+            "size": incoming.size,
+            "contentType": mime,
+            "deduplicated": deduplicated,
+            "thumbnails": thumbnails,
+        }
+
+    async def _ensure_thumbnails(self, source: str, digest: str, extension: str) -> Dict[str, str]:
+        if not self.thumbnail_sizes:
+            return {}
+        thumb_extension = "jpg" if extension == "jpg" else "png"
+        targets = {size: self._relative_path(digest, f"_{size}.{thumb_extension}") for size in self.thumbnail_sizes}
+        missing = {size: os.path.join(self.root, relative) for size, relative in targets.items()
+                   if not os.path.exists(os.path.join(self.root, relative))}
+        if missing:
+            if self.process_pool is None:
+                self.process_pool = ProcessPoolExecutor(max_workers=config.UPLOAD_THUMBNAIL_WORKERS)
+            try:
+                loop = asyncio.get_running_loop()
+                await loop.run_in_executor(self.process_pool, render_thumbnails, source, missing)
+            except Exception as e: # 图片损坏等情况下只是没有缩略图，原图照常可用
+                logger.warning(f"生成缩略图失败 {source}: {e}")
+        return {str(size): f"/uploads/{relative}" for size, relative in targets.items()
+                if os.path.exists(os.path.join(self.root, relative))}
+
+    def close(self):
+        if self.process_pool:
+            self.process_pool.shutdown(wait=False, cancel_futures=True)
+
+
+class ImmutableStaticFiles(StaticFiles):
+    """上传文件永不覆盖 (内容哈希或 UUID 文件名)，浏览器和 CDN 可以一直缓存"""
+    def file_response(self, *args, **kwargs):
+        response = super().file_response(*args, **kwargs)
+        if response.status_code == 200:
+            response.headers["Cache-Control"] = f"public, max-age={config.UPLOAD_CACHE_MAX_AGE}, immutable"
+        return response
@@ -0,0 +1,117 @@
+# backend/wire_codec.py
+"""
+WebSocket 帧的编解码。客户端连接时通过 ?codec= 协商 (默认 json)：
+  - "json": 文本帧。安装了 orjson 时用 orjson，否则用紧凑的标准库 json (不转义中文，体积更小)
+  - "msgpack": 二进制帧 (需要安装 msgpack)
+广播时每种编码只序列化一次，同一编码的所有连接共享同一份帧。
+"""
+import json
+import logging
+from typing import Any, Dict
+from fastapi import WebSocket, WebSocketDisconnect
+import config
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+DEFAULT_CODEC = "json"
+
+
+class Codec:
+    name = ""
+    binary = False # True 时以二进制帧发送
+
+    def encode(self, message: Any) -> str | bytes:
+        raise NotImplementedError
+
+    def decode(self, data: str | bytes) -> Any:
+        """解码客户端发来的帧，格式错误时抛出 ValueError"""
+        raise NotImplementedError
+
+
+class JSONCodec(Codec):
+    name = "json"
+
+    def encode(self, message: Any) -> str:
+        if orjson is not None:
+            return orjson.dumps(message).decode()
+        return json.dumps(message, ensure_ascii=False, separators=(",", ":"))
+
+    def decode(self, data: str | bytes) -> Any:
+        if orjson is not None:
+            return orjson.loads(data) # orjson.JSONDecodeError 是 ValueError 的子类
+        return json.loads(data)
+
+
+class MsgPackCodec(Codec):
+    name = "msgpack"
+    binary = True
+
+    def encode(self, message: Any) -> bytes:
+        return msgpack.packb(message, use_bin_type=True)
+
+    def decode(self, data: str | bytes) -> Any:
+        if isinstance(data, str):
+            raise ValueError("msgpack 连接收到了文本帧")
+        try:
+            return msgpack.unpackb(data, raw=False)
+        except Exception as e: # msgpack 的各种格式错误并不都继承自 ValueError
+            raise ValueError(f"msgpack 解码失败: {e}") from e
+
+
+CODECS: Dict[str, Codec] = {"json": JSONCodec()}
+if msgpack is not None:
+    CODECS["msgpack"] = MsgPackCodec()
+
+
+def get_codec(name: str | None) -> Codec | None:
+    """按名字查找编码，未安装或未知时返回 None"""
+    return CODECS.get(name or DEFAULT_CODEC)
+
+
+async def receive_frame(websocket: WebSocket) -> str | bytes:
+    """接收一帧的原始数据 (还没有解码，可以先按大小和频率决定是否丢弃)"""
+    message = await websocket.receive()
+    if message["type"] == "websocket.disconnect":
+        raise WebSocketDisconnect(message.get("code", 1000), message.get("reason"))
+    data = message.get("text")
+    if data is None:
+        data = message.get("bytes") or b""
+    return data
+
+
+try:
+    from uvicorn.protocols.websockets.websockets_sansio_impl import WebSocketsSansIOProtocol
+    from websockets.extensions.permessage_deflate import ServerPerMessageDeflateFactory
+    from websockets.server import ServerProtocol
+except ImportError: # 没有安装 websockets (或 uvicorn 版本较旧) 时只能用 uvicorn 的默认压缩参数
+    WebSocketsSansIOProtocol = None
+
+# uvicorn 只能开关 permessage-deflate，参数需要通过自定义的协议类设置 (传给 uvicorn 的 ws 参数)
+DEFLATE_PROTOCOL = "wire_codec:DeflateTunedWebSocketProtocol" if WebSocketsSansIOProtocol is not None else "auto"
+
+if WebSocketsSansIOProtocol is not None:
+    class DeflateTunedWebSocketProtocol(WebSocketsSansIOProtocol):
+        """
+        按配置设置 permessage-deflate 参数的 uvicorn WebSocket 协议：
+        较小的压缩窗口能显著降低每个连接的内存占用，对短小的聊天消息压缩率几乎没有影响。
+        """
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            if self.config.ws_per_message_deflate:
+                self.conn = ServerProtocol(
+                    extensions=[ServerPerMessageDeflateFactory(
+                        server_max_window_bits=config.WS_DEFLATE_MAX_WINDOW_BITS,
+                        client_max_window_bits=config.WS_DEFLATE_MAX_WINDOW_BITS,
+                        compress_settings={"level": config.WS_DEFLATE_LEVEL, "memLevel": config.WS_DEFLATE_MEM_LEVEL},
+                    )],
+                    max_size=self.config.ws_max_size,
+                    logger=logging.getLogger("uvicorn.error"),
+                )